@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Choose the best name compression pipeline for every block.
+
+A pipeline is a transform, optionally preceded by sorting the names of the
+block, followed by an entropy backend. Which pipeline wins depends on the
+data: the column transform works well for UUIDs with bzip2, the tokenizer
+for Illumina names. Every candidate is tried on a sample of the block and
+the smallest one that stays within the CPU budget is used for the entire
+block. The pipeline identifier is stored in the first byte of the block.
+"""
+
+import argparse
+import collections
+import functools
+import io
+import struct
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from entropy_backends import BACKENDS, RAW, ZLIB, backend_allowed
+from idcompression import EncodedColumns, EncodedNames
+from mmap_reader import LineBlock, MappedFile
+from parallel import ordered_map
+from permutation_codec import decode_permutation, encode_permutation
+from prefix_remover import front_decode, front_encode
+import punctuation_tokenizer
+
+PLAIN = 0
+NAMES = 1
+COLUMNS = 2
+TOKENIZER = 3
+FRONT_CODING = 4
+
+
+def plain_encode(names: Sequence[str]) -> bytes:
+    return "".join(name + "\n" for name in names).encode("utf-8")
+
+
+def plain_decode(data: bytes) -> List[str]:
+    return data.decode("utf-8").split("\n")[:-1]
+
+
+def transposed_encode(encoder, names: Sequence[str]) -> bytes:
+    return struct.pack("<I", len(names)) + encoder(names).raw_data()
+
+
+def transposed_decode(encoder, data: bytes) -> List[str]:
+    number_of_names, = struct.unpack("<I", data[:4])
+    return list(encoder.from_raw_data(number_of_names, data[4:]).decode())
+
+
+class Transform(NamedTuple):
+    name: str
+    encode: Callable[[Sequence[str]], bytes]
+    decode: Callable[[bytes], List[str]]
+
+
+TRANSFORMS: Dict[int, Transform] = {
+    PLAIN: Transform("plain", plain_encode, plain_decode),
+    NAMES: Transform("names", functools.partial(transposed_encode, EncodedNames),
+                     functools.partial(transposed_decode, EncodedNames)),
+    COLUMNS: Transform("columns",
+                       functools.partial(transposed_encode, EncodedColumns),
+                       functools.partial(transposed_decode, EncodedColumns)),
+    # The tokenizer compresses its columns itself.
+    TOKENIZER: Transform("tokenizer", punctuation_tokenizer.compress,
+                         lambda data: list(punctuation_tokenizer.decompress(data))),
+    FRONT_CODING: Transform("front", front_encode, front_decode),
+}
+
+
+def sort_names(names: Sequence[str]) -> Tuple[bytes, List[str]]:
+    """Sort the names and return the encoded sort indexes as well."""
+    order = sorted(range(len(names)), key=names.__getitem__)
+    return encode_permutation(order), [names[index] for index in order]
+
+
+class Pipeline(NamedTuple):
+    transform_id: int
+    sort: bool
+    backend_id: int
+
+    @property
+    def id(self) -> int:
+        return (self.transform_id << 4) | (self.sort << 3) | self.backend_id
+
+    @classmethod
+    def from_id(cls, pipeline_id: int):
+        pipeline = cls(pipeline_id >> 4, bool(pipeline_id & 0x08), pipeline_id & 0x07)
+        if (pipeline.transform_id not in TRANSFORMS or
+                pipeline.backend_id not in BACKENDS):
+            raise ValueError(f"Unknown pipeline: {pipeline_id}")
+        return pipeline
+
+    @property
+    def name(self) -> str:
+        parts = [TRANSFORMS[self.transform_id].name]
+        if self.sort:
+            parts.append("sort")
+        parts.append(BACKENDS[self.backend_id].name)
+        return "+".join(parts)
+
+    def encode(self, names: Sequence[str]) -> bytes:
+        indexes = b""
+        if self.sort:
+            indexes, names = sort_names(names)
+        transformed = TRANSFORMS[self.transform_id].encode(names)
+        return indexes + BACKENDS[self.backend_id].compress(transformed)
+
+    def decode(self, data: bytes) -> List[str]:
+        stream = io.BytesIO(data)
+        order = decode_permutation(stream).tolist() if self.sort else None
+        transformed = BACKENDS[self.backend_id].decompress(stream.read())
+        names = TRANSFORMS[self.transform_id].decode(transformed)
+        if order is None:
+            return names
+        unsorted = [""] * len(names)
+        for index, name in zip(order, names):
+            unsorted[index] = name
+        return unsorted
+
+
+FALLBACK = Pipeline(PLAIN, False, ZLIB)
+
+
+def backends_for(transform_id: int) -> List[int]:
+    if transform_id == TOKENIZER:
+        return [RAW]
+    return list(BACKENDS)
+
+
+def choose_pipeline(names: Sequence[str], sample_size: int = 1000,
+                    budget: Optional[float] = None) -> Pipeline:
+    """
+    Try every pipeline on the first sample_size names and return the one
+    with the smallest output. budget is the maximum number of CPU seconds
+    per megabyte of names a pipeline may use. Once trying the pipelines has
+    used that much time no more are tried. Each transform is applied once
+    and its output is shared by all backends. Backends are only tried when
+    compress_column would use them on the transformed block.
+    """
+    sample = names[:sample_size]
+    sample_megabytes = max(sum(map(len, sample)) + len(sample), 1) / 1e6
+    block_scale = len(names) / max(len(sample), 1)
+    trials_start = time.process_time()
+
+    def over_budget(cpu_time: float) -> bool:
+        return budget is not None and cpu_time / sample_megabytes > budget
+
+    best, best_size = FALLBACK, None
+    for sort in (False, True):
+        start = time.process_time()
+        indexes, transform_input = sort_names(sample) if sort else (b"", sample)
+        sort_time = time.process_time() - start
+        for transform_id, transform in TRANSFORMS.items():
+            start = time.process_time()
+            try:
+                transformed = transform.encode(transform_input)
+            except (ValueError, NotImplementedError, UnicodeError):
+                continue
+            transform_time = sort_time + time.process_time() - start
+            for backend_id in backends_for(transform_id):
+                if over_budget(time.process_time() - trials_start):
+                    return best
+                if not backend_allowed(backend_id, int(len(transformed) * block_scale)):
+                    continue
+                start = time.process_time()
+                size = len(indexes) + len(BACKENDS[backend_id].compress(transformed))
+                cpu_time = transform_time + time.process_time() - start
+                if over_budget(cpu_time):
+                    continue
+                if best_size is None or size < best_size:
+                    best, best_size = Pipeline(transform_id, sort, backend_id), size
+    return best
+
+
+def compress(names: Sequence[str], sample_size: int = 1000,
+             budget: Optional[float] = None) -> bytes:
+    """
+    Compress names with the pipeline chosen on the sample. The result is
+    decoded again and the block falls back to plain+zlib when it does not
+    round trip.
+    """
+    pipeline = choose_pipeline(names, sample_size, budget)
+    try:
+        encoded = pipeline.encode(names)
+        if pipeline.decode(encoded) != list(names):
+            raise ValueError(f"{pipeline.name} does not round trip")
+    except (ValueError, NotImplementedError, UnicodeError):
+        # The sample did not contain the names the transform can not handle.
+        pipeline = FALLBACK
+        encoded = pipeline.encode(names)
+    return struct.pack("B", pipeline.id) + encoded
+
+
+def decompress(data: bytes) -> List[str]:
+    return Pipeline.from_id(data[0]).decode(data[1:])
+
+
+def block_result(sample_size: int, budget: Optional[float],
+                 block: LineBlock) -> Tuple[str, int, int]:
+    names = block.to_str_list("utf-8")
+    compressed = compress(names, sample_size, budget)
+    assert decompress(compressed) == names
+    original = len(block.newline_terminated())
+    return Pipeline.from_id(compressed[0]).name, original, len(compressed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("names", help="newline separated names")
+    parser.add_argument("-b", "--block-size", type=int, default=10_000)
+    parser.add_argument("-s", "--sample-size", type=int, default=1000,
+                        help="Number of names of each block to try the "
+                             "pipelines on.")
+    parser.add_argument("--budget", type=float,
+                        help="Maximum CPU seconds per megabyte of names. "
+                             "Slower pipelines are not considered.")
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="Number of processes used to encode blocks.")
+    args = parser.parse_args()
+    chosen = collections.Counter()
+    original = compressed = 0
+    start = time.perf_counter()
+    with MappedFile(args.names) as f:
+        blocks = f.blocks(args.block_size)
+        encode_block = functools.partial(block_result, args.sample_size, args.budget)
+        for name, original_size, compressed_size in ordered_map(
+                encode_block, blocks, args.threads):
+            chosen[name] += 1
+            original += original_size
+            compressed += compressed_size
+    for name, count in chosen.most_common():
+        print(f"{name}\t{count} blocks")
+    print(f"original\t{original}")
+    print(f"compressed\t{compressed}")
+    print(f"time\t\t{time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
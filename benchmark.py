@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark every transform combined with every entropy backend on the
+bundled datasets.
+
+For each combination the compressed size, the bits per record, the encode
+and decode throughput and the peak resident memory are reported. Every
+measurement runs in a fresh process so the peak memory of one combination
+does not carry over to the next. Peak memory includes the interpreter and
+numpy, roughly 30 MiB.
+
+Results can be stored as JSON and compared against a stored baseline. The
+exit status is 1 when a compressed size grew compared to the baseline.
+"""
+
+import argparse
+import concurrent.futures
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import resource
+import struct
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+import block_sort
+import punctuation_tokenizer
+import reversible_sort
+from entropy_backends import BACKEND_IDS, BACKENDS
+from idcompression import EncodedColumns, EncodedNames
+from prefix_remover import find_common_prefix, front_decode, front_encode
+from quality_block import QualityBlock, lengths_from_stream, lengths_to_bytes
+
+NAMES = "names"
+QUALITIES = "qualities"
+
+
+class Dataset(NamedTuple):
+    path: str
+    kind: str
+
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+DATASETS = [
+    Dataset(os.path.join(DATA_DIR, "10000_illumina_ids.txt"), NAMES),
+    Dataset(os.path.join(DATA_DIR, "10000_illumina_ids_simpler.txt"), NAMES),
+    Dataset(os.path.join(DATA_DIR, "10000_ont_ids.txt"), NAMES),
+    Dataset(os.path.join(DATA_DIR, "10000_pacbio_revio_ids.txt"), NAMES),
+    Dataset(os.path.join(DATA_DIR, "100nanoporequals.txt"), QUALITIES),
+]
+
+
+def join_lines(lines: List[str]) -> bytes:
+    return "".join(line + "\n" for line in lines).encode("ascii")
+
+
+def split_lines(data: bytes) -> List[str]:
+    return data.decode("ascii").split("\n")[:-1]
+
+
+def encoded_names_encode(encoder, lines: List[str]) -> bytes:
+    return struct.pack("<I", len(lines)) + encoder(lines).raw_data()
+
+
+def encoded_names_decode(encoder, data: bytes) -> List[str]:
+    number_of_names, = struct.unpack("<I", data[:4])
+    return list(encoder.from_raw_data(number_of_names, data[4:]).decode())
+
+
+def sort_encode(sort_file: Callable, lines: List[str]) -> bytes:
+    """Sort with the file based sort scripts and store the compact indexes."""
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "input")
+        sorted_path = os.path.join(tmp, "sorted")
+        index_path = os.path.join(tmp, "indexes")
+        with open(input_path, "wb") as f:
+            f.write(join_lines(lines))
+        sort_file(input_path, sorted_path, index_path)
+        with open(index_path, "rb") as f:
+            indexes = f.read()
+        with open(sorted_path, "rb") as f:
+            sorted_lines = f.read()
+    return struct.pack("<I", len(indexes)) + indexes + sorted_lines
+
+
+def sort_decode(unsort_file: Callable, data: bytes) -> List[str]:
+    index_length, = struct.unpack("<I", data[:4])
+    with tempfile.TemporaryDirectory() as tmp:
+        sorted_path = os.path.join(tmp, "sorted")
+        index_path = os.path.join(tmp, "indexes")
+        output_path = os.path.join(tmp, "output")
+        with open(index_path, "wb") as f:
+            f.write(data[4:4 + index_length])
+        with open(sorted_path, "wb") as f:
+            f.write(data[4 + index_length:])
+        unsort_file(sorted_path, index_path, output_path)
+        with open(output_path, "rb") as f:
+            return split_lines(f.read())
+
+
+def prefix_encode(lines: List[str]) -> bytes:
+    prefix = find_common_prefix(lines) if lines else ""
+    stripped = [line[len(prefix):] for line in lines]
+    return struct.pack("<I", len(prefix)) + prefix.encode("ascii") + join_lines(stripped)
+
+
+def prefix_decode(data: bytes) -> List[str]:
+    prefix_length, = struct.unpack("<I", data[:4])
+    prefix = data[4:4 + prefix_length].decode("ascii")
+    return [prefix + line for line in split_lines(data[4 + prefix_length:])]
+
+
+def range_encode(lines: List[str]) -> bytes:
+    block = QualityBlock.from_qualities(lines)
+    return lengths_to_bytes(block.lengths) + block.range_encode()
+
+
+def range_decode(data: bytes) -> List[str]:
+    stream = io.BytesIO(data)
+    lengths = lengths_from_stream(stream)
+    return QualityBlock.range_decode(stream.read(), lengths).qualities()
+
+
+class Transform(NamedTuple):
+    name: str
+    kinds: Tuple[str, ...]
+    encode: Callable[[List[str]], bytes]
+    decode: Callable[[bytes], List[str]]
+
+
+TRANSFORMS = {transform.name: transform for transform in [
+    Transform("none", (NAMES, QUALITIES), join_lines, split_lines),
+    Transform("names", (NAMES,),
+              lambda lines: encoded_names_encode(EncodedNames, lines),
+              lambda data: encoded_names_decode(EncodedNames, data)),
+    Transform("columns", (NAMES,),
+              lambda lines: encoded_names_encode(EncodedColumns, lines),
+              lambda data: encoded_names_decode(EncodedColumns, data)),
+    Transform("names_bitpacked", (NAMES,),
+              lambda lines: EncodedNames(lines).packed_data(),
+              lambda data: list(EncodedNames.from_packed_data(data).decode())),
+    Transform("tokenizer", (NAMES,), punctuation_tokenizer.compress,
+              lambda data: list(punctuation_tokenizer.decompress(data))),
+    Transform("reversible_sort", (NAMES, QUALITIES),
+              lambda lines: sort_encode(
+                  lambda *paths: reversible_sort.sort_file(*paths, "I", compact=True),
+                  lines),
+              lambda data: sort_decode(
+                  lambda *paths: reversible_sort.unsort_file(*paths, "I", compact=True),
+                  data)),
+    Transform("block_sort", (NAMES, QUALITIES),
+              lambda lines: sort_encode(
+                  lambda *paths: block_sort.sort_file(*paths, compact=True), lines),
+              lambda data: sort_decode(
+                  lambda *paths: block_sort.unsort_file(*paths, compact=True), data)),
+    Transform("prefix_remover", (NAMES, QUALITIES), prefix_encode, prefix_decode),
+    Transform("front_coding", (NAMES,), front_encode, front_decode),
+    Transform("qual_range_finder", (QUALITIES,), range_encode, range_decode),
+]}
+
+
+def available_transforms() -> List[str]:
+    names = list(TRANSFORMS)
+    if importlib.util.find_spec("diffcompress") is None:
+        print("diffcompress extension is not built, skipping qual_range_finder. "
+              "Build it with: python setup.py build_ext --inplace",
+              file=sys.stderr)
+        names.remove("qual_range_finder")
+    return names
+
+
+def measure(dataset: Dataset, transform_name: str, backend_name: str,
+            repeats: int) -> Dict:
+    """Run in a separate process, so ru_maxrss is the peak of this run only."""
+    transform = TRANSFORMS[transform_name]
+    backend = BACKENDS[BACKEND_IDS[backend_name]]
+    with open(dataset.path, "rt") as f:
+        lines = f.read().splitlines()
+    original_size = sum(len(line) + 1 for line in lines)
+    encode_time = decode_time = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        compressed = backend.compress(transform.encode(lines))
+        encode_time = min(encode_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        decoded = transform.decode(backend.decompress(compressed))
+        decode_time = min(decode_time, time.perf_counter() - start)
+        if decoded != lines:
+            raise RuntimeError(f"Round trip failed for {transform_name} + "
+                               f"{backend_name} on {dataset.path}")
+    # Kilobytes on Linux.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "dataset": os.path.basename(dataset.path),
+        "transform": transform_name,
+        "backend": backend_name,
+        "records": len(lines),
+        "original_size": original_size,
+        "compressed_size": len(compressed),
+        "bits_per_record": len(compressed) * 8 / max(len(lines), 1),
+        "encode_mb_per_s": original_size / encode_time / 1e6,
+        "decode_mb_per_s": original_size / decode_time / 1e6,
+        "peak_rss_mib": peak_rss / 1024,
+    }
+
+
+def run_benchmarks(datasets: List[Dataset], transforms: List[str],
+                   backends: List[str], repeats: int = 1,
+                   processes: int = 1) -> List[Dict]:
+    tasks = [(dataset, transform, backend)
+             for dataset in datasets
+             for transform in transforms if dataset.kind in TRANSFORMS[transform].kinds
+             for backend in backends]
+    # A fresh interpreter for every measurement keeps peak RSS separate.
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=1) as executor:
+        futures = [executor.submit(measure, *task, repeats) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def result_key(result: Dict) -> Tuple[str, str, str]:
+    return result["dataset"], result["transform"], result["backend"]
+
+
+def print_table(results: List[Dict]):
+    print(f"{'dataset':<32} {'transform':<18} {'backend':<7} {'size':>9} "
+          f"{'bits/rec':>9} {'enc MB/s':>9} {'dec MB/s':>9} {'RSS MiB':>8}")
+    for result in results:
+        print(f"{result['dataset']:<32} {result['transform']:<18} "
+              f"{result['backend']:<7} {result['compressed_size']:>9} "
+              f"{result['bits_per_record']:>9.1f} "
+              f"{result['encode_mb_per_s']:>9.2f} "
+              f"{result['decode_mb_per_s']:>9.2f} "
+              f"{result['peak_rss_mib']:>8.1f}")
+
+
+def compare_with_baseline(results: List[Dict], baseline: List[Dict]) -> bool:
+    """Print the changes against the baseline. Returns False when a size grew."""
+    baseline_results = {result_key(result): result for result in baseline}
+    ok = True
+    print(f"{'dataset':<32} {'transform':<18} {'backend':<7} {'size':>9} "
+          f"{'change':>8} {'enc':>7} {'dec':>7}")
+    for result in results:
+        old = baseline_results.get(result_key(result))
+        if old is None:
+            continue
+        size_change = result["compressed_size"] / old["compressed_size"] - 1
+        encode_change = result["encode_mb_per_s"] / old["encode_mb_per_s"] - 1
+        decode_change = result["decode_mb_per_s"] / old["decode_mb_per_s"] - 1
+        marker = ""
+        if result["compressed_size"] > old["compressed_size"]:
+            marker = "  REGRESSION"
+            ok = False
+        print(f"{result['dataset']:<32} {result['transform']:<18} "
+              f"{result['backend']:<7} {result['compressed_size']:>9} "
+              f"{size_change:>+8.2%} {encode_change:>+7.0%} "
+              f"{decode_change:>+7.0%}{marker}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-d", "--datasets", nargs="+",
+                        help="Only run these datasets (file names).")
+    parser.add_argument("-T", "--transforms", nargs="+", choices=TRANSFORMS.keys(),
+                        help="Only run these transforms.")
+    parser.add_argument("-b", "--backends", nargs="+", choices=BACKEND_IDS.keys(),
+                        help="Only run these backends.")
+    parser.add_argument("-r", "--repeats", type=int, default=1,
+                        help="Report the fastest of this many runs.")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="Run this many measurements at once. Throughput "
+                             "is less reliable when they compete for CPU.")
+    parser.add_argument("-j", "--json", help="Write the results to this file.")
+    parser.add_argument("--baseline",
+                        help="JSON file from an earlier run to compare with.")
+    args = parser.parse_args()
+    datasets = DATASETS
+    if args.datasets:
+        datasets = [dataset for dataset in DATASETS
+                    if os.path.basename(dataset.path) in args.datasets]
+    transforms = args.transforms or available_transforms()
+    backends = args.backends or list(BACKEND_IDS)
+    results = run_benchmarks(datasets, transforms, backends, args.repeats,
+                             args.processes)
+    print_table(results)
+    if args.json:
+        with open(args.json, "wt") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "rt") as f:
+            baseline = json.load(f)
+        print()
+        if not compare_with_baseline(results, baseline):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
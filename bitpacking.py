@@ -0,0 +1,154 @@
+"""
+Bit-packing for columns with a small alphabet.
+
+A column is stored as its alphabet followed by the index of every byte in
+that alphabet, packed at ceil(log2(alphabet size)) bits. Constant columns
+need 0 bits so only the single character is stored. Hexadecimal columns
+take 4 bits, a UUID variant column 2 bits.
+
+Also holds the helpers that pick the smallest array typecode for a range of
+integers, shared by the name and quality codecs.
+"""
+
+import array
+import struct
+from typing import BinaryIO, List, Sequence
+
+import numpy as np
+
+UINT64_MAX = 0xFFFF_FFFF_FFFF_FFFF
+UINT32_MAX = 0xFFFF_FFFF
+UINT16_MAX = 0xFFFF
+UINT8_MAX = 0xFF
+INT64_MAX = 9223372036854775807
+INT32_MAX = 2147483647
+INT16_MAX = 32767
+INT8_MAX = 127
+INT64_MIN = - INT64_MAX - 1
+INT32_MIN = - INT32_MAX - 1
+INT16_MIN = - INT16_MAX - 1
+INT8_MIN = - INT8_MAX - 1
+
+# Integers are packed this many at a time, so the bit planes of only one
+# slice are held in memory. A multiple of 8, so every slice starts on a byte.
+PACK_SLICE_SIZE = 1 << 14
+
+
+def bits_needed(alphabet_size: int) -> int:
+    return (alphabet_size - 1).bit_length()
+
+
+def pack_integers(values: np.ndarray, bits: int) -> bytes:
+    """Pack non-negative integers at a fixed number of bits, most significant bit first."""
+    if bits == 0:
+        return b""
+    values = np.asarray(values)
+    shifts = np.arange(bits - 1, -1, -1, dtype=np.uint64)
+    packed = np.empty(packed_length(len(values), bits), dtype=np.uint8)
+    for start in range(0, len(values), PACK_SLICE_SIZE):
+        part = values[start:start + PACK_SLICE_SIZE].astype(np.uint64)
+        bit_planes = ((part[:, np.newaxis] >> shifts) & np.uint64(1)).astype(np.uint8)
+        part_packed = np.packbits(bit_planes)
+        byte_start = start * bits // 8
+        packed[byte_start:byte_start + len(part_packed)] = part_packed
+    return packed.tobytes()
+
+
+def unpack_integers(data: bytes, count: int, bits: int) -> np.ndarray:
+    if bits == 0:
+        return np.zeros(count, dtype=np.uint64)
+    packed = np.frombuffer(data, dtype=np.uint8, count=packed_length(count, bits))
+    shifts = np.arange(bits - 1, -1, -1, dtype=np.uint64)
+    values = np.empty(count, dtype=np.uint64)
+    for start in range(0, count, PACK_SLICE_SIZE):
+        part_count = min(PACK_SLICE_SIZE, count - start)
+        part_packed = packed[start * bits // 8:packed_length(start + part_count, bits)]
+        bit_planes = np.unpackbits(part_packed, count=part_count * bits).reshape(
+            part_count, bits)
+        values[start:start + part_count] = (
+            bit_planes.astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+    return values
+
+
+def packed_length(count: int, bits: int) -> int:
+    return (count * bits + 7) // 8
+
+
+def pack_column(column: bytes) -> bytes:
+    data = np.frombuffer(column, dtype=np.uint8)
+    alphabet = np.unique(data)
+    if len(alphabet) == 0:
+        return struct.pack("<IB", 0, 0)
+    header = struct.pack("<IB", len(data), len(alphabet) - 1) + alphabet.tobytes()
+    bits = bits_needed(len(alphabet))
+    if bits == 0:
+        return header
+    indexes = np.searchsorted(alphabet, data)
+    return header + pack_integers(indexes, bits)
+
+
+def unpack_column(stream: BinaryIO) -> bytes:
+    length, alphabet_size = struct.unpack("<IB", stream.read(5))
+    if length == 0:
+        return b""
+    alphabet_size += 1
+    alphabet = np.frombuffer(stream.read(alphabet_size), dtype=np.uint8)
+    bits = bits_needed(alphabet_size)
+    if bits == 0:
+        return alphabet.tobytes() * length
+    indexes = unpack_integers(stream.read(packed_length(length, bits)), length, bits)
+    return alphabet[indexes.astype(np.intp)].tobytes()
+
+
+def pack_columns(columns: List[bytes]) -> bytes:
+    return b"".join(pack_column(column) for column in columns)
+
+
+def unpack_columns(stream: BinaryIO, number_of_columns: int) -> List[bytes]:
+    return [unpack_column(stream) for _ in range(number_of_columns)]
+
+
+def pack_stripes(strings: bytes, width: int) -> bytes:
+    """
+    Bit-pack a concatenation of strings that are all width long, storing
+    every character position as its own column.
+    """
+    matrix = np.frombuffer(strings, dtype=np.uint8).reshape(-1, width)
+    return pack_columns([column.tobytes() for column in matrix.T])
+
+
+def unpack_stripes(stream: BinaryIO, width: int) -> bytes:
+    columns = unpack_columns(stream, width)
+    matrix = np.frombuffer(b"".join(columns), dtype=np.uint8).reshape(width, -1)
+    return matrix.T.tobytes()
+
+
+def typecode_for_range(number_min: int, number_max: int) -> str:
+    """Smallest array typecode that holds all numbers from number_min to number_max."""
+    if number_min >= 0:
+        if number_max > UINT64_MAX:
+            raise NotImplementedError("Numbers to big")
+        elif number_max > UINT32_MAX:
+            return "Q"
+        elif number_max > UINT16_MAX:
+            return "I"
+        elif number_max > UINT8_MAX:
+            return "H"
+        return "B"
+    if number_min < INT64_MIN or number_max > INT64_MAX:
+        raise NotImplementedError("Numbers to big")
+    elif number_min < INT32_MIN or number_max > INT32_MAX:
+        return "q"
+    elif number_min < INT16_MIN or number_max > INT16_MAX:
+        return "i"
+    elif number_min < INT8_MIN or number_max > INT8_MAX:
+        return "h"
+    return "b"
+
+
+def numbers_to_array(numbers: Sequence[int]) -> array.ArrayType:
+    return array.array(typecode_for_range(min(numbers), max(numbers)), numbers)
+
+
+def array_type_to_itemsize(array_type: str) -> int:
+    return {"B": 1, "H": 2, "I": 4, "Q": 8}[array_type.upper()]
@@ -5,8 +5,12 @@ Script to sort and unsort a file using the sort indexes.
 """
 import argparse
 import array
+import io
 import operator
 import itertools
+import struct
+
+from permutation_codec import decode_permutation, encode_permutation
 
 
 def block_iterator(file):
@@ -21,7 +25,7 @@ def block_iterator(file):
 
 
 
-def sort_file(file, output, index_output):
+def sort_file(file, output, index_output, compact=False):
     with open(output, "wb") as out:
         with open(index_output, "wb") as index_out:
             for block in block_iterator(file):
@@ -29,17 +33,26 @@ def sort_file(file, output, index_output):
                 indexes_and_lines.sort(key=operator.itemgetter(1))
                 indexes = array.array("B", (index for index, line in
                                             indexes_and_lines))
-                index_out.write(indexes.tobytes())
+                if compact:
+                    encoded = encode_permutation(indexes)
+                    index_out.write(struct.pack("<H", len(encoded)))
+                    index_out.write(encoded)
+                else:
+                    index_out.write(indexes.tobytes())
                 for index, line in indexes_and_lines:
                     out.write(line)
 
 
-def unsort_file(input, input_indexes, output):
+def unsort_file(input, input_indexes, output, compact=False):
     with open(output, "wb") as out:
         with open(input_indexes, "rb") as idxf:
             for lines in block_iterator(input):
-                indexes = array.array("B")
-                indexes.frombytes(idxf.read(256))
+                if compact:
+                    encoded_length, = struct.unpack("<H", idxf.read(2))
+                    indexes = decode_permutation(io.BytesIO(idxf.read(encoded_length)))
+                else:
+                    indexes = array.array("B")
+                    indexes.frombytes(idxf.read(256))
                 indexes_and_lines = list(zip(indexes, lines))
                 indexes_and_lines.sort(key=operator.itemgetter(0))
                 for index, line in indexes_and_lines:
@@ -53,19 +66,21 @@ def main():
     sort_parser.add_argument("input")
     sort_parser.add_argument("-o", "--output")
     sort_parser.add_argument("-i", "--indexes-output")
+    sort_parser.add_argument("-c", "--compact-indexes", action="store_true")
     unsort_parser = subparsers.add_parser("unsort")
     unsort_parser.add_argument("input")
     unsort_parser.add_argument("indexes")
     unsort_parser.add_argument("-o", "--output", default="/dev/stdout")
+    unsort_parser.add_argument("-c", "--compact-indexes", action="store_true")
     args = parser.parse_args()
     if hasattr(args, "indexes"):
-        unsort_file(args.input, args.indexes, args.output)
+        unsort_file(args.input, args.indexes, args.output, args.compact_indexes)
         return
     if args.output is None:
         args.output = args.input + ".sorted"
     if args.indexes_output is None:
         args.indexes_output = args.output + ".indexes"
-    sort_file(args.input, args.output, args.indexes_output)
+    sort_file(args.input, args.output, args.indexes_output, args.compact_indexes)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,130 @@
+"""
+Block container file format with an index for random access.
+
+Layout::
+
+    header:  magic "FQZC", version (B), number of streams per block (B)
+    blocks:  number of records (I), then for each stream its size (I) and
+             CRC32 (I), followed by the stream data
+    index:   for each block its file offset (Q), first record (Q) and
+             number of records (I)
+    trailer: index offset (Q), number of blocks (I), magic "FQZI"
+
+All integers are little endian. The trailer has a fixed size, so a reader
+can find the index from the end of the file and decompress only the blocks
+that cover the records it needs.
+"""
+
+import bisect
+import struct
+import zlib
+from typing import BinaryIO, Iterator, List, NamedTuple, Tuple
+
+MAGIC = b"FQZC"
+INDEX_MAGIC = b"FQZI"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBB")
+STREAM_HEADER = struct.Struct("<II")
+INDEX_ENTRY = struct.Struct("<QQI")
+TRAILER = struct.Struct("<QI4s")
+
+
+class IndexEntry(NamedTuple):
+    offset: int
+    first_record: int
+    number_of_records: int
+
+
+class ContainerWriter:
+    def __init__(self, fileobj: BinaryIO, number_of_streams: int):
+        self.fileobj = fileobj
+        self.number_of_streams = number_of_streams
+        self.index: List[IndexEntry] = []
+        self.number_of_records = 0
+        self.offset = HEADER.size
+        fileobj.write(HEADER.pack(MAGIC, VERSION, number_of_streams))
+
+    def write_block(self, number_of_records: int, streams: List[bytes]):
+        if len(streams) != self.number_of_streams:
+            raise ValueError(f"Expected {self.number_of_streams} streams, "
+                             f"got {len(streams)}")
+        header = [struct.pack("<I", number_of_records)]
+        for stream in streams:
+            header.append(STREAM_HEADER.pack(len(stream), zlib.crc32(stream)))
+        block = b"".join(header + streams)
+        self.fileobj.write(block)
+        self.index.append(IndexEntry(self.offset, self.number_of_records,
+                                     number_of_records))
+        self.offset += len(block)
+        self.number_of_records += number_of_records
+
+    def close(self):
+        for entry in self.index:
+            self.fileobj.write(INDEX_ENTRY.pack(*entry))
+        self.fileobj.write(TRAILER.pack(self.offset, len(self.index), INDEX_MAGIC))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+class ContainerReader:
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        magic, version, self.number_of_streams = HEADER.unpack(
+            fileobj.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"Not a container file: {magic}")
+        if version != VERSION:
+            raise ValueError(f"Unsupported container version: {version}")
+        fileobj.seek(-TRAILER.size, 2)
+        index_offset, number_of_blocks, index_magic = TRAILER.unpack(
+            fileobj.read(TRAILER.size))
+        if index_magic != INDEX_MAGIC:
+            raise ValueError("Container index is missing. Truncated file?")
+        fileobj.seek(index_offset)
+        index_data = fileobj.read(number_of_blocks * INDEX_ENTRY.size)
+        self.index = [IndexEntry(*entry)
+                      for entry in INDEX_ENTRY.iter_unpack(index_data)]
+        self.first_records = [entry.first_record for entry in self.index]
+
+    @property
+    def number_of_records(self) -> int:
+        if not self.index:
+            return 0
+        last = self.index[-1]
+        return last.first_record + last.number_of_records
+
+    def read_block(self, block_number: int) -> Tuple[IndexEntry, List[bytes]]:
+        entry = self.index[block_number]
+        self.fileobj.seek(entry.offset)
+        number_of_records, = struct.unpack("<I", self.fileobj.read(4))
+        if number_of_records != entry.number_of_records:
+            raise ValueError(f"Block {block_number} has {number_of_records} "
+                             f"records, the index says {entry.number_of_records}")
+        stream_headers = [STREAM_HEADER.unpack(self.fileobj.read(STREAM_HEADER.size))
+                          for _ in range(self.number_of_streams)]
+        streams = []
+        for stream_number, (size, crc) in enumerate(stream_headers):
+            stream = self.fileobj.read(size)
+            if zlib.crc32(stream) != crc:
+                raise ValueError(f"Checksum mismatch in block {block_number}, "
+                                 f"stream {stream_number}")
+            streams.append(stream)
+        return entry, streams
+
+    def blocks_for_records(self, start: int, stop: int) -> range:
+        """Numbers of the blocks that hold records start up to stop."""
+        if start >= stop:
+            return range(0)
+        first = bisect.bisect_right(self.first_records, start) - 1
+        last = bisect.bisect_left(self.first_records, stop)
+        return range(max(first, 0), last)
+
+    def blocks(self) -> Iterator[Tuple[IndexEntry, List[bytes]]]:
+        for block_number in range(len(self.index)):
+            yield self.read_block(block_number)
@@ -1,47 +1,70 @@
-#include <stdlib.h>
-#include <stdio.h>
-#include <unistd.h>
-#include <errno.h>
+/*
+ * Range encoding of phred scores as described in the README.
+ *
+ * Stretches where all phreds are within 15 of the stretch minimum are
+ * encoded as a header byte with the most significant bit set and the
+ * minimum in the lower bits, a byte with the stretch length - 1 and the
+ * 4-bit offsets from the minimum, two per byte. Stretches shorter than 6
+ * do not benefit and are stored verbatim. Since phreds are ASCII, verbatim
+ * bytes never have the most significant bit set.
+ *
+ * Build with: python setup.py build_ext --inplace
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
 #include <stdint.h>
-#include<string.h>
+#include <string.h>
 
 #define ENCODED_BIT 0x80
+#define MAX_DIFF 15
+#define MIN_STRETCH_LENGTH 6
+#define MAX_CHUNK_LENGTH 256
 
-static size_t encode_stretch_inner(const uint8_t *data, uint8_t *out, uint8_t length, uint8_t min) {
-    if (length < 6) {
-        memcpy(out, data, length);
-    }
+static size_t
+encode_chunk(const uint8_t *data, uint8_t *out, size_t length, uint8_t min)
+{
     out[0] = ENCODED_BIT | min;
-    out[1] = length;
-    const uint8_t *data_ptr = data;
+    out[1] = (uint8_t)(length - 1);
     uint8_t *out_ptr = out + 2;
+    const uint8_t *data_ptr = data;
     while (length > 1) {
         out_ptr[0] = ((data_ptr[0] - min) << 4) | (data_ptr[1] - min);
         out_ptr += 1;
         data_ptr += 2;
-        length -= 2; 
+        length -= 2;
     }
     if (length) {
-        out_ptr[0] = (data_ptr[0] - min) << 4; 
+        out_ptr[0] = (data_ptr[0] - min) << 4;
         out_ptr += 1;
     }
     return out_ptr - out;
 }
 
-static size_t encode_stretch(const uint8_t *data, uint8_t *out, size_t length, uint8_t min) {
+static size_t
+encode_stretch(const uint8_t *data, uint8_t *out, size_t length, uint8_t min)
+{
+    if (length < MIN_STRETCH_LENGTH) {
+        memcpy(out, data, length);
+        return length;
+    }
     uint8_t *out_ptr = out;
     while (length > 0) {
-        size_t stretch_length = length;
-        if (stretch_length > UINT8_MAX) {
-            stretch_length = UINT8_MAX;
+        size_t chunk_length = length;
+        if (chunk_length > MAX_CHUNK_LENGTH) {
+            chunk_length = MAX_CHUNK_LENGTH;
         }
-        out_ptr += encode_stretch_inner(data, out_ptr, stretch_length, min);
-        length -= stretch_length;
+        out_ptr += encode_chunk(data, out_ptr, chunk_length, min);
+        data += chunk_length;
+        length -= chunk_length;
     }
     return out_ptr - out;
 }
 
-static size_t encode(const uint8_t *data, uint8_t *out, size_t data_length) {
+/* Returns the encoded size, or -1 when a byte has the most significant bit set. */
+static Py_ssize_t
+encode(const uint8_t *data, uint8_t *out, size_t data_length)
+{
     if (data_length == 0) {
         return 0;
     }
@@ -49,50 +72,169 @@ static size_t encode(const uint8_t *data, uint8_t *out, size_t data_length) {
     uint8_t minimum = data[0];
     uint8_t maximum = data[0];
     size_t range_start = 0;
-    size_t i = 0;
-    for (; i < data_length; i++) {
+    for (size_t i = 0; i < data_length; i++) {
         uint8_t c = data[i];
-        if (c < minimum) {
-            minimum = c;
-        }
-        if (c > maximum) {
-            maximum = c;
+        if (c & ENCODED_BIT) {
+            return -1;
         }
-        if ((minimum + 15) < maximum) {
-            out_ptr += encode_stretch(data + range_start, out_ptr, i - range_start, minimum);
+        uint8_t new_minimum = c < minimum ? c : minimum;
+        uint8_t new_maximum = c > maximum ? c : maximum;
+        if ((new_minimum + MAX_DIFF) < new_maximum) {
+            /* c does not fit, encode the stretch before it with the old minimum. */
+            out_ptr += encode_stretch(data + range_start, out_ptr,
+                                      i - range_start, minimum);
             range_start = i;
-            minimum = c; 
-            maximum = c;
+            new_minimum = c;
+            new_maximum = c;
         }
+        minimum = new_minimum;
+        maximum = new_maximum;
     }
-    out_ptr += encode_stretch(data + range_start, out_ptr, data_length - range_start, minimum);
+    out_ptr += encode_stretch(data + range_start, out_ptr,
+                              data_length - range_start, minimum);
     return out_ptr - out;
 }
-    
 
-int main (int argc, char *argv[]) {
-    if (argc != 2) {
-        fprintf(stderr, "Error: accepts only one argument\n");
-        exit(1);
-    }
-    FILE *file = fopen(argv[1], "r");
-    if (file == NULL) {
-        exit(errno);
-    }
-    char *line_buffer = NULL;
-    size_t line_buffer_size = 0;
-    uint8_t *out_buffer = NULL;
-    while(1) {
-        ssize_t line_length = getline(&line_buffer, &line_buffer_size, file);
-        out_buffer = realloc(out_buffer, line_length);
-        if (line_length == -1) {
-            break;
+/* Returns the decoded size, or -1 when the data is truncated. */
+static Py_ssize_t
+decoded_size(const uint8_t *data, size_t data_length)
+{
+    size_t i = 0;
+    size_t size = 0;
+    while (i < data_length) {
+        if (data[i] & ENCODED_BIT) {
+            if (i + 1 >= data_length) {
+                return -1;
+            }
+            size_t length = (size_t)data[i + 1] + 1;
+            i += 2 + (length + 1) / 2;
+            size += length;
+        } else {
+            i += 1;
+            size += 1;
         }
-        size_t encoded_size = encode((uint8_t *)line_buffer, out_buffer, line_length - 1);
-        fwrite(out_buffer, 1, encoded_size, stdout);
-    }
-    free(out_buffer);
-    free(line_buffer);
-    fclose(file);
-    return 0;
-}
\ No newline at end of file
+    }
+    if (i != data_length) {
+        return -1;
+    }
+    return size;
+}
+
+static void
+decode(const uint8_t *data, uint8_t *out, size_t data_length)
+{
+    const uint8_t *end = data + data_length;
+    while (data < end) {
+        uint8_t c = data[0];
+        if (!(c & ENCODED_BIT)) {
+            *out++ = c;
+            data += 1;
+            continue;
+        }
+        uint8_t min = c & ~ENCODED_BIT;
+        size_t length = (size_t)data[1] + 1;
+        data += 2;
+        while (length > 1) {
+            out[0] = min + (data[0] >> 4);
+            out[1] = min + (data[0] & 0x0F);
+            out += 2;
+            data += 1;
+            length -= 2;
+        }
+        if (length) {
+            *out++ = min + (data[0] >> 4);
+            data += 1;
+        }
+    }
+}
+
+PyDoc_STRVAR(encode_ranges__doc__,
+"encode_ranges($module, data, /)\n"
+"--\n"
+"\n"
+"Range encode ASCII phred scores.\n");
+
+static PyObject *
+encode_ranges(PyObject *module, PyObject *arg)
+{
+    Py_buffer buffer;
+    if (PyObject_GetBuffer(arg, &buffer, PyBUF_SIMPLE) < 0) {
+        return NULL;
+    }
+    /* Encoded stretches are never longer than the data they replace. */
+    PyObject *out = PyBytes_FromStringAndSize(NULL, buffer.len);
+    if (out == NULL) {
+        PyBuffer_Release(&buffer);
+        return NULL;
+    }
+    Py_ssize_t encoded_size;
+    Py_BEGIN_ALLOW_THREADS
+    encoded_size = encode(buffer.buf, (uint8_t *)PyBytes_AS_STRING(out),
+                          buffer.len);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&buffer);
+    if (encoded_size < 0) {
+        Py_DECREF(out);
+        PyErr_SetString(PyExc_ValueError,
+                        "Data contains bytes that are not ASCII");
+        return NULL;
+    }
+    if (_PyBytes_Resize(&out, encoded_size) < 0) {
+        return NULL;
+    }
+    return out;
+}
+
+PyDoc_STRVAR(decode_ranges__doc__,
+"decode_ranges($module, data, /)\n"
+"--\n"
+"\n"
+"Decode data created with encode_ranges.\n");
+
+static PyObject *
+decode_ranges(PyObject *module, PyObject *arg)
+{
+    Py_buffer buffer;
+    if (PyObject_GetBuffer(arg, &buffer, PyBUF_SIMPLE) < 0) {
+        return NULL;
+    }
+    Py_ssize_t size;
+    Py_BEGIN_ALLOW_THREADS
+    size = decoded_size(buffer.buf, buffer.len);
+    Py_END_ALLOW_THREADS
+    if (size < 0) {
+        PyBuffer_Release(&buffer);
+        PyErr_SetString(PyExc_ValueError, "Truncated range encoded data");
+        return NULL;
+    }
+    PyObject *out = PyBytes_FromStringAndSize(NULL, size);
+    if (out == NULL) {
+        PyBuffer_Release(&buffer);
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    decode(buffer.buf, (uint8_t *)PyBytes_AS_STRING(out), buffer.len);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&buffer);
+    return out;
+}
+
+static PyMethodDef diffcompress_methods[] = {
+    {"encode_ranges", encode_ranges, METH_O, encode_ranges__doc__},
+    {"decode_ranges", decode_ranges, METH_O, decode_ranges__doc__},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef diffcompress_module = {
+    PyModuleDef_HEAD_INIT,
+    "diffcompress",
+    "Range encoding of phred scores.",
+    -1,
+    diffcompress_methods,
+};
+
+PyMODINIT_FUNC
+PyInit_diffcompress(void)
+{
+    return PyModule_Create(&diffcompress_module);
+}
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+"""
+Entropy coding backends for transformed columns.
+
+Each backend is registered under a one byte identifier. compress_column
+tries all backends on a column and stores the identifier of the smallest
+result in the column header, so decompress_column can dispatch on it.
+
+Next to the generic compressors, static order-0 and order-1 rANS coders
+are implemented here. These follow rans_byte.h by Fabian Giesen: 12-bit
+frequencies, a 32-bit state and byte-wise renormalization.
+"""
+
+import argparse
+import bz2
+import io
+import lzma
+import struct
+import zlib
+from typing import BinaryIO, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+RANS_PROB_BITS = 12
+RANS_PROB_SCALE = 1 << RANS_PROB_BITS
+RANS_L = 1 << 23
+
+
+def normalize_frequencies(counts: List[int]) -> List[int]:
+    total = sum(counts)
+    frequencies = [max(1, count * RANS_PROB_SCALE // total) if count else 0
+                   for count in counts]
+    difference = RANS_PROB_SCALE - sum(frequencies)
+    most_common = max(range(256), key=frequencies.__getitem__)
+    if difference >= 0 or frequencies[most_common] + difference > 0:
+        frequencies[most_common] += difference
+        return frequencies
+    # Many rare symbols got rounded up to 1. Take the excess from the most
+    # frequent symbols.
+    while difference < 0:
+        most_common = max(range(256), key=frequencies.__getitem__)
+        frequencies[most_common] -= 1
+        difference += 1
+    return frequencies
+
+
+def write_frequencies(stream: BinaryIO, frequencies: List[int]):
+    symbols = [symbol for symbol, freq in enumerate(frequencies) if freq]
+    # 256 symbols do not fit in a byte, store the count minus one.
+    stream.write(struct.pack("B", len(symbols) - 1))
+    for symbol in symbols:
+        stream.write(struct.pack("<BH", symbol, frequencies[symbol]))
+
+
+def cumulative_frequencies(frequencies: List[int]) -> List[int]:
+    cumulative = [0] * 256
+    total = 0
+    for symbol, freq in enumerate(frequencies):
+        cumulative[symbol] = total
+        total += freq
+    return cumulative
+
+
+def read_frequencies(stream: BinaryIO) -> Tuple[List[int], List[int], bytes]:
+    number_of_symbols = struct.unpack("B", stream.read(1))[0] + 1
+    frequencies = [0] * 256
+    for _ in range(number_of_symbols):
+        symbol, freq = struct.unpack("<BH", stream.read(3))
+        frequencies[symbol] = freq
+    cumulative = cumulative_frequencies(frequencies)
+    slot_to_symbol = b"".join(bytes([symbol]) * freq
+                              for symbol, freq in enumerate(frequencies))
+    return frequencies, cumulative, slot_to_symbol
+
+
+def rans_encode(data: bytes, contexts: Iterable[int],
+                frequencies: Dict[int, List[int]]) -> bytes:
+    """
+    Encode data in reverse with the frequency table that belongs to the
+    context of each symbol. Returns the encoded bytes in decoding order.
+    """
+    cumulatives = {context: cumulative_frequencies(freqs)
+                   for context, freqs in frequencies.items()}
+    out = bytearray()
+    state = RANS_L
+    for symbol, context in zip(reversed(data), reversed(list(contexts))):
+        freq = frequencies[context][symbol]
+        state_max = ((RANS_L >> RANS_PROB_BITS) << 8) * freq
+        while state >= state_max:
+            out.append(state & 0xFF)
+            state >>= 8
+        state = ((state // freq) << RANS_PROB_BITS) + (state % freq) + \
+            cumulatives[context][symbol]
+    out.extend(state.to_bytes(4, "little"))
+    out.reverse()
+    return bytes(out)
+
+
+def rans0_compress(data: bytes) -> bytes:
+    stream = io.BytesIO()
+    stream.write(struct.pack("<I", len(data)))
+    if not data:
+        return stream.getvalue()
+    counts = [0] * 256
+    for symbol in data:
+        counts[symbol] += 1
+    frequencies = normalize_frequencies(counts)
+    write_frequencies(stream, frequencies)
+    stream.write(rans_encode(data, bytes(len(data)), {0: frequencies}))
+    return stream.getvalue()
+
+
+def rans0_decompress(data: bytes) -> bytes:
+    stream = io.BytesIO(data)
+    length, = struct.unpack("<I", stream.read(4))
+    if not length:
+        return b""
+    frequencies, cumulative, slot_to_symbol = read_frequencies(stream)
+    encoded = stream.read()
+    state = int.from_bytes(encoded[:4], "big")
+    position = 4
+    out = bytearray(length)
+    mask = RANS_PROB_SCALE - 1
+    for i in range(length):
+        slot = state & mask
+        symbol = slot_to_symbol[slot]
+        out[i] = symbol
+        state = frequencies[symbol] * (state >> RANS_PROB_BITS) + slot - cumulative[symbol]
+        while state < RANS_L:
+            state = (state << 8) | encoded[position]
+            position += 1
+    return bytes(out)
+
+
+def rans1_compress(data: bytes) -> bytes:
+    """Order-1 rANS: the previous byte selects the frequency table."""
+    stream = io.BytesIO()
+    stream.write(struct.pack("<I", len(data)))
+    if not data:
+        return stream.getvalue()
+    contexts = b"\x00" + data[:-1]
+    counts = {}
+    for context, symbol in zip(contexts, data):
+        context_counts = counts.get(context)
+        if context_counts is None:
+            context_counts = counts[context] = [0] * 256
+        context_counts[symbol] += 1
+    frequencies = {context: normalize_frequencies(context_counts)
+                   for context, context_counts in counts.items()}
+    stream.write(struct.pack("B", len(frequencies) - 1))
+    for context in sorted(frequencies):
+        stream.write(struct.pack("B", context))
+        write_frequencies(stream, frequencies[context])
+    stream.write(rans_encode(data, contexts, frequencies))
+    return stream.getvalue()
+
+
+def rans1_decompress(data: bytes) -> bytes:
+    stream = io.BytesIO(data)
+    length, = struct.unpack("<I", stream.read(4))
+    if not length:
+        return b""
+    number_of_contexts = struct.unpack("B", stream.read(1))[0] + 1
+    tables: List[Optional[Tuple[List[int], List[int], bytes]]] = [None] * 256
+    for _ in range(number_of_contexts):
+        context, = struct.unpack("B", stream.read(1))
+        tables[context] = read_frequencies(stream)
+    encoded = stream.read()
+    state = int.from_bytes(encoded[:4], "big")
+    position = 4
+    out = bytearray(length)
+    mask = RANS_PROB_SCALE - 1
+    symbol = 0
+    for i in range(length):
+        frequencies, cumulative, slot_to_symbol = tables[symbol]
+        slot = state & mask
+        symbol = slot_to_symbol[slot]
+        out[i] = symbol
+        state = frequencies[symbol] * (state >> RANS_PROB_BITS) + slot - cumulative[symbol]
+        while state < RANS_L:
+            state = (state << 8) | encoded[position]
+            position += 1
+    return bytes(out)
+
+
+def raw_compress(data: bytes) -> bytes:
+    return bytes(data)
+
+
+class Backend(NamedTuple):
+    name: str
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+RAW = 0
+ZLIB = 1
+BZIP2 = 2
+LZMA = 3
+RANS0 = 4
+RANS1 = 5
+
+# The raw format has no headers which saves a few dozen bytes on small
+# columns. Instead the dictionary size is stored in a single byte as a
+# power of two just large enough for the column: the 64 MiB dictionary of
+# preset 9 takes longer to set up than most columns take to compress.
+LZMA_PRESET = 9
+LZMA_MIN_DICT_BITS = 12
+LZMA_MAX_DICT_BITS = 26
+# The pure Python rANS coders are only tried on columns up to this size.
+RANS_MAX_LENGTH = 1 << 16
+
+
+def lzma_filters(dict_bits: int) -> List[Dict[str, int]]:
+    return [{"id": lzma.FILTER_LZMA2, "preset": LZMA_PRESET,
+             "dict_size": 1 << dict_bits}]
+
+
+def lzma_compress(data: bytes) -> bytes:
+    dict_bits = min(max((len(data) - 1).bit_length(), LZMA_MIN_DICT_BITS),
+                    LZMA_MAX_DICT_BITS)
+    return struct.pack("B", dict_bits) + lzma.compress(
+        data, lzma.FORMAT_RAW, filters=lzma_filters(dict_bits))
+
+
+def lzma_decompress(data: bytes) -> bytes:
+    if not LZMA_MIN_DICT_BITS <= data[0] <= LZMA_MAX_DICT_BITS:
+        raise ValueError(f"Invalid LZMA dictionary size: 2^{data[0]}")
+    return lzma.decompress(data[1:], lzma.FORMAT_RAW, filters=lzma_filters(data[0]))
+
+
+BACKENDS: Dict[int, Backend] = {
+    RAW: Backend("raw", raw_compress, raw_compress),
+    ZLIB: Backend("zlib", lambda data: zlib.compress(data, 9), zlib.decompress),
+    BZIP2: Backend("bzip2", bz2.compress, bz2.decompress),
+    LZMA: Backend("lzma", lzma_compress, lzma_decompress),
+    RANS0: Backend("rans0", rans0_compress, rans0_decompress),
+    RANS1: Backend("rans1", rans1_compress, rans1_decompress),
+}
+# Pure Python rANS is too slow for the megabytes of sequences and qualities
+# in a block.
+BULK_BACKENDS = (RAW, ZLIB, BZIP2, LZMA)
+BACKEND_IDS = {backend.name: backend_id for backend_id, backend in BACKENDS.items()}
+
+
+def backend_allowed(backend_id: int, length: int) -> bool:
+    """Whether backend_id should be tried on length bytes."""
+    return backend_id not in (RANS0, RANS1) or length <= RANS_MAX_LENGTH
+
+
+def compress_column(data: bytes, backend_ids: Optional[Iterable[int]] = None) -> bytes:
+    """
+    Compress data with every backend in backend_ids (default: all) and
+    return the smallest result prefixed with a header that records the
+    backend and the compressed size. rANS is skipped for columns longer
+    than RANS_MAX_LENGTH.
+    """
+    if backend_ids is None:
+        backend_ids = BACKENDS.keys()
+    backend_ids = [backend_id for backend_id in backend_ids
+                   if backend_allowed(backend_id, len(data))] or [RAW]
+    best_id, best = min(
+        ((backend_id, BACKENDS[backend_id].compress(data))
+         for backend_id in backend_ids),
+        key=lambda item: len(item[1]))
+    return struct.pack("<BI", best_id, len(best)) + best
+
+
+def decompress_column(stream: BinaryIO) -> bytes:
+    backend_id, length = struct.unpack("<BI", stream.read(5))
+    try:
+        backend = BACKENDS[backend_id]
+    except KeyError:
+        raise ValueError(f"Unknown backend: {backend_id}")
+    return backend.decompress(stream.read(length))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="File to compress with each backend.")
+    args = parser.parse_args()
+    with open(args.input, "rb") as f:
+        data = f.read()
+    print(f"original\t{len(data)}")
+    for backend in BACKENDS.values():
+        compressed = backend.compress(data)
+        assert backend.decompress(compressed) == data
+        print(f"{backend.name}\t\t{len(compressed)}")
+
+
+if __name__ == "__main__":
+    main()
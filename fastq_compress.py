@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+"""
+Compress a FASTQ file into a block structured container.
+
+Records are read in blocks. Each block is split into a name, a sequence
+and a quality stream and every stream is encoded by its own codec. A
+reader thread, a pool of encoder processes and an ordered writer are
+connected by bounded queues, so the FASTQ is read and parsed only once and
+memory use does not depend on the file size.
+"""
+
+import argparse
+import collections
+import contextlib
+import functools
+import io
+import queue
+import struct
+import threading
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
+
+import dnaio
+import numpy as np
+
+from entropy_backends import BULK_BACKENDS, compress_column, decompress_column
+import auto_pipeline
+import instrumentation
+import punctuation_tokenizer
+import quality_binning
+import sequence_codec
+from container import ContainerReader, ContainerWriter
+from parallel import process_pool
+from quality_block import lengths_from_stream, lengths_to_bytes
+
+NAMES_TOKENIZED = 0
+NAMES_GENERIC = 1
+NAMES_AUTO = 2
+
+RecordBlock = Tuple[List[str], List[str], List[str]]
+
+
+def encode_names(names: List[str]) -> bytes:
+    try:
+        return struct.pack("B", NAMES_TOKENIZED) + punctuation_tokenizer.compress(names)
+    except (ValueError, NotImplementedError):
+        # For instance zero prefixed numbers with different lengths.
+        data = "\n".join(names).encode("latin-1")
+        return struct.pack("B", NAMES_GENERIC) + compress_column(data)
+
+
+def encode_names_auto(names: List[str]) -> bytes:
+    """Try the name pipelines on each block and use the smallest."""
+    return struct.pack("B", NAMES_AUTO) + auto_pipeline.compress(names)
+
+
+def decode_names(data: bytes) -> List[str]:
+    if data[0] == NAMES_TOKENIZED:
+        return list(punctuation_tokenizer.decompress(data[1:]))
+    if data[0] == NAMES_AUTO:
+        return auto_pipeline.decompress(data[1:])
+    names = decompress_column(io.BytesIO(data[1:])).decode("latin-1")
+    return names.split("\n")
+
+
+def encode_strings(strings: List[str]) -> bytes:
+    """Store the lengths and the concatenation of all strings."""
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    data = "".join(strings).encode("ascii")
+    return lengths_to_bytes(lengths) + compress_column(data, BULK_BACKENDS)
+
+
+def decode_strings(data: bytes) -> List[str]:
+    stream = io.BytesIO(data)
+    lengths = lengths_from_stream(stream)
+    concatenated = decompress_column(stream).decode("ascii")
+    ends = np.cumsum(lengths).tolist()
+    starts = [0] + ends[:-1]
+    return [concatenated[start:end] for start, end in zip(starts, ends)]
+
+
+encode_sequences = sequence_codec.compress
+decode_sequences = sequence_codec.decompress
+encode_qualities = encode_strings
+decode_qualities = decode_strings
+
+
+def encode_binned_qualities(table: bytes, qualities: List[str]) -> bytes:
+    """Bin the qualities before storing them. Decoding is unchanged."""
+    return encode_qualities(quality_binning.bin_qualities(qualities, table))
+
+
+STREAM_NAMES = ["names", "sequences", "qualities"]
+STREAM_ENCODERS: List[Callable[[List[str]], bytes]] = [
+    encode_names, encode_sequences, encode_qualities]
+STREAM_DECODERS: List[Callable[[bytes], List[str]]] = [
+    decode_names, decode_sequences, decode_qualities]
+
+
+def open_threads_for(threads: int) -> int:
+    """Threads for dnaio to (de)compress gzip in a separate process, if any."""
+    return threads if threads > 1 else 0
+
+
+def read_record_blocks(path: str, block_size: int,
+                       open_threads: int = 0) -> Iterator[RecordBlock]:
+    with dnaio.open(path, open_threads=open_threads) as records:
+        names: List[str] = []
+        sequences: List[str] = []
+        qualities: List[str] = []
+        for record in records:
+            names.append(record.name)
+            sequences.append(record.sequence)
+            qualities.append(record.qualities)
+            if len(names) == block_size:
+                yield names, sequences, qualities
+                names, sequences, qualities = [], [], []
+        if names:
+            yield names, sequences, qualities
+
+
+def fill_queue(blocks: Iterator, block_queue: queue.Queue):
+    """Put all blocks on the queue, followed by None or the raised exception."""
+    try:
+        for block in blocks:
+            block_queue.put(block)
+    except BaseException as error:
+        block_queue.put(error)
+        return
+    block_queue.put(None)
+
+
+def queued(blocks: Iterator, max_queued: int) -> Iterator:
+    """Iterate over blocks that are read in a separate thread."""
+    block_queue: queue.Queue = queue.Queue(max_queued)
+    reader = threading.Thread(target=fill_queue, args=(blocks, block_queue),
+                              daemon=True)
+    reader.start()
+    while True:
+        block = block_queue.get()
+        if block is None:
+            break
+        if isinstance(block, BaseException):
+            raise block
+        yield block
+    reader.join()
+
+
+def compress_fastq(input: str, out: BinaryIO, block_size: int = 10_000,
+                   threads: int = 1, max_pending: Optional[int] = None,
+                   auto_names: bool = False,
+                   quality_table: Optional[bytes] = None,
+                   reporter: Optional[instrumentation.Reporter] = None):
+    if max_pending is None:
+        max_pending = max(2, threads * 2)
+    encoders = list(STREAM_ENCODERS)
+    if auto_names:
+        encoders[0] = encode_names_auto
+    if quality_table is not None:
+        encoders[2] = functools.partial(encode_binned_qualities, quality_table)
+    if reporter is not None:
+        encoders = [functools.partial(instrumentation.collect, encode,
+                                      stage_name=stream_name)
+                    for encode, stream_name in zip(encoders, STREAM_NAMES)]
+    blocks = queued(read_record_blocks(input, block_size, open_threads_for(threads)),
+                    max_pending)
+    pending = collections.deque()
+
+    def write_block(block_number, number_of_records, futures):
+        streams = [f.result() for f in futures]
+        if reporter is not None:
+            reporter.write_block(block_number, [
+                record for _, records in streams for record in records])
+            streams = [data for data, _ in streams]
+        container.write_block(number_of_records, streams)
+
+    with ContainerWriter(out, len(STREAM_ENCODERS)) as container, \
+            process_pool(threads) as executor:
+        for block_number, block in enumerate(blocks):
+            if len(pending) >= max_pending:
+                write_block(*pending.popleft())
+            futures = [executor.submit(encode, stream)
+                       for encode, stream in zip(encoders, block)]
+            pending.append((block_number, len(block[0]), futures))
+        while pending:
+            write_block(*pending.popleft())
+
+
+def decompress_fastq(stream: BinaryIO, output: str, threads: int = 1,
+                     start: int = 0, stop: Optional[int] = None,
+                     max_pending: Optional[int] = None):
+    """
+    Write records start up to stop to output. Only the blocks that hold
+    these records are read and decoded.
+    """
+    if max_pending is None:
+        max_pending = max(2, threads * 2)
+    container = ContainerReader(stream)
+    if stop is None:
+        stop = container.number_of_records
+    pending = collections.deque()
+
+    def write_block(first_record, futures):
+        names, sequences, qualities = [f.result() for f in futures]
+        block_start = max(start - first_record, 0)
+        block_stop = min(stop - first_record, len(names))
+        for i in range(block_start, block_stop):
+            writer.write(dnaio.SequenceRecord(names[i], sequences[i], qualities[i]))
+
+    with dnaio.open(output, mode="w", fileformat="fastq",
+                    open_threads=open_threads_for(threads)) as writer:
+        with process_pool(threads) as executor:
+            for block_number in container.blocks_for_records(start, stop):
+                entry, streams = container.read_block(block_number)
+                if len(pending) >= max_pending:
+                    write_block(*pending.popleft())
+                pending.append((entry.first_record,
+                                [executor.submit(decode, data) for decode, data
+                                 in zip(STREAM_DECODERS, streams)]))
+            while pending:
+                write_block(*pending.popleft())
+
+
+def parse_record_range(value: str) -> Tuple[int, Optional[int]]:
+    start, _, stop = value.partition(":")
+    return int(start or 0), int(stop) if stop else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input", help="FASTQ(.gz) file, or compressed file.")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("-d", "--decompress", action="store_true")
+    parser.add_argument("-b", "--block-size", type=int, default=10_000,
+                        help="Number of records per block.")
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="Number of encoder processes.")
+    parser.add_argument("-r", "--records", type=parse_record_range,
+                        default=(0, None),
+                        help="Only decompress records START:STOP (0-based, "
+                             "STOP excluded).")
+    parser.add_argument("-a", "--auto-names", action="store_true",
+                        help="Choose the name pipeline for each block by "
+                             "trying all of them on a sample. Slower.")
+    parser.add_argument("-q", "--quality-binning",
+                        choices=quality_binning.SCHEMES, default="none",
+                        help="Bin the qualities. Lossy, the default keeps "
+                             "them unchanged.")
+    parser.add_argument("--quality-bins", type=quality_binning.parse_bins,
+                        help="Custom quality bins as LOW-HIGH:VALUE,... in "
+                             "phred units. Overrides --quality-binning.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    if args.decompress:
+        start, stop = args.records
+        with open(args.input, "rb") as stream:
+            decompress_fastq(stream, args.output, args.threads, start, stop)
+        return
+    with open(args.output, "wb") as out:
+        bins = args.quality_bins
+        if bins is None:
+            bins = quality_binning.SCHEMES[args.quality_binning]
+        quality_table = quality_binning.binning_table(bins) if bins else None
+        reporter = instrumentation.open_reporter(args.stats, args.stats_format)
+        with reporter or contextlib.nullcontext():
+            compress_fastq(args.input, out, args.block_size, args.threads,
+                           auto_names=args.auto_names,
+                           quality_table=quality_table, reporter=reporter)
+
+
+if __name__ == "__main__":
+    main()
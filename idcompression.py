@@ -2,52 +2,188 @@
 
 import argparse
 import bz2
+import collections
+import functools
 import gzip
+import io
 import lzma
-from typing import Sequence, List
+import struct
+from typing import Dict, List, Sequence, Union
+
+import numpy as np
+
+from bitpacking import pack_columns, unpack_columns
+from mmap_reader import LineBlock, MappedFile
+from parallel import ordered_map
 
 
 class EncodedNames:
     number_of_names: int
-    data: str
+    data: Union[bytes, str]
 
-    def __init__(self, names: Sequence[str]):
+    def __init__(self, names: Sequence[Union[str, bytes]]):
         self.number_of_names = len(names)
         maximum_length = max(len(name) for name in names)
-        padded_names = (name.ljust(maximum_length, "\00") for name in names)
-        concat_data = "".join(padded_names)
-        column_data = "".join(concat_data[i::maximum_length] for i in range(maximum_length))
-        self.data = column_data
+        if isinstance(names[0], bytes):
+            lengths = np.fromiter(map(len, names), dtype=np.intp, count=len(names))
+            self.data = self._transpose(np.frombuffer(b"".join(names), dtype=np.uint8),
+                                        lengths, maximum_length)
+            return
+        try:
+            self.data = self._transpose_ascii(names, maximum_length)
+        except UnicodeEncodeError:
+            # Fall back on slicing strings column by column.
+            padded_names = (name.ljust(maximum_length, "\00") for name in names)
+            concat_data = "".join(padded_names)
+            column_data = "".join(concat_data[i::maximum_length] for i in range(maximum_length))
+            self.data = column_data
+
+    @classmethod
+    def from_line_block(cls, block: LineBlock):
+        """Encode the lines of a LineBlock without decoding them to str."""
+        concat_data = block.concatenated()
+        if concat_data.size and concat_data.max() > 127:
+            return cls(block.to_str_list("utf-8"))
+        lengths = block.lengths()
+        encoded = cls.__new__(cls)
+        encoded.number_of_names = len(block)
+        encoded.data = cls._transpose(concat_data, lengths, int(lengths.max()))
+        return encoded
+
+    @staticmethod
+    def _transpose(concat_data: np.ndarray, lengths: np.ndarray,
+                   maximum_length: int) -> bytes:
+        matrix = np.zeros((len(lengths), maximum_length), dtype=np.uint8)
+        matrix[np.arange(maximum_length) < lengths[:, np.newaxis]] = concat_data
+        return matrix.T.tobytes()
+
+    def _transpose_ascii(self, names: Sequence[str], maximum_length: int) -> bytes:
+        concat_data = np.frombuffer("".join(names).encode("ascii"), dtype=np.uint8)
+        lengths = np.fromiter(map(len, names), dtype=np.intp, count=len(names))
+        return self._transpose(concat_data, lengths, maximum_length)
+
+    def _decode_ascii(self) -> List[str]:
+        number_of_names = self.number_of_names
+        maximum_length = len(self.data) // number_of_names
+        matrix = np.frombuffer(self.data, dtype=np.uint8).reshape(
+            maximum_length, number_of_names).T
+        # Strip the null padding at the end of each name and put a newline
+        # there instead, so all names can be split at once.
+        not_null = matrix[:, ::-1] != 0
+        lengths = np.where(not_null.any(axis=1),
+                           maximum_length - not_null.argmax(axis=1), 0)
+        lines = np.zeros((number_of_names, maximum_length + 1), dtype=np.uint8)
+        lines[:, :maximum_length] = matrix
+        lines[np.arange(number_of_names), lengths] = ord("\n")
+        concat_lines = lines[np.arange(maximum_length + 1) <= lengths[:, np.newaxis]]
+        return concat_lines.tobytes().decode("ascii").split("\n")[:-1]
 
     def decode(self) -> Sequence[str]:
+        if isinstance(self.data, bytes):
+            return self._decode_ascii()
         data = self.data
         number_of_names = self.number_of_names
         padded_names = (data[i::number_of_names] for i in range(number_of_names))
         return [name.rstrip("\00") for name in padded_names]
 
-    def raw_data(self):
-        return self.data.encode('ascii')
+    def raw_data(self) -> bytes:
+        if isinstance(self.data, bytes):
+            return self.data
+        return self.data.encode('utf-8')
+
+    def packed_data(self) -> bytes:
+        """
+        Bit-pack every column to the number of bits its alphabet needs.
+        Unlike raw_data the result can be decoded on its own.
+        """
+        data = self.raw_data()
+        number_of_names = self.number_of_names
+        maximum_length = len(data) // number_of_names
+        columns = [data[i:i + number_of_names]
+                   for i in range(0, len(data), number_of_names)]
+        header = struct.pack("<II", number_of_names, maximum_length)
+        return header + pack_columns(columns)
+
+    @classmethod
+    def from_raw_data(cls, number_of_names: int, data: bytes):
+        encoded = cls.__new__(cls)
+        encoded.number_of_names = number_of_names
+        # Only the str fallback for non-ASCII names writes non-ASCII raw data.
+        encoded.data = data if data.isascii() else data.decode("utf-8")
+        return encoded
+
+    @classmethod
+    def from_packed_data(cls, packed: bytes):
+        stream = io.BytesIO(packed)
+        number_of_names, maximum_length = struct.unpack("<II", stream.read(8))
+        return cls.from_raw_data(
+            number_of_names, b"".join(unpack_columns(stream, maximum_length)))
 
 class EncodedColumns(EncodedNames):
     column_data: List[EncodedNames]
 
-    def __init__(self, names: Sequence[str]):
+    def __init__(self, names: Sequence[Union[str, bytes]]):
         self.number_of_names = len(names)
+        if names and isinstance(names[0], bytes):
+            separator, padding = b":", b"\00"
+        else:
+            separator, padding = ":", "\00"
         column_maxes = []
         for name in names:
-            columns = name.split(":")
+            columns = name.split(separator)
             if len(columns) > len(column_maxes):
                 column_maxes.extend([0 for _ in range(len(columns) - len(column_maxes))])
             for i, column in enumerate(columns):
                 column_maxes[i] = max(len(column), column_maxes[i])
         new_names = []
         for name in names:
-            columns = name.split(":")
+            columns = name.split(separator)
             for i, column in enumerate(columns):
-                columns[i] = column.ljust(column_maxes[i], "\00")
-            new_names.append(":".join(columns))
+                columns[i] = column.ljust(column_maxes[i], padding)
+            new_names.append(separator.join(columns))
         super().__init__(new_names)
 
+    @classmethod
+    def from_line_block(cls, block: LineBlock):
+        """
+        Pad the columns of all lines at once. Every byte is moved to the
+        start of its column plus its offset in the column, and a separator
+        to the end of the padded column it closes.
+        """
+        concat_data = block.concatenated()
+        if concat_data.size and concat_data.max() > 127:
+            return cls(block.to_str_list("utf-8"))
+        lengths = block.lengths()
+        name_starts = np.cumsum(lengths) - lengths
+        name_of_byte = np.repeat(np.arange(len(lengths)), lengths)
+        is_separator = concat_data == ord(":")
+        separators_before = np.concatenate(([0], np.cumsum(is_separator)))
+        column_of_byte = (separators_before[:-1] -
+                          separators_before[name_starts][name_of_byte])
+        is_column_start = np.zeros(len(concat_data), dtype=bool)
+        is_column_start[name_starts[lengths > 0]] = True
+        is_column_start[np.flatnonzero(is_separator[:-1]) + 1] = True
+        positions = np.arange(len(concat_data))
+        offset_in_column = positions - np.maximum.accumulate(
+            np.where(is_column_start, positions, 0))
+        separators_per_name = (separators_before[name_starts + lengths] -
+                               separators_before[name_starts])
+        number_of_columns = int(separators_per_name.max(initial=0)) + 1
+        column_maxes = np.zeros(number_of_columns, dtype=np.intp)
+        np.maximum.at(column_maxes, column_of_byte[~is_separator],
+                      offset_in_column[~is_separator] + 1)
+        column_starts = np.cumsum(column_maxes + 1) - (column_maxes + 1)
+        new_positions = column_starts[column_of_byte] + np.where(
+            is_separator, column_maxes[column_of_byte], offset_in_column)
+        maximum_length = int(column_maxes.sum()) + number_of_columns - 1
+        # Write the transposed matrix directly: column position major.
+        transposed = np.zeros(maximum_length * len(lengths), dtype=np.uint8)
+        transposed[new_positions * len(lengths) + name_of_byte] = concat_data
+        encoded = cls.__new__(cls)
+        encoded.number_of_names = len(block)
+        encoded.data = transposed.tobytes()
+        return encoded
+
     def decode(self):
         decoded_data = super().decode()
         answer_names = []
@@ -58,28 +194,53 @@ class EncodedColumns(EncodedNames):
         return answer_names
 
 
+ENCODERS = {"names": EncodedNames, "columns": EncodedColumns}
+COMPRESSORS = {"gzip": gzip.compress, "bzip2": bz2.compress, "lzma": lzma.compress}
+
+
+def block_sizes(encoder_name: str, ids: LineBlock) -> Dict[str, int]:
+    encoder = ENCODERS[encoder_name]
+    encoded_ids = encoder.from_line_block(ids)
+    lines = bytes(ids.newline_terminated())
+    assert lines == "".join(name + "\n" for name in encoded_ids.decode()).encode()
+    original = ids.concatenated().tobytes()
+    transformed = encoded_ids.raw_data()
+    packed = encoded_ids.packed_data()
+    assert encoded_ids.decode() == encoder.from_packed_data(packed).decode()
+    sizes = {"original": len(original), "bitpacked": len(packed)}
+    for name, compress in COMPRESSORS.items():
+        sizes[f"{name} original"] = len(compress(original))
+        sizes[f"{name} transformed"] = len(compress(transformed))
+    return sizes
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("names", help="newline separated names")
     parser.add_argument("-b", "--block-size", type=int, default=10_000)
-    parser.add_argument("-e", "--encoder", default="names")
+    parser.add_argument("-e", "--encoder", default="names",
+                        choices=ENCODERS.keys())
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="Number of processes used to encode blocks.")
     args = parser.parse_args()
-    encoder = {"names": EncodedNames, "columns": EncodedColumns}[args.encoder]
-    with open(args.names, "rt") as f:
-        ids = f.read().splitlines()
-    encoded_ids = encoder(ids)
-    concat_ids = ''.join(ids)
-    assert ids == encoded_ids.decode()
-    print("original length\t\t", len(concat_ids))
-    print("gzipped original\t", len(gzip.compress(concat_ids.encode('ascii'))))
-    print("gzipped transformed\t", len(gzip.compress(encoded_ids.raw_data())))
+    totals = collections.Counter()
+    with MappedFile(args.names) as f:
+        blocks = f.blocks(args.block_size)
+        encode_block = functools.partial(block_sizes, args.encoder)
+        for sizes in ordered_map(encode_block, blocks, args.threads):
+            totals.update(sizes)
+    print("original length\t\t", totals["original"])
+    print("gzipped original\t", totals["gzip original"])
+    print("gzipped transformed\t", totals["gzip transformed"])
+
+    print("bzipped original\t", totals["bzip2 original"])
+    print("bzipped transformed\t", totals["bzip2 transformed"])
 
-    print("bzipped original\t", len(bz2.compress(concat_ids.encode('ascii'))))
-    print("bzipped transformed\t", len(bz2.compress(encoded_ids.raw_data())))
+    print("lzma original\t\t", totals["lzma original"])
+    print("lzma transformed\t", totals["lzma transformed"])
 
-    print("lzma original\t\t", len(lzma.compress(concat_ids.encode('ascii'))))
-    print("lzma transformed\t", len(lzma.compress(encoded_ids.raw_data())))
+    print("bitpacked transformed\t", totals["bitpacked"])
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,197 @@
+"""
+Opt-in instrumentation of the block codecs.
+
+Pass --stats FILE to a script, or set FASTQCOMPRESS_STATS=FILE ("-" for
+stderr), to record the wall time of every stage of every block and, for
+every tokenizer column, the bytes going in and out, the encoding flags and,
+for diff encoded columns, the number of diff runs. Records are written as
+JSON lines, one per stage per block. With --stats-format prometheus, or a
+FILE ending in .prom, the records are summed over all blocks and written in
+the Prometheus text format when the script ends.
+
+Blocks may be encoded in worker processes, so records are only collected
+inside collect, which returns them together with the block result. The
+main process hands them to a Reporter in block order.
+"""
+
+import argparse
+import collections
+import contextlib
+import functools
+import json
+import os
+import sys
+import time
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    TextIO, Tuple, TypeVar)
+
+from mmap_reader import LineBlock
+from parallel import ordered_map
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+ENV_VARIABLE = "FASTQCOMPRESS_STATS"
+FORMAT_ENV_VARIABLE = "FASTQCOMPRESS_STATS_FORMAT"
+JSON = "json"
+PROMETHEUS = "prometheus"
+METRIC_PREFIX = "fastqcompress"
+# Fields that identify a record rather than measure it. Other fields that
+# are not numbers, such as the backend, are only written as JSON.
+LABEL_FIELDS = ("stage", "group", "column", "type", "flags")
+
+_records: Optional[List[Dict[str, Any]]] = None
+
+
+def enabled() -> bool:
+    return _records is not None
+
+
+@contextlib.contextmanager
+def stage(name: str, **fields) -> Iterator[Dict[str, Any]]:
+    """
+    Time the body and record it with fields. The body can add fields to
+    the yielded dict. Nothing is recorded outside of collect.
+    """
+    record = {"stage": name, **fields}
+    if _records is None:
+        yield record
+        return
+    start = time.perf_counter()
+    yield record
+    record["seconds"] = time.perf_counter() - start
+    _records.append(record)
+
+
+def input_size(item) -> Optional[int]:
+    """Size in bytes of a block of names or data, when it can be told."""
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return len(item)
+    if isinstance(item, LineBlock):
+        return len(item.data)
+    if isinstance(item, list) and all(isinstance(line, str) for line in item):
+        return sum(map(len, item)) + len(item)
+    return None
+
+
+def collect(function: Callable[[T], R], item: T,
+            stage_name: str = "block") -> Tuple[R, List[Dict[str, Any]]]:
+    """Call function with recording enabled. Returns the result and the records."""
+    global _records
+    previous, _records = _records, []
+    try:
+        with stage(stage_name, bytes_in=input_size(item)) as record:
+            result = function(item)
+            if isinstance(result, bytes):
+                record["bytes_out"] = len(result)
+        return result, _records
+    finally:
+        _records = previous
+
+
+def escape_label(value: str) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Reporter:
+    file: TextIO
+    format: str
+    totals: Dict[Tuple[str, str, Tuple[Tuple[str, str], ...]], float]
+
+    def __init__(self, file: TextIO, format: str = JSON):
+        if format not in (JSON, PROMETHEUS):
+            raise ValueError(f"Unknown stats format: {format}")
+        self.file = file
+        self.format = format
+        self.totals = collections.defaultdict(float)
+
+    def write_block(self, block_number: int, records: Iterable[Dict[str, Any]]):
+        for record in records:
+            if self.format == JSON:
+                self.file.write(json.dumps({"block": block_number, **record}) + "\n")
+            else:
+                self.add(record)
+
+    def add(self, record: Dict[str, Any]):
+        labels = tuple((field, "|".join(value) if isinstance(value, list) else str(value))
+                       for field, value in record.items()
+                       if field in LABEL_FIELDS and field != "stage")
+        stage_name = record["stage"]
+        self.totals[(stage_name, "records", labels)] += 1
+        for field, value in record.items():
+            if field in LABEL_FIELDS or isinstance(value, bool):
+                continue
+            if isinstance(value, (int, float)):
+                self.totals[(stage_name, field, labels)] += value
+
+    def prometheus_text(self) -> str:
+        lines = []
+        metrics = collections.defaultdict(list)
+        for (stage_name, field, labels), value in self.totals.items():
+            metrics[f"{METRIC_PREFIX}_{stage_name}_{field}_total"].append((labels, value))
+        for metric in sorted(metrics):
+            lines.append(f"# TYPE {metric} counter")
+            for labels, value in sorted(metrics[metric]):
+                label_text = ",".join(f'{field}="{escape_label(label_value)}"'
+                                      for field, label_value in labels)
+                if label_text:
+                    label_text = "{" + label_text + "}"
+                if value == int(value):
+                    value = int(value)
+                lines.append(f"{metric}{label_text} {value}")
+        return "".join(line + "\n" for line in lines)
+
+    def close(self):
+        if self.format == PROMETHEUS:
+            self.file.write(self.prometheus_text())
+        if self.file is sys.stderr:
+            self.file.flush()
+        else:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_reporter(path: Optional[str] = None,
+                  format: Optional[str] = None) -> Optional[Reporter]:
+    """
+    Reporter for path, or for the FASTQCOMPRESS_STATS environment variable
+    when path is not given. Returns None when no statistics are requested.
+    """
+    path = path or os.environ.get(ENV_VARIABLE)
+    if not path:
+        return None
+    format = format or os.environ.get(FORMAT_ENV_VARIABLE)
+    if format is None:
+        format = PROMETHEUS if path.endswith(".prom") else JSON
+    file = sys.stderr if path == "-" else open(path, "wt")
+    return Reporter(file, format)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--stats", metavar="FILE",
+                        help=f"Write timings and column sizes of every block "
+                             f"to FILE, '-' for stderr. Can also be set with "
+                             f"{ENV_VARIABLE}.")
+    parser.add_argument("--stats-format", choices=(JSON, PROMETHEUS),
+                        help="Format of the statistics. Default: prometheus "
+                             "for FILEs ending in .prom, JSON lines otherwise.")
+
+
+def instrumented_map(function: Callable[[T], R], iterable: Iterable[T],
+                     threads: int = 1, reporter: Optional[Reporter] = None,
+                     stage_name: str = "block") -> Iterator[R]:
+    """ordered_map that reports the records of every block to reporter."""
+    if reporter is None:
+        yield from ordered_map(function, iterable, threads)
+        return
+    collect_block = functools.partial(collect, function, stage_name=stage_name)
+    for block_number, (result, records) in enumerate(
+            ordered_map(collect_block, iterable, threads)):
+        reporter.write_block(block_number, records)
+        yield result
@@ -0,0 +1,155 @@
+"""
+Zero-copy line reading for the name and quality tools.
+
+The input file is memory-mapped and newline positions are found with numpy,
+one chunk at a time. Blocks of lines are handed out as LineBlocks: a
+memoryview of the mapped bytes plus the offsets of the line ends. Nothing
+is decoded to str and the lines are not copied until an encoder asks for
+it.
+"""
+
+import mmap
+from typing import Iterator, List
+
+import numpy as np
+
+NEWLINE = ord("\n")
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class LineBlock:
+    """
+    Lines that live in a shared buffer. line_ends holds the offset of the
+    newline that ends each line. The last line of a file may end without a
+    newline, its end is then the end of data.
+    """
+    data: memoryview
+    line_ends: np.ndarray
+
+    def __init__(self, data, line_ends: np.ndarray):
+        self.data = memoryview(data)
+        self.line_ends = line_ends
+
+    def __reduce__(self):
+        # Memory maps can not be sent to worker processes, copy the block.
+        return type(self), (bytes(self.data), self.line_ends)
+
+    def __len__(self):
+        return len(self.line_ends)
+
+    def starts(self) -> np.ndarray:
+        starts = np.empty_like(self.line_ends)
+        starts[:1] = 0
+        starts[1:] = self.line_ends[:-1] + 1
+        return starts
+
+    def lengths(self) -> np.ndarray:
+        return self.line_ends - self.starts()
+
+    def __getitem__(self, index: int) -> memoryview:
+        if index < 0:
+            index += len(self)
+        end = int(self.line_ends[index])
+        start = int(self.line_ends[index - 1]) + 1 if index > 0 else 0
+        return self.data[start:end]
+
+    def __iter__(self) -> Iterator[memoryview]:
+        start = 0
+        for end in self.line_ends.tolist():
+            yield self.data[start:end]
+            start = end + 1
+
+    def with_newlines(self) -> Iterator[memoryview]:
+        """Lines including their newline, like iterating over a file."""
+        start = 0
+        for end in self.line_ends.tolist():
+            yield self.data[start:end + 1]
+            start = end + 1
+
+    def is_newline_terminated(self) -> bool:
+        return len(self.line_ends) == 0 or self.line_ends[-1] < len(self.data)
+
+    def newline_terminated(self):
+        """All lines including their newlines. Only copies when the last
+        line of the file has no newline."""
+        if self.is_newline_terminated():
+            return self.data
+        return bytes(self.data) + b"\n"
+
+    def concatenated(self) -> np.ndarray:
+        """All lines without newlines in one array."""
+        buffer = np.frombuffer(self.data, dtype=np.uint8)
+        is_content = np.ones(len(buffer), dtype=bool)
+        newlines = self.line_ends[self.line_ends < len(buffer)]
+        is_content[newlines] = False
+        return buffer[is_content]
+
+    def to_bytes_list(self) -> List[bytes]:
+        return [bytes(line) for line in self]
+
+    def to_str_list(self, encoding: str = "latin-1") -> List[str]:
+        return [str(line, encoding) for line in self]
+
+
+class MappedFile:
+    def __init__(self, path: str):
+        self.fileobj = open(path, "rb")
+        try:
+            self.buffer = mmap.mmap(self.fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can not be mapped.
+            self.buffer = b""
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            try:
+                self.buffer.close()
+            except BufferError:
+                # LineBlocks still refer to the map. It is closed when they
+                # are garbage collected.
+                pass
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def line_ends(self, chunk_size: int = CHUNK_SIZE) -> Iterator[np.ndarray]:
+        """Offsets of all newlines, per chunk of the file."""
+        size = len(self.buffer)
+        for offset in range(0, size, chunk_size):
+            chunk = np.frombuffer(self.buffer, dtype=np.uint8,
+                                  count=min(chunk_size, size - offset),
+                                  offset=offset)
+            yield np.flatnonzero(chunk == NEWLINE) + offset
+
+    def blocks(self, block_size: int,
+               chunk_size: int = CHUNK_SIZE) -> Iterator[LineBlock]:
+        view = memoryview(self.buffer)
+        start = 0
+        pending: List[np.ndarray] = []
+        number_pending = 0
+        for chunk_ends in self.line_ends(chunk_size):
+            pending.append(chunk_ends)
+            number_pending += len(chunk_ends)
+            if number_pending < block_size:
+                continue
+            ends = np.concatenate(pending)
+            for block_start in range(0, len(ends) - block_size + 1, block_size):
+                block_ends = ends[block_start:block_start + block_size]
+                end = int(block_ends[-1]) + 1
+                yield LineBlock(view[start:end], block_ends - start)
+                start = end
+            pending = [ends[len(ends) - len(ends) % block_size:]]
+            number_pending = len(pending[0])
+        ends = np.concatenate(pending) if pending else np.zeros(0, dtype=np.intp)
+        if len(view) > (int(ends[-1]) + 1 if len(ends) else start):
+            # The last line has no newline.
+            ends = np.append(ends, len(view))
+        if len(ends):
+            yield LineBlock(view[start:], ends - start)
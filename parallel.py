@@ -0,0 +1,73 @@
+"""
+Helpers to run block codecs on multiple cores while keeping the block order.
+"""
+
+import collections
+import concurrent.futures
+from typing import Callable, Iterable, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    """Executor that runs every submitted call right away in this process."""
+
+    def submit(self, fn, /, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def process_pool(threads: int) -> concurrent.futures.Executor:
+    """
+    A pool of threads worker processes. Like ordered_map, one thread runs
+    in-process, without the cost of starting a worker and pickling blocks.
+    """
+    if threads <= 1:
+        return InlineExecutor()
+    return concurrent.futures.ProcessPoolExecutor(threads)
+
+
+def ordered_map(function: Callable[[T], R],
+                iterable: Iterable[T],
+                threads: int = 1,
+                max_pending: Optional[int] = None) -> Iterator[R]:
+    """
+    Like map, but function is executed in a pool of worker processes. Results
+    are yielded in input order. At most max_pending blocks are in flight so
+    memory use is bounded when the consumer is slower than the workers.
+    """
+    if threads <= 1:
+        yield from map(function, iterable)
+        return
+    if max_pending is None:
+        max_pending = threads * 2
+    with concurrent.futures.ProcessPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(function, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def batched(items: Iterable[T], block_size: int) -> Iterator[List[T]]:
+    """Lists of block_size items, the last one may be shorter."""
+    block = []
+    for item in items:
+        block.append(item)
+        if len(block) == block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def read_blocks(lines: Iterable[str], block_size: int) -> Iterator[List[str]]:
+    """Blocks of block_size lines without their newlines."""
+    return batched((line.rstrip("\n") for line in lines), block_size)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+"""
+Compact storage for the sort permutations of reversible_sort and block_sort.
+
+A raw array of 16-bit indexes hardly compresses. The size of every
+encoding is estimated and the smallest is used:
+
+- PACKED: every index at ceil(log2(n)) bits.
+- RUNS: stretches where each index is one more than the previous one are
+  stored as a start and a length. Cheap for already ordered data.
+- DELTA: the distance between the sorted and the original position,
+  zigzag encoded and packed at the bits of the largest distance. Cheap for
+  nearly sorted data.
+- LEHMER: the Lehmer code as mixed radix numbers of LEHMER_CHUNK_LENGTH
+  digits each, close to log2(n!) bits. The best possible for random
+  permutations. Only used up to LEHMER_MAX_LENGTH indexes.
+
+Longer permutations can be written with write_permutation and read with
+permutation_chunks a chunk at a time, so reversible_sort never needs the
+whole permutation in memory.
+"""
+
+import argparse
+import array
+import math
+import struct
+from typing import (BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Sequence, Tuple)
+
+import numpy as np
+
+from bitpacking import pack_integers, packed_length, unpack_integers
+
+PACKED = 0
+RUNS = 1
+DELTA = 2
+LEHMER = 3
+# Frames of the other methods, each with its own method and count.
+CHUNKED = 4
+
+# Lehmer codes are converted to and from integers this many digits at a
+# time. Above LEHMER_MAX_LENGTH computing the code in Python is too slow.
+LEHMER_CHUNK_LENGTH = 1024
+LEHMER_MAX_LENGTH = 1 << 18
+
+
+def bits_for(maximum: int) -> int:
+    return int(maximum).bit_length()
+
+
+def encode_packed(values: np.ndarray, length: int, offset: int = 0) -> bytes:
+    return pack_integers(values, bits_for(length - 1))
+
+
+def decode_packed(stream: BinaryIO, count: int, length: int,
+                  offset: int = 0) -> np.ndarray:
+    bits = bits_for(length - 1)
+    return unpack_integers(stream.read(packed_length(count, bits)), count, bits)
+
+
+def packed_size(values: np.ndarray, length: int, offset: int = 0) -> int:
+    return packed_length(len(values), bits_for(length - 1))
+
+
+def find_runs(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    breaks = np.flatnonzero(np.diff(values) != 1) + 1
+    run_starts = np.concatenate(([0], breaks))
+    return run_starts, np.diff(run_starts, append=len(values))
+
+
+def encode_runs(values: np.ndarray, length: int, offset: int = 0) -> bytes:
+    run_starts, run_lengths = find_runs(values)
+    start_bits = bits_for(length - 1)
+    length_bits = bits_for(run_lengths.max())
+    return b"".join([
+        struct.pack("<IB", len(run_starts), length_bits),
+        pack_integers(values[run_starts], start_bits),
+        pack_integers(run_lengths, length_bits),
+    ])
+
+
+def decode_runs(stream: BinaryIO, count: int, length: int,
+                offset: int = 0) -> np.ndarray:
+    number_of_runs, length_bits = struct.unpack("<IB", stream.read(5))
+    start_bits = bits_for(length - 1)
+    starts = unpack_integers(stream.read(packed_length(number_of_runs, start_bits)),
+                             number_of_runs, start_bits).astype(np.int64)
+    run_lengths = unpack_integers(
+        stream.read(packed_length(number_of_runs, length_bits)),
+        number_of_runs, length_bits).astype(np.int64)
+    run_of_position = np.repeat(np.arange(number_of_runs), run_lengths)
+    offset_in_run = np.arange(count) - (np.cumsum(run_lengths) - run_lengths)[run_of_position]
+    return starts[run_of_position] + offset_in_run
+
+
+def runs_size(values: np.ndarray, length: int, offset: int = 0) -> int:
+    run_starts, run_lengths = find_runs(values)
+    return (5 + packed_length(len(run_starts), bits_for(length - 1)) +
+            packed_length(len(run_starts), bits_for(run_lengths.max())))
+
+
+def zigzag_deltas(values: np.ndarray, offset: int) -> np.ndarray:
+    """Distance of every value from its position, zigzag encoded."""
+    deltas = values.astype(np.int64) - np.arange(offset, offset + len(values))
+    return np.where(deltas < 0, -2 * deltas - 1, 2 * deltas)
+
+
+def encode_delta(values: np.ndarray, length: int, offset: int = 0) -> bytes:
+    zigzag = zigzag_deltas(values, offset)
+    bits = bits_for(zigzag.max())
+    return struct.pack("B", bits) + pack_integers(zigzag, bits)
+
+
+def decode_delta(stream: BinaryIO, count: int, length: int,
+                 offset: int = 0) -> np.ndarray:
+    bits, = struct.unpack("B", stream.read(1))
+    zigzag = unpack_integers(stream.read(packed_length(count, bits)),
+                             count, bits).astype(np.int64)
+    deltas = np.where(zigzag & 1, -(zigzag + 1) // 2, zigzag // 2)
+    return deltas + np.arange(offset, offset + count)
+
+
+def delta_size(values: np.ndarray, length: int, offset: int = 0) -> int:
+    return 1 + packed_length(len(values), bits_for(zigzag_deltas(values, offset).max()))
+
+
+class FenwickTree:
+    def __init__(self, size: int):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    def add(self, index: int, value: int):
+        index += 1
+        while index <= self.size:
+            self.tree[index] += value
+            index += index & -index
+
+    def prefix_sum(self, index: int) -> int:
+        """Sum of the values at positions below index."""
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def find(self, rank: int) -> int:
+        """Lowest position where the prefix sum including it exceeds rank."""
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            next_position = position + step
+            if next_position <= self.size and self.tree[next_position] <= rank:
+                position = next_position
+                rank -= self.tree[next_position]
+            step >>= 1
+        return position
+
+
+def lehmer_code(permutation: Sequence[int]) -> List[int]:
+    """For each position the number of later positions with a smaller value."""
+    seen = FenwickTree(len(permutation))
+    code = [0] * len(permutation)
+    for i in range(len(permutation) - 1, -1, -1):
+        value = permutation[i]
+        code[i] = seen.prefix_sum(value)
+        seen.add(value, 1)
+    return code
+
+
+def permutation_from_lehmer_code(code: Sequence[int]) -> List[int]:
+    unused = FenwickTree(len(code))
+    for i in range(len(code)):
+        unused.add(i, 1)
+    permutation = []
+    for rank in code:
+        value = unused.find(rank)
+        unused.add(value, -1)
+        permutation.append(value)
+    return permutation
+
+
+def radix_product(radices: Sequence[int], start: int, stop: int) -> int:
+    if stop - start <= 32:
+        return math.prod(radices[start:stop])
+    middle = (start + stop) // 2
+    return radix_product(radices, start, middle) * radix_product(radices, middle, stop)
+
+
+def mixed_radix_value(digits: Sequence[int], radices: Sequence[int],
+                      start: int, stop: int) -> Tuple[int, int]:
+    """
+    Combine digits into one number with the first digit most significant.
+    The halves are combined recursively so the big integer multiplications
+    stay balanced. Returns the value and the product of the radices.
+    """
+    if stop - start <= 32:
+        value = 0
+        for i in range(start, stop):
+            value = value * radices[i] + digits[i]
+        return value, math.prod(radices[start:stop])
+    middle = (start + stop) // 2
+    left_value, left_product = mixed_radix_value(digits, radices, start, middle)
+    right_value, right_product = mixed_radix_value(digits, radices, middle, stop)
+    return left_value * right_product + right_value, left_product * right_product
+
+
+def mixed_radix_digits(value: int, radices: Sequence[int], start: int,
+                       stop: int, digits: List[int]):
+    if stop - start <= 32:
+        for i in range(stop - 1, start - 1, -1):
+            value, digits[i] = divmod(value, radices[i])
+        return
+    middle = (start + stop) // 2
+    left, right = divmod(value, radix_product(radices, middle, stop))
+    mixed_radix_digits(left, radices, start, middle, digits)
+    mixed_radix_digits(right, radices, middle, stop, digits)
+
+
+def lehmer_chunk_size(radices: Sequence[int], start: int, stop: int) -> int:
+    return ((radix_product(radices, start, stop) - 1).bit_length() + 7) // 8
+
+
+def encode_lehmer(values: np.ndarray, length: int, offset: int = 0) -> bytes:
+    """
+    Store the Lehmer code in chunks of LEHMER_CHUNK_LENGTH mixed radix
+    digits. Each chunk is one integer, so the big integer conversions cost
+    the same for every chunk and the total stays linear in the length.
+    """
+    code = lehmer_code(values.tolist())
+    radices = list(range(length, 0, -1))
+    chunks = []
+    for start in range(0, length, LEHMER_CHUNK_LENGTH):
+        stop = min(start + LEHMER_CHUNK_LENGTH, length)
+        value, product = mixed_radix_value(code, radices, start, stop)
+        chunks.append(value.to_bytes(((product - 1).bit_length() + 7) // 8, "little"))
+    return b"".join(chunks)
+
+
+def decode_lehmer(stream: BinaryIO, count: int, length: int,
+                  offset: int = 0) -> np.ndarray:
+    radices = list(range(length, 0, -1))
+    code = [0] * length
+    for start in range(0, length, LEHMER_CHUNK_LENGTH):
+        stop = min(start + LEHMER_CHUNK_LENGTH, length)
+        value = int.from_bytes(
+            stream.read(lehmer_chunk_size(radices, start, stop)), "little")
+        mixed_radix_digits(value, radices, start, stop, code)
+    return np.array(permutation_from_lehmer_code(code), dtype=np.int64)
+
+
+def lehmer_size(values: np.ndarray, length: int, offset: int = 0) -> int:
+    """log2(n!) bits, plus at most a byte of rounding per chunk."""
+    number_of_chunks = -(-length // LEHMER_CHUNK_LENGTH)
+    return math.ceil(math.lgamma(length + 1) / math.log(2) / 8) + number_of_chunks
+
+
+class Method(NamedTuple):
+    name: str
+    encode: Callable[[np.ndarray, int, int], bytes]
+    decode: Callable[[BinaryIO, int, int, int], np.ndarray]
+    size: Callable[[np.ndarray, int, int], int]
+
+
+METHODS: Dict[int, Method] = {
+    PACKED: Method("packed", encode_packed, decode_packed, packed_size),
+    RUNS: Method("runs", encode_runs, decode_runs, runs_size),
+    DELTA: Method("delta", encode_delta, decode_delta, delta_size),
+    LEHMER: Method("lehmer", encode_lehmer, decode_lehmer, lehmer_size),
+}
+
+
+def candidate_methods(length: int) -> List[int]:
+    if length > LEHMER_MAX_LENGTH:
+        return [PACKED, RUNS, DELTA]
+    return [PACKED, RUNS, DELTA, LEHMER]
+
+
+def choose_method(values: np.ndarray, length: int, offset: int = 0) -> int:
+    """The method with the smallest estimated size. Only that one is encoded."""
+    return min(candidate_methods(length),
+               key=lambda method: METHODS[method].size(values, length, offset))
+
+
+def encode_permutation(permutation: Sequence[int]) -> bytes:
+    permutation = np.asarray(permutation, dtype=np.int64)
+    if len(permutation) == 0:
+        return struct.pack("<BI", PACKED, 0)
+    method = choose_method(permutation, len(permutation))
+    encoded = METHODS[method].encode(permutation, len(permutation), 0)
+    return struct.pack("<BI", method, len(permutation)) + encoded
+
+
+def write_permutation(out: BinaryIO, chunks: Iterable[Sequence[int]], length: int):
+    """
+    Write a permutation of length indexes that is given in chunks. Up to
+    LEHMER_MAX_LENGTH indexes it is encoded as a whole. Longer permutations
+    are written as CHUNKED, where every chunk gets its own method, so only
+    one chunk is in memory at a time.
+    """
+    if length <= LEHMER_MAX_LENGTH:
+        chunks = [np.asarray(chunk, dtype=np.int64) for chunk in chunks]
+        out.write(encode_permutation(np.concatenate(chunks) if chunks else []))
+        return
+    out.write(struct.pack("<BI", CHUNKED, length))
+    offset = 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.int64)
+        if len(chunk) == 0:
+            continue
+        method = choose_method(chunk, length, offset)
+        out.write(struct.pack("<BI", method, len(chunk)))
+        out.write(METHODS[method].encode(chunk, length, offset))
+        offset += len(chunk)
+    if offset != length:
+        raise ValueError(f"Expected {length} indexes, got {offset}")
+
+
+def read_method(stream: BinaryIO, method: int, count: int, length: int,
+                offset: int) -> np.ndarray:
+    if method not in METHODS:
+        raise ValueError(f"Unknown permutation encoding: {method}")
+    return METHODS[method].decode(stream, count, length, offset).astype(np.int64)
+
+
+def read_permutation_length(stream: BinaryIO) -> int:
+    """Length of the permutation at the start of stream. Consumes the header."""
+    _, length = struct.unpack("<BI", stream.read(5))
+    return length
+
+
+def permutation_chunks(stream: BinaryIO) -> Iterator[np.ndarray]:
+    """Decode a permutation one chunk at a time."""
+    method, length = struct.unpack("<BI", stream.read(5))
+    if length == 0:
+        return
+    if method != CHUNKED:
+        yield read_method(stream, method, length, length, 0)
+        return
+    offset = 0
+    while offset < length:
+        method, count = struct.unpack("<BI", stream.read(5))
+        yield read_method(stream, method, count, length, offset)
+        offset += count
+
+
+def decode_permutation(stream: BinaryIO) -> np.ndarray:
+    chunks = list(permutation_chunks(stream))
+    if not chunks:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show the size of each encoding for an indexes file.")
+    parser.add_argument("indexes")
+    parser.add_argument("-t", "--index-array-type", default="H")
+    args = parser.parse_args()
+    permutation = array.array(args.index_array_type)
+    with open(args.indexes, "rb") as f:
+        permutation.frombytes(f.read())
+    print(f"array\t\t{len(permutation) * permutation.itemsize}")
+    permutation = np.asarray(permutation, dtype=np.int64)
+    print(f"log2(n!)\t{math.lgamma(len(permutation) + 1) / math.log(2) / 8:.0f}")
+    length = len(permutation)
+    for method_id in candidate_methods(length):
+        method = METHODS[method_id]
+        print(f"{method.name}\t\t{len(method.encode(permutation, length, 0))}\t"
+              f"estimated {method.size(permutation, length, 0)}")
+
+
+if __name__ == "__main__":
+    main()
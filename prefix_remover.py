@@ -7,34 +7,213 @@ Answer: No. It only works with gzip to a significant degree. Bzip2 and
 the name tokenizer do a good job in capturing the repetition not requiring
 much overhead to store the prefix. It works for gzip though, but that has
 only a 32KiB window size and is thus massively helped by such things.
+
+With --front-coding each name is stored as the length of the prefix it
+shares with the previous name and the remaining suffix instead. This works
+best on sorted names, such as the output of reversible_sort.py.
 """
 
+import argparse
+import io
+import os
+import struct
 import sys
-from typing import Iterable
+from typing import BinaryIO, Iterable, Iterator, List, Sequence
+
+import numpy as np
+
+from bitpacking import array_type_to_itemsize, numbers_to_array
+from mmap_reader import LineBlock, MappedFile
+from parallel import read_blocks
+
+# Consecutive names are compared this many pairs at a time in a matrix that
+# is as wide as a few times the median shared length of the chunk. Longer
+# pairs are compared on their own, so an outlier does not widen the matrix.
+PREFIX_CHUNK_SIZE = 1024
+OUTLIER_FACTOR = 4
+MIN_MATRIX_WIDTH = 64
+
 
 def find_common_prefix(lines: Iterable[str]) -> str:
     line_iter = iter(lines)
     common_prefix = next(line_iter)
-    common_prefix_length = len(common_prefix)
     for line in line_iter:
         if not line.startswith(common_prefix):
-            while True:
-                # This trail and error approach is very inefficient but in the
-                # context of read names of length 33 with thousands of entries
-                # it does not matter.
-                common_prefix_length -= 1
-                if common_prefix_length == 0:
-                    return ""
-                common_prefix = common_prefix[:common_prefix_length]
-                if line.startswith(common_prefix):
-                    break
+            common_prefix = os.path.commonprefix([common_prefix, line])
+            if not common_prefix:
+                return ""
     return common_prefix
 
 
-def main():
-    file = sys.argv[1]
+def shared_prefix_lengths(names: Sequence[str], previous: str = "") -> np.ndarray:
+    """
+    Length of the prefix each name shares with the name before it. The
+    first name is compared with previous.
+    """
+    all_names = [previous, *names]
+    lengths = np.fromiter(map(len, all_names), dtype=np.intp, count=len(all_names))
+    try:
+        concat_data = "".join(all_names).encode("ascii")
+    except UnicodeEncodeError:
+        concat_data = None
+    if concat_data is None:
+        return np.fromiter(
+            (len(os.path.commonprefix([before, name]))
+             for before, name in zip(all_names, names)),
+            dtype=np.intp, count=len(names))
+    return matrix_shared_prefix_lengths(
+        np.frombuffer(concat_data, dtype=np.uint8), lengths)
+
+
+def pair_shared_prefix_length(concat_data: np.ndarray, before: int, after: int,
+                              length: int) -> int:
+    differs = np.flatnonzero(concat_data[after:after + length]
+                             != concat_data[before:before + length])
+    return int(differs[0]) if differs.size else length
+
+
+def matrix_shared_prefix_lengths(concat_data: np.ndarray,
+                                 lengths: np.ndarray) -> np.ndarray:
+    """
+    shared_prefix_lengths for the concatenated bytes of previous and the
+    names. Chunks of names are compared at once in a names x width matrix,
+    where the width is bounded by the median length the pairs in the chunk
+    can share. This keeps the work proportional to the total bytes, also
+    when a few names are much longer than the rest.
+    """
+    starts = np.cumsum(lengths) - lengths
+    comparable = np.minimum(lengths[1:], lengths[:-1])
+    shared = np.empty(len(comparable), dtype=np.intp)
+    for first in range(0, len(comparable), PREFIX_CHUNK_SIZE):
+        last = min(first + PREFIX_CHUNK_SIZE, len(comparable))
+        row_lengths = lengths[first:last + 1]
+        row_starts = starts[first:last + 1]
+        chunk_comparable = comparable[first:last]
+        longest_row = int(row_lengths.max())
+        width = min(longest_row, max(OUTLIER_FACTOR * int(np.median(chunk_comparable)),
+                                     MIN_MATRIX_WIDTH))
+        if width == 0:
+            shared[first:last] = 0
+            continue
+        in_row = np.arange(width) < row_lengths[:, np.newaxis]
+        if longest_row <= width:
+            row_data = concat_data[row_starts[0]:row_starts[-1] + row_lengths[-1]]
+        else:
+            kept = np.minimum(row_lengths, width)
+            row_data = concat_data[np.nonzero(in_row)[1] + np.repeat(row_starts, kept)]
+        matrix = np.zeros((len(row_lengths), width), dtype=np.uint8)
+        matrix[in_row] = row_data
+        differs = matrix[1:] != matrix[:-1]
+        first_difference = np.where(differs.any(axis=1), differs.argmax(axis=1),
+                                    width)
+        # Padding compares equal, so a name can not share more than its length.
+        shared[first:last] = np.minimum(first_difference, chunk_comparable)
+        for pair in np.flatnonzero(chunk_comparable > width).tolist():
+            shared[first + pair] = pair_shared_prefix_length(
+                concat_data, int(row_starts[pair]), int(row_starts[pair + 1]),
+                int(chunk_comparable[pair]))
+    return shared
+
+
+def front_coded(shared: np.ndarray, suffixes: bytes) -> bytes:
+    shared_array = numbers_to_array(shared.tolist() or [0])
+    return b"".join([
+        struct.pack("<IB", len(shared), ord(shared_array.typecode)),
+        shared_array.tobytes()[:len(shared) * shared_array.itemsize],
+        suffixes,
+    ])
+
+
+def front_encode(names: Sequence[str], previous: str = "") -> bytes:
+    """
+    Store the shared prefix lengths as an array, followed by the newline
+    terminated suffixes.
+    """
+    shared = shared_prefix_lengths(names, previous)
+    suffixes = "".join(name[length:] + "\n"
+                       for name, length in zip(names, shared.tolist()))
+    return front_coded(shared, suffixes.encode("utf-8"))
+
+
+def front_encode_line_block(block: LineBlock, previous: str = "") -> bytes:
+    """
+    front_encode the lines of a LineBlock. ASCII blocks are compared and
+    cut into suffixes as bytes, without making a str for every name.
+    """
+    concat_data = block.concatenated()
+    lengths = block.lengths()
+    if (concat_data.size and concat_data.max() > 127) or not previous.isascii():
+        return front_encode(block.to_str_list("utf-8"), previous)
+    previous_data = np.frombuffer(previous.encode("ascii"), dtype=np.uint8)
+    shared = matrix_shared_prefix_lengths(
+        np.concatenate((previous_data, concat_data)),
+        np.concatenate(([len(previous_data)], lengths)))
+    lines = np.frombuffer(block.newline_terminated(), dtype=np.uint8)
+    line_lengths = lengths + 1
+    offset_in_line = np.arange(len(lines)) - np.repeat(block.starts(), line_lengths)
+    suffixes = lines[offset_in_line >= np.repeat(shared, line_lengths)]
+    return front_coded(shared, suffixes.tobytes())
+
+
+def front_decode(data: bytes, previous: str = "") -> List[str]:
+    stream = io.BytesIO(data)
+    number_of_names, typecode = struct.unpack("<IB", stream.read(5))
+    typecode = chr(typecode)
+    shared = np.frombuffer(
+        stream.read(number_of_names * array_type_to_itemsize(typecode)),
+        dtype=typecode).tolist()
+    suffixes = stream.read().decode("utf-8").split("\n")
+    names = []
+    for length, suffix in zip(shared, suffixes):
+        previous = previous[:length] + suffix
+        names.append(previous)
+    return names
+
+
+def front_encode_stream(lines: Iterable[str], block_size: int = 10_000,
+                        independent_blocks: bool = False) -> Iterator[bytes]:
+    """
+    Front code lines in length prefixed blocks. By default the first name
+    of a block shares its prefix with the last name of the previous block.
+    With independent_blocks every block can be decoded on its own.
+    """
+    previous = ""
+    for block in read_blocks(lines, block_size):
+        data = front_encode(block, "" if independent_blocks else previous)
+        yield struct.pack("<I", len(data)) + data
+        previous = block[-1]
+
+
+def front_encode_file(path: str, block_size: int = 10_000,
+                      independent_blocks: bool = False) -> Iterator[bytes]:
+    """Like front_encode_stream, but reads memory-mapped blocks of bytes."""
+    previous = ""
+    with MappedFile(path) as f:
+        for block in f.blocks(block_size):
+            data = front_encode_line_block(
+                block, "" if independent_blocks else previous)
+            yield struct.pack("<I", len(data)) + data
+            previous = str(block[-1], "utf-8")
+
+
+def front_decode_stream(stream: BinaryIO) -> Iterator[str]:
+    # Independent blocks start with a shared length of 0, so carrying the
+    # previous name over decodes both kinds of streams.
+    previous = ""
+    while True:
+        header = stream.read(4)
+        if not header:
+            return
+        length, = struct.unpack("<I", header)
+        names = front_decode(stream.read(length), previous)
+        yield from names
+        if names:
+            previous = names[-1]
+
+
+def remove_common_prefix(file: str):
     with open(file, "rt") as f:
-        common_prefix = find_common_prefix(f)
+        common_prefix = find_common_prefix(line.rstrip("\n") for line in f)
     common_prefix_length = len(common_prefix)
     print(f"Common prefix: {common_prefix}")
     with open(file, "rt") as fin:
@@ -42,5 +221,35 @@ def main():
             for line in fin:
                 fout.write(line[common_prefix_length:])
 
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="File with a name on each line, or a "
+                                     "front coded file with -d.")
+    parser.add_argument("-f", "--front-coding", action="store_true",
+                        help="Front code the names to FILE.front instead of "
+                             "removing the common prefix.")
+    parser.add_argument("-d", "--decode", action="store_true",
+                        help="Decode a front coded file to stdout.")
+    parser.add_argument("-b", "--block-size", type=int, default=10_000)
+    parser.add_argument("-i", "--independent-blocks", action="store_true",
+                        help="Do not share prefixes across blocks, so each "
+                             "block can be decoded on its own.")
+    args = parser.parse_args()
+    if args.decode:
+        with open(args.file, "rb") as f:
+            for name in front_decode_stream(f):
+                sys.stdout.write(name + "\n")
+        return
+    if not args.front_coding:
+        remove_common_prefix(args.file)
+        return
+    with open(args.file + ".front", "wb") as fout:
+        for frame in front_encode_file(args.file, args.block_size,
+                                       args.independent_blocks):
+            fout.write(frame)
+
+
 if __name__ == "__main__":
     main()
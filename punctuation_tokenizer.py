@@ -1,25 +1,25 @@
 #!/usr/bin/env python3
 import argparse
 import array
+import contextlib
+import functools
 import io
 import logging
 import string
 import struct
 import sys
-from typing import List, Iterator, Sequence, Tuple, Iterable, BinaryIO
-
-UINT64_MAX = 0xFFFF_FFFF_FFFF_FFFF
-UINT32_MAX = 0xFFFF_FFFF
-UINT16_MAX = 0xFFFF
-UINT8_MAX = 0xFF
-INT64_MAX = 9223372036854775807
-INT32_MAX = 2147483647
-INT16_MAX = 32767
-INT8_MAX = 127
-INT64_MIN = - INT64_MAX - 1
-INT32_MIN = - INT32_MAX - 1
-INT16_MIN = - INT16_MAX - 1
-INT8_MIN = - INT8_MAX - 1
+from typing import Callable, Dict, List, Iterator, NamedTuple, Optional, Sequence, Tuple, Iterable, BinaryIO, Union
+
+import numpy as np
+
+from bitpacking import (INT64_MAX, UINT8_MAX, UINT16_MAX, array_type_to_itemsize,
+                        bits_needed, numbers_to_array, pack_integers,
+                        pack_stripes, packed_length, typecode_for_range,
+                        unpack_integers, unpack_stripes)
+from entropy_backends import BACKENDS, compress_column, decompress_column
+import instrumentation
+from mmap_reader import NEWLINE, LineBlock, MappedFile
+from parallel import ordered_map, read_blocks
 
 DECIMAL =      0b0000_0000
 LOWER =        0b0000_0001
@@ -27,6 +27,8 @@ UPPER =        0b0000_0010
 ZERO_PREFIX =  0b0000_0100
 PUNCTUATION =  0b0000_1000
 DIFF_ENCODED = 0b0001_0000
+BIT_PACKED =   0b0010_0000
+DICTIONARY =   0b0100_0000
 STRING = UPPER | LOWER
 
 TOK_TYPE_TO_STRING = [
@@ -44,6 +46,39 @@ TOK_TYPE_TO_STRING[UPPER] = "UPPERHEXADECIMAL"
 TOK_TYPE_TO_STRING[LOWER] = "LOWERHEXADECIMAL"
 TOK_TYPE_TO_STRING[DECIMAL] = "DECIMAL"
 
+FLAG_NAMES = [
+    (LOWER, "LOWER"),
+    (UPPER, "UPPER"),
+    (ZERO_PREFIX, "ZERO_PREFIX"),
+    (PUNCTUATION, "PUNCTUATION"),
+    (DIFF_ENCODED, "DIFF_ENCODED"),
+    (BIT_PACKED, "BIT_PACKED"),
+    (DICTIONARY, "DICTIONARY"),
+]
+
+# A STRING column is stored with a dictionary when each distinct value
+# occurs at least this many times on average.
+DICTIONARY_MIN_REPEATS = 4
+DICTIONARY_MAX_SIZE = UINT16_MAX
+
+LOWER_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+UPPER_DIGITS = np.frombuffer(b"0123456789ABCDEF", dtype=np.uint8)
+DIGIT_VALUES = np.zeros(256, dtype=np.uint8)
+DIGIT_VALUES[LOWER_DIGITS] = np.arange(16)
+DIGIT_VALUES[UPPER_DIGITS] = np.arange(16)
+# Numbers with more digits than this may not fit in an int64 and are parsed
+# one by one.
+MAX_PARSED_DIGITS = {10: 18, 16: 15}
+
+# Any character that is not a hexadecimal digit or punctuation makes a token
+# a STRING. This class is only used internally by tokenize_block.
+NOT_HEXADECIMAL = 0b1000_0000
+BYTE_CLASSES = np.full(256, NOT_HEXADECIMAL, dtype=np.uint8)
+BYTE_CLASSES[np.frombuffer(string.digits.encode(), dtype=np.uint8)] = DECIMAL
+BYTE_CLASSES[np.frombuffer(b"abcdef", dtype=np.uint8)] = LOWER
+BYTE_CLASSES[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = UPPER
+BYTE_CLASSES[np.frombuffer(string.punctuation.encode(), dtype=np.uint8)] = PUNCTUATION
+
 
 def classify_token(tok: str) -> int:
     tp = 0
@@ -79,139 +114,494 @@ def tokenize_name(name: str) -> Iterator[Tuple[int, str]]:
         yield classify_token(token), token
 
 
-def numbers_to_array(numbers: Sequence[int]) -> array.ArrayType:
-    number_min = min(numbers)
-    number_max = max(numbers)
-    if number_min >= 0:
-        if number_max > UINT64_MAX:
-            raise NotImplementedError("Numbers to big")
-        elif number_max > UINT32_MAX:
-            array_type = "Q"
-        elif number_max > UINT16_MAX:
-            array_type = "I"
-        elif number_max > UINT8_MAX:
-            array_type = "H"
-        else:
-            array_type = "B"
+def pack_diff_encoding(arr: array.ArrayType) -> bytes:
+    """
+    Store numbers as runs where each number is at most 255 larger than the
+    previous one. The run starts, the run lengths and the differences within
+    the runs are stored as three contiguous arrays.
+    """
+    numbers = np.frombuffer(arr, dtype=arr.typecode)
+    if arr.typecode == "Q" and numbers.max() > INT64_MAX:
+        raise ValueError("Numbers too big for diff encoding")
+    numbers = numbers.astype(np.int64)
+    diffs = np.diff(numbers)
+    is_break = (diffs < 0) | (diffs > UINT8_MAX)
+    start_positions = np.concatenate(([0], np.flatnonzero(is_break) + 1))
+    run_lengths = np.diff(start_positions, append=len(numbers))
+    start_array = numbers_to_array(numbers[start_positions].tolist())
+    length_array = numbers_to_array(run_lengths.tolist())
+    return b"".join([
+        struct.pack("<IBB", len(start_array), ord(start_array.typecode),
+                    ord(length_array.typecode)),
+        start_array.tobytes(),
+        length_array.tobytes(),
+        diffs[~is_break].astype(np.uint8).tobytes(),
+    ])
+
+
+def unpack_diff_encoding(stream: BinaryIO, number_stored: int) -> np.ndarray:
+    number_of_runs, start_tp, length_tp = struct.unpack("<IBB", stream.read(6))
+    start_tp = chr(start_tp)
+    length_tp = chr(length_tp)
+    starts = np.frombuffer(
+        stream.read(array_type_to_itemsize(start_tp) * number_of_runs),
+        dtype=start_tp).astype(np.int64)
+    run_lengths = np.frombuffer(
+        stream.read(array_type_to_itemsize(length_tp) * number_of_runs),
+        dtype=length_tp).astype(np.intp)
+    diffs = np.frombuffer(stream.read(number_stored - number_of_runs),
+                          dtype=np.uint8)
+    start_positions = np.cumsum(run_lengths) - run_lengths
+    is_start = np.zeros(number_stored, dtype=bool)
+    is_start[start_positions] = True
+    deltas = np.zeros(number_stored, dtype=np.int64)
+    deltas[~is_start] = diffs
+    # Cumulative sum within each run, offset by the start of the run.
+    cumulative = np.cumsum(deltas)
+    run_of_number = np.repeat(np.arange(number_of_runs), run_lengths)
+    return cumulative - cumulative[start_positions][run_of_number] + starts[run_of_number]
+
+
+class ColumnBytes(NamedTuple):
+    """The concatenated tokens of a decoded column and the length of each."""
+    data: np.ndarray
+    lengths: np.ndarray
+
+    @classmethod
+    def from_tokens(cls, tokens: Sequence[str]):
+        return cls(np.frombuffer("".join(tokens).encode("latin-1"), dtype=np.uint8),
+                   np.fromiter(map(len, tokens), dtype=np.intp, count=len(tokens)))
+
+    def tokens(self) -> List[str]:
+        text = self.data.tobytes().decode("latin-1")
+        ends = np.cumsum(self.lengths).tolist()
+        return [text[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+class TokenPositions(NamedTuple):
+    """The buffer of a tokenized block and where each token is in it."""
+    data: np.ndarray
+    starts: np.ndarray
+    lengths: np.ndarray
+
+    def column(self, indexes: np.ndarray) -> ColumnBytes:
+        """Gather the tokens at indexes into one column."""
+        lengths = self.lengths[indexes]
+        offsets = np.cumsum(lengths) - lengths
+        positions = (np.repeat(self.starts[indexes] - offsets, lengths) +
+                     np.arange(int(lengths.sum())))
+        return ColumnBytes(self.data[positions], lengths)
+
+
+def flag_names(tp: int) -> List[str]:
+    return [name for flag, name in FLAG_NAMES if tp & flag]
+
+
+def token_type_name(tp: int) -> str:
+    if tp & PUNCTUATION:
+        return "PUNCTUATION"
+    return TOK_TYPE_TO_STRING[tp & (STRING | ZERO_PREFIX)]
+
+
+def is_numeric(tp: int) -> bool:
+    return not tp & PUNCTUATION and tp & STRING != STRING
+
+
+def number_base(tp: int) -> int:
+    return 16 if tp & (LOWER | UPPER) else 10
+
+
+def number_lengths(numbers: np.ndarray, base: int) -> np.ndarray:
+    """Number of digits of each non-negative number."""
+    lengths = np.ones(len(numbers), dtype=np.intp)
+    maximum = int(numbers.max()) if len(numbers) else 0
+    power = base
+    while power <= maximum:
+        lengths += numbers >= np.uint64(power)
+        power *= base
+    return lengths
+
+
+def parse_numbers(column: ColumnBytes, base: int) -> Optional[np.ndarray]:
+    """
+    Parse a column of non-negative numbers at once in a numbers x digits
+    matrix. Returns None when they may not fit in an int64.
+    """
+    number_of_digits = int(column.lengths.max()) if len(column.lengths) else 0
+    if number_of_digits > MAX_PARSED_DIGITS[base]:
+        return None
+    digits = np.zeros((len(column.lengths), number_of_digits), dtype=np.uint8)
+    # Right align the digits, so every position has the same weight.
+    is_digit = (np.arange(number_of_digits) >=
+                number_of_digits - column.lengths[:, np.newaxis])
+    digits[is_digit] = DIGIT_VALUES[column.data]
+    numbers = np.zeros(len(column.lengths), dtype=np.int64)
+    for position in range(number_of_digits):
+        numbers = numbers * base + digits[:, position]
+    return numbers
+
+
+def format_numbers(numbers: np.ndarray, tp: int, width: int = 0) -> ColumnBytes:
+    """
+    Format a column of non-negative numbers in the base and case of tp,
+    left padded with zeros to width. The digits of all numbers are
+    computed at once in a numbers x digits matrix.
+    """
+    numbers = numbers.astype(np.uint64)
+    base = np.uint64(number_base(tp))
+    lengths = np.maximum(number_lengths(numbers, int(base)), width)
+    number_of_digits = int(lengths.max()) if len(lengths) else 0
+    digits = np.empty((len(numbers), number_of_digits), dtype=np.uint8)
+    remainder = numbers
+    for position in range(number_of_digits - 1, -1, -1):
+        digits[:, position] = remainder % base
+        remainder = remainder // base
+    symbols = UPPER_DIGITS if tp & UPPER else LOWER_DIGITS
+    is_digit = np.arange(number_of_digits) >= number_of_digits - lengths[:, np.newaxis]
+    return ColumnBytes(symbols[digits[is_digit]], lengths)
+
+
+def read_column(stream: BinaryIO, dictionary: Optional["ColumnDictionary"] = None
+                ) -> Tuple[int, ColumnBytes]:
+    """
+    Read a column written by TokenStore.to_data as bytes. dictionary is the
+    table of the column in earlier blocks of the stream, if any.
+    """
+    tp, number_stored = struct.unpack("<BI", stream.read(5))
+    if tp & DICTIONARY:
+        if dictionary is None:
+            dictionary = ColumnDictionary()
+        return tp, dictionary.decode(stream, number_stored)
+    if tp & PUNCTUATION:
+        character, = stream.read(1)
+        return tp, ColumnBytes(np.full(number_stored, character, dtype=np.uint8),
+                               np.ones(number_stored, dtype=np.intp))
+    if tp & STRING == STRING and tp & BIT_PACKED:
+        width, = struct.unpack("B", stream.read(1))
+        data = np.frombuffer(unpack_stripes(stream, width), dtype=np.uint8)
+        return tp, ColumnBytes(data, np.full(len(data) // width, width, dtype=np.intp))
+    if tp & STRING == STRING:
+        data = np.frombuffer(stream.read(number_stored), dtype=np.uint8)
+        is_separator = data == 0
+        ends = np.append(np.flatnonzero(is_separator), len(data))
+        lengths = np.diff(ends, prepend=-1) - 1
+        return tp, ColumnBytes(data[~is_separator], lengths)
+    # The rest is numbers
+    width = 0
+    if tp & ZERO_PREFIX:
+        width, = struct.unpack("B", stream.read(1))
+    if tp & DIFF_ENCODED:
+        numbers = unpack_diff_encoding(stream, number_stored)
     else:
-        if number_min < INT64_MIN or number_max > INT64_MAX:
-            raise NotImplementedError("Numbers to big")
-        elif number_min < INT32_MIN or number_max > INT32_MAX:
-            array_type = "q"
-        elif number_min < INT16_MIN or number_max > INT16_MAX:
-            array_type = "i"
-        elif number_min < INT8_MIN or number_max > INT8_MAX:
-            array_type = "h"
+        array_type = stream.read(1).decode("latin-1")
+        item_size = array_type_to_itemsize(array_type)
+        numbers = np.frombuffer(stream.read(number_stored * item_size),
+                                dtype=array_type)
+    return tp, format_numbers(numbers, tp, width)
+
+
+class ColumnStats:
+    """
+    Statistics of a token column, gathered from its bytes with numpy: the
+    union of the token types, the token count, the minimum, maximum and
+    total token length, the alphabet of PUNCTUATION and STRING columns and
+    the smallest and largest number of numeric columns.
+    """
+    tp: int
+    count: int
+    min_length: Optional[int]
+    max_length: Optional[int]
+    total_length: int
+    alphabet: Optional[np.ndarray]
+    minimum: Optional[int]
+    maximum: Optional[int]
+
+    def __init__(self, tp: int = 0):
+        self.tp = tp
+        self.count = 0
+        self.min_length = None
+        self.max_length = None
+        self.total_length = 0
+        self.alphabet = None
+        self.minimum = None
+        self.maximum = None
+
+    @classmethod
+    def gather(cls, tp: int, column: ColumnBytes
+               ) -> Tuple["ColumnStats", Union[np.ndarray, List[int], None]]:
+        """
+        Statistics of a column. For numeric columns the parsed numbers are
+        returned as well, so they do not have to be parsed again.
+        """
+        stats = cls(tp)
+        stats.count = len(column.lengths)
+        if stats.count == 0:
+            return stats, None
+        stats.min_length = int(column.lengths.min())
+        stats.max_length = int(column.lengths.max())
+        stats.total_length = len(column.data)
+        if not is_numeric(tp):
+            stats.alphabet = np.bincount(column.data, minlength=256) != 0
+            return stats, None
+        base = number_base(tp)
+        numbers = parse_numbers(column, base)
+        if numbers is None:
+            numbers = [int(token, base) for token in column.tokens()]
+            stats.minimum, stats.maximum = min(numbers), max(numbers)
         else:
-            array_type = "b"
-    return array.array(array_type, numbers)
+            stats.minimum, stats.maximum = int(numbers.min()), int(numbers.max())
+        return stats, numbers
+
+    def symbols(self) -> bytes:
+        return np.flatnonzero(self.alphabet).astype(np.uint8).tobytes()
+
+    def uniform_length(self) -> Optional[int]:
+        """The length of all tokens, or None when the lengths differ."""
+        if self.count and self.min_length == self.max_length:
+            return self.min_length
+        return None
+
+    def typecode(self) -> str:
+        return typecode_for_range(self.minimum, self.maximum)
+
 
+class ColumnDictionary:
+    """
+    Table of the distinct values of a STRING column. Tokens are stored as
+    packed indexes into the table, run-length coded when values repeat. In
+    a stream the table of each column is kept across blocks, so a value is
+    only stored in the first block it occurs in.
+    """
+    values: List[str]
+    indexes: Dict[str, int]
 
-def array_type_to_itemsize(array_type: str) -> int:
-    return {"B": 1, "H": 2, "I": 4, "Q": 8}[array_type.upper()]
+    def __init__(self, values: Iterable[str] = ()):
+        self.values = list(values)
+        self.indexes = {value: index for index, value in enumerate(self.values)}
 
+    def copy(self) -> "ColumnDictionary":
+        return type(self)(self.values)
 
-def diffcompress(numbers: Iterable[int]) -> Iterator[Tuple[int, Sequence[int]]]:
-    it = iter(numbers)
-    first_number = next(it)
-    previous_number = first_number
-    following_diffs = []
-    for number in it:
-        diff = number - previous_number
-        if diff < 0 or diff > 255:
-            yield first_number, following_diffs
-            first_number = number
-            following_diffs = []
+    def add(self, values: Iterable[str]):
+        for value in values:
+            self.indexes[value] = len(self.values)
+            self.values.append(value)
+
+    def encode(self, tokens: Sequence[str]) -> Optional[bytes]:
+        """
+        Store tokens as indexes and add the new values to the table. Returns
+        None when the column has too many distinct values.
+        """
+        distinct = dict.fromkeys(tokens)
+        if len(distinct) > max(1, len(tokens) // DICTIONARY_MIN_REPEATS):
+            return None
+        if any("\x00" in value for value in distinct):
+            return None
+        new_values = [value for value in distinct if value not in self.indexes]
+        # A reset column does not refer to values of earlier blocks.
+        reset = not self.values or len(self.values) + len(new_values) > DICTIONARY_MAX_SIZE
+        if reset:
+            self.values, self.indexes = [], {}
+            new_values = list(distinct)
+        self.add(new_values)
+        indexes = np.fromiter(map(self.indexes.__getitem__, tokens),
+                              dtype=np.int64, count=len(tokens))
+        bits = bits_needed(len(self.values))
+        is_start = np.ones(len(indexes), dtype=bool)
+        is_start[1:] = indexes[1:] != indexes[:-1]
+        run_values = indexes[is_start]
+        run_lengths = numbers_to_array(
+            np.diff(np.flatnonzero(is_start), append=len(indexes)).tolist())
+        run_length_size = (4 + packed_length(len(run_values), bits) + 1 +
+                           len(run_lengths) * run_lengths.itemsize)
+        run_length_coded = run_length_size < packed_length(len(indexes), bits)
+        new_data = "\x00".join(new_values).encode("latin-1")
+        header = struct.pack("<BIIB", reset, len(new_values), len(new_data),
+                             run_length_coded)
+        if not run_length_coded:
+            return header + new_data + pack_integers(indexes, bits)
+        return b"".join([
+            header,
+            new_data,
+            struct.pack("<I", len(run_values)),
+            pack_integers(run_values, bits),
+            run_lengths.typecode.encode("latin-1"),
+            run_lengths.tobytes(),
+        ])
+
+    def decode(self, stream: BinaryIO, number_of_tokens: int) -> ColumnBytes:
+        reset, number_of_new_values, new_data_length, run_length_coded = \
+            struct.unpack("<BIIB", stream.read(10))
+        if reset:
+            self.values, self.indexes = [], {}
+        elif not self.values:
+            raise ValueError("Column refers to the dictionary of an earlier "
+                             "block. Decompress the blocks in order.")
+        if number_of_new_values:
+            self.add(stream.read(new_data_length).decode("latin-1").split("\x00"))
+        bits = bits_needed(len(self.values))
+        if run_length_coded:
+            number_of_runs, = struct.unpack("<I", stream.read(4))
+            run_values = unpack_integers(
+                stream.read(packed_length(number_of_runs, bits)), number_of_runs, bits)
+            typecode = stream.read(1).decode("latin-1")
+            run_lengths = np.frombuffer(
+                stream.read(number_of_runs * array_type_to_itemsize(typecode)),
+                dtype=typecode)
+            indexes = np.repeat(run_values.astype(np.intp), run_lengths)
         else:
-            following_diffs.append(diff)
-        previous_number = number
-    yield first_number, following_diffs
+            indexes = unpack_integers(
+                stream.read(packed_length(number_of_tokens, bits)),
+                number_of_tokens, bits).astype(np.intp)
+        value_data = np.frombuffer(
+            "".join(self.values).encode("latin-1"), dtype=np.uint8)
+        value_lengths = np.fromiter(map(len, self.values), dtype=np.intp,
+                                    count=len(self.values))
+        value_starts = np.cumsum(value_lengths) - value_lengths
+        lengths = value_lengths[indexes]
+        token_starts = np.cumsum(lengths) - lengths
+        positions = (np.repeat(value_starts[indexes] - token_starts, lengths) +
+                     np.arange(int(lengths.sum())))
+        return ColumnBytes(value_data[positions], lengths)
 
 
-def diffdecompress(diffcompressed: Iterable[Tuple[int, Sequence[int]]]) -> Iterator[int]:
-    for first_number, diffs in diffcompressed:
-        yield first_number
-        previous_number = first_number
-        for diff in diffs:
-            number = previous_number + diff
-            yield number
-            previous_number = number
+# Keyed by the signature of the group and the column number. Group numbers
+# depend on the order in which signatures first appear in a block, so they
+# do not identify a column across blocks.
+Dictionaries = Dict[Tuple[str, int], ColumnDictionary]
 
 
-def pack_diff_encoding(diff_compressed: Iterable[Tuple[int, Sequence[int]]]) -> bytes:
-    stream = io.BytesIO()
-    diff_compressed = list(diff_compressed)
-    start_numbers = [start for start, diffs in diff_compressed]
-    start_array = numbers_to_array(start_numbers)
-    stream.write(struct.pack("<IB", len(start_array), ord(start_array.typecode)))
-    stream.write(start_array.tobytes())
-    diffstream = (diffs for start, diffs in diff_compressed)
-    for diffs in diffstream:
-        arr = numbers_to_array(diffs)
-        stream.write(struct.pack("<IB", len(arr), ord(arr.typecode)))
-        stream.write(arr.tobytes())
-    return stream.getvalue()
+def group_signature(token_stores: Sequence["TokenStore"]) -> str:
+    """The signature split_tokens gives to the names of a group."""
+    return "".join(ts.tokens[0] if ts.tp & PUNCTUATION else "\x01"
+                   for ts in token_stores)
 
 
-def unpack_diff_encoding(stream: BinaryIO) -> Iterator[Tuple[int, Sequence[int]]]:
-    start_length, start_tp = struct.unpack("<IB", stream.read(5))
-    start_tp = chr(start_tp)
-    array_bytes =  array_type_to_itemsize(start_tp) * start_length
-    start_numbers = array.array(start_tp)
-    start_numbers.frombytes(stream.read(array_bytes))
-    for start in start_numbers:
-        length, tp = struct.unpack("<IB", stream.read(5))
-        array_type = chr(tp)
-        array_bytes = array_type_to_itemsize(array_type) * length
-        diffs = array.array(array_type)
-        diffs.frombytes(stream.read(array_bytes))
-        yield start, diffs
+def column_signature(column_data: bytes) -> str:
+    """Part of the group signature for a column written by TokenStore.to_data."""
+    tp = column_data[0]
+    return chr(column_data[5]) if tp & PUNCTUATION else "\x01"
 
 
 class TokenStore:
     tp: int
     tokens: List[str]
+    column: Optional[ColumnBytes]
+    stats: Optional[ColumnStats]
+    numbers: Union[np.ndarray, List[int], None]
+    diff_runs: Optional[int]
 
-    def __init__(self, tp: int, tokens: List[str]):
+    def __init__(self, tp: int, tokens: List[str],
+                 column: Optional[ColumnBytes] = None):
         self.tp = tp
         self.tokens = tokens
+        self.column = column
+        self.stats = None
+        self.numbers = None
+        self.diff_runs = None
 
-    def to_data(self) -> bytes:
-        number_of_tokens = len(self.tokens)
+    @classmethod
+    def from_column(cls, tokens: List[str], types: np.ndarray,
+                    column: Optional[ColumnBytes] = None):
+        """
+        Create a store. column holds the bytes of the tokens when the
+        tokenizer already has them.
+        """
+        token_store = cls(int(np.bitwise_or.reduce(types)), tokens, column)
+        if is_numeric(token_store.tp) and token_store.tp & ZERO_PREFIX:
+            token_store.demote_mixed_widths()
+        return token_store
+
+    def demote_mixed_widths(self):
+        """
+        Zero prefixed numbers are stored at a single width. When the widths
+        differ and the only zero prefixed token is "0", such as in read_0 to
+        read_299, the column is stored as plain numbers. Otherwise it is
+        stored as STRING.
+        """
+        column = self.column_bytes()
+        if column.lengths.min() == column.lengths.max():
+            return
+        starts = np.cumsum(column.lengths) - column.lengths
+        if np.any((column.data[starts] == ord("0")) & (column.lengths > 1)):
+            self.tp = STRING
+        else:
+            self.tp &= ~ZERO_PREFIX
+
+    def column_bytes(self) -> ColumnBytes:
+        if self.column is None:
+            self.column = ColumnBytes.from_tokens(self.tokens)
+        return self.column
+
+    def column_stats(self) -> ColumnStats:
+        if self.stats is None:
+            self.stats, self.numbers = ColumnStats.gather(self.tp, self.column_bytes())
+        return self.stats
+
+    def to_data(self, bit_pack: bool = True, diff_encode: bool = True,
+                dictionary: Optional[ColumnDictionary] = None) -> bytes:
+        """
+        Serialize the column. When a dictionary is given, low cardinality
+        STRING columns are stored as indexes into it and their new values
+        are added to it.
+        """
+        stats = self.column_stats()
+        number_of_tokens = stats.count
+        dictionary_data = None
+        if dictionary is not None and self.tp & STRING == STRING:
+            dictionary_data = dictionary.encode(self.tokens)
         if self.tp & PUNCTUATION:
-            token_set = set(self.tokens)
-            if len(token_set) != 1:
+            separators = stats.symbols()
+            if len(separators) != 1:
                 raise NotImplementedError(
-                    f"PUNCTUATION separators should be the same: {token_set}")
-            separator = token_set.pop()
-            if len(separator) != 1:
+                    f"PUNCTUATION separators should be the same: {separators}")
+            if stats.uniform_length() != 1:
                 raise RuntimeError(
-                    f"Programmer messed up! Separator length is not 1: {separator}")
-            data = separator.encode("latin-1")
+                    f"Programmer messed up! Separator length is not 1: {separators}")
+            data = separators
+        elif dictionary_data is not None:
+            data = dictionary_data
+            self.tp |= DICTIONARY
         elif self.tp & STRING == STRING:
-            all_string = "\x00".join(self.tokens)
-            number_of_tokens = len(all_string)
-            data = (all_string.encode("latin_1"))
-        elif self.tp & LOWER or self.tp & UPPER or self.tp == DECIMAL or self.tp == ZERO_PREFIX:
-            if self.tp & LOWER or self.tp & UPPER:
-                numbers = [int(x, 16) for x in self.tokens]
+            column = self.column_bytes()
+            data = np.insert(column.data, np.cumsum(column.lengths)[:-1], 0).tobytes()
+            number_of_tokens = len(data)
+            width = stats.uniform_length()
+            if bit_pack and width is not None and 0 < width <= UINT8_MAX:
+                # Store each character position as a bit-packed column.
+                packed = struct.pack("B", width) + pack_stripes(
+                    column.data.tobytes(), width)
+                if len(packed) < len(data):
+                    data = packed
+                    number_of_tokens = len(self.tokens)
+                    self.tp |= BIT_PACKED
+        elif is_numeric(self.tp):
+            arr = array.array(stats.typecode())
+            if isinstance(self.numbers, np.ndarray):
+                arr.frombytes(self.numbers.astype(arr.typecode).tobytes())
             else:
-                numbers = [int(x, 10) for x in self.tokens]
-            arr = numbers_to_array(numbers)
+                arr.extend(self.numbers)
             array_size = arr.itemsize * len(arr)
             data = arr.typecode.encode("latin-1") + arr.tobytes()
-            try:
-                diff_compressed_bytes = pack_diff_encoding(diffcompress(arr))
-                if array_size > len(diff_compressed_bytes):
-                    data = diff_compressed_bytes
-                    self.tp |= DIFF_ENCODED
-            except ValueError:
-                pass
+            # Diff encoding stores at least a byte per number, so it can not
+            # beat an array of single bytes.
+            if diff_encode and arr.itemsize > 1:
+                try:
+                    diff_compressed_bytes = pack_diff_encoding(arr)
+                except ValueError:
+                    pass
+                else:
+                    self.diff_runs, = struct.unpack_from("<I", diff_compressed_bytes)
+                    if array_size > len(diff_compressed_bytes):
+                        data = diff_compressed_bytes
+                        self.tp |= DIFF_ENCODED
             if self.tp & ZERO_PREFIX:
-                length_set = set(len(x) for x in self.tokens)
-                if len(length_set) != 1:
-                    raise ValueError(f"Zero prefixed numbers should all have the same formatted length. Found {length_set}")
-                formatted_length = length_set.pop()
+                formatted_length = stats.uniform_length()
+                if formatted_length is None:
+                    raise ValueError(
+                        f"Zero prefixed numbers should all have the same "
+                        f"formatted length. Found lengths {stats.min_length} "
+                        f"to {stats.max_length}")
                 data = struct.pack("B", formatted_length) + data
         else:
             raise NotImplementedError(f"Unkown token type: {self.tp}")
@@ -219,35 +609,10 @@ class TokenStore:
         return header + data
 
     @classmethod
-    def from_stream(cls, stream: BinaryIO):
-        tp, number_stored = struct.unpack("<BI", stream.read(5))
-        if tp & PUNCTUATION:
-            character = stream.read(1).decode("latin-1")
-            return cls(tp, [character for _ in range(number_stored)])
-        if tp & STRING == STRING:
-            all_strings = stream.read(number_stored).decode("latin-1")
-            return cls(tp, all_strings.split("\x00"))
-        # The rest is numbers
-        if tp & UPPER:
-            format_code = "X"
-        elif tp & LOWER:
-            format_code = "x"
-        else:
-            format_code = "d"
-        if tp & ZERO_PREFIX:
-            formatted_length, = struct.unpack("B", stream.read(1))
-            format_code = f"0{formatted_length}" + format_code
-        if tp & DIFF_ENCODED:
-            number_array = diffdecompress(unpack_diff_encoding(stream))
-        else:
-            array_type = stream.read(1).decode("latin-1")
-            item_size = array_type_to_itemsize(array_type)
-            bytes_stored = number_stored * item_size
-            array_bytes = stream.read(bytes_stored)
-            number_array = array.array(array_type)
-            number_array.frombytes(array_bytes)
-        tokens = [f"%{format_code}" % number for number in number_array]
-        return cls(tp, tokens)
+    def from_stream(cls, stream: BinaryIO,
+                    dictionary: Optional[ColumnDictionary] = None):
+        tp, column = read_column(stream, dictionary)
+        return cls(tp, column.tokens())
 
     @classmethod
     def from_token_stream(cls, token_stream: List[tuple[int, str]]):
@@ -259,63 +624,408 @@ class TokenStore:
         return cls(combined, tokens)
 
 
-def compress(names: List[str]) -> bytes:
-    token_strings = []
+def tokenize_names(names: Sequence[str]
+                   ) -> Tuple[List[str], np.ndarray, np.ndarray, List[str], None]:
+    """
+    Per name version of split_tokens. Used for names that can not be handled
+    as a latin-1 block.
+    """
+    tokens = []
+    token_types = []
+    tokens_per_name = []
+    signatures = []
     for name in names:
-        token_strings.append(list(tokenize_name(name)))
-    it = iter(token_strings)
-    first = next(it)
-    length_mismatch = False
-    for token_string in it:
-        if len(token_string) != len(first):
-            length_mismatch = True
-    if length_mismatch:
-        raise ValueError("Unequal token lengths. Codec unsuitable.")
-    token_streams = [list(row) for row in zip(*token_strings)]
-    token_sets = []
-    for token_stream in token_streams:
-        token_sets.append(set(TOK_TYPE_TO_STRING[tok_type] for tok_type, token in token_stream))
-    logging.info(f"Token types per column: {token_sets}")
-    token_stores = [TokenStore.from_token_stream(token_stream)
-                    for token_stream in token_streams]
-    homogenized_token_order = [TOK_TYPE_TO_STRING[ts.tp] for ts in token_stores]
-    logging.info(f"Homogenized token type order: {homogenized_token_order}")
-    all_data = b"".join(ts.to_data() for ts in token_stores)
-    return all_data
-
-
-def decompress(data: bytes) -> Iterator[str]:
+        token_string = list(tokenize_name(name))
+        tokens_per_name.append(len(token_string))
+        signatures.append("".join(token if tp == PUNCTUATION else "\x01"
+                                  for tp, token in token_string))
+        for tp, token in token_string:
+            token_types.append(tp)
+            tokens.append(token)
+    return (tokens, np.array(token_types, dtype=np.uint8),
+            np.array(tokens_per_name, dtype=np.intp), signatures, None)
+
+
+def split_tokens(names: Union[Sequence[str], LineBlock]
+                 ) -> Tuple[List[str], np.ndarray, np.ndarray, List[str],
+                            Optional[TokenPositions]]:
+    """
+    Tokenize all names at once. Separators and token types are found with a
+    byte class lookup table over the entire block rather than character by
+    character as in tokenize_name. Names in a LineBlock are tokenized straight
+    from its buffer.
+
+    Returns all tokens, their types, the number of tokens in each name,
+    each name's signature: its separators with every other token replaced
+    by "\x01", and the positions of the tokens in the block buffer. The
+    per name fallback gives no positions.
+    """
+    if isinstance(names, LineBlock):
+        block = names.newline_terminated()
+    else:
+        try:
+            block = "\n".join(names).encode("latin-1") + b"\n"
+        except UnicodeEncodeError:
+            return tokenize_names(names)
+    data = np.frombuffer(block, dtype=np.uint8)
+    is_newline = data == ord("\n")
+    if np.count_nonzero(is_newline) != len(names) or not data.all():
+        if isinstance(names, LineBlock):
+            names = names.to_str_list()
+        return tokenize_names(names)
+    byte_classes = BYTE_CLASSES[data]
+    byte_classes[is_newline] = 0
+    is_punctuation = byte_classes == PUNCTUATION
+    # A token starts at every punctuation character and after every
+    # punctuation character or line start.
+    follows_boundary = np.empty_like(is_newline)
+    follows_boundary[0] = True
+    np.logical_or(is_punctuation[:-1], is_newline[:-1], out=follows_boundary[1:])
+    token_starts = np.flatnonzero(~is_newline & (is_punctuation | follows_boundary))
+    newlines = np.flatnonzero(is_newline)
+    name_of_token = np.searchsorted(newlines, token_starts)
+    tokens_per_name = np.bincount(name_of_token, minlength=len(names))
+
+    # The newline bytes are set to 0 so they do not change the token types.
+    if len(token_starts):
+        combined_classes = np.bitwise_or.reduceat(byte_classes, token_starts)
+    else:
+        combined_classes = np.zeros(0, dtype=np.uint8)
+    token_types = combined_classes & (UPPER | LOWER | PUNCTUATION)
+    token_types[data[token_starts] == ord("0")] |= ZERO_PREFIX
+    token_types[combined_classes & NOT_HEXADECIMAL != 0] = STRING
+
+    # Split all tokens at once by putting a null byte between them.
+    separated = data.copy()
+    separated[is_newline] = 0
+    line_starts = np.concatenate(([0], newlines[:-1] + 1))
+    inner_starts = np.setdiff1d(token_starts, line_starts, assume_unique=True)
+    separated = np.insert(separated, inner_starts, 0)
+    tokens = separated.tobytes().decode("latin-1").split("\x00")[:-1]
+    if not np.all(tokens_per_name):
+        # Empty names leave an empty string between the separators.
+        tokens = [token for token in tokens if token]
+
+    signature_codes = np.where(is_punctuation[token_starts],
+                               data[token_starts], 1).astype(np.uint8)
+    signature_codes = np.insert(signature_codes,
+                                np.cumsum(tokens_per_name)[:-1], ord("\n"))
+    signatures = signature_codes.tobytes().decode("latin-1").split("\n")
+    # A token ends at the next token start or at the end of its name.
+    token_ends = np.minimum(np.append(token_starts[1:], len(data)),
+                            newlines[name_of_token])
+    positions = TokenPositions(data, token_starts, token_ends - token_starts)
+    return tokens, token_types, tokens_per_name, signatures, positions
+
+
+def group_names(names: Union[Sequence[str], LineBlock]) -> Tuple[np.ndarray, List[List[TokenStore]]]:
+    """
+    Tokenize names and partition them on their signature, so names with
+    different separators or a different number of tokens are stored in
+    separate column sets. Returns the group of each name and the TokenStores
+    of each group.
+    """
+    tokens, token_types, tokens_per_name, signatures, token_positions = (
+        split_tokens(names))
+    group_numbers = {}
+    group_ids = np.fromiter(
+        (group_numbers.setdefault(signature, len(group_numbers))
+         for signature in signatures),
+        dtype=np.intp, count=len(names))
+    token_offsets = np.cumsum(tokens_per_name) - tokens_per_name
+    if len(group_numbers) > 1:
+        token_array = np.array(tokens, dtype=object)
+    groups = []
+    for group_id in range(len(group_numbers)):
+        members = np.flatnonzero(group_ids == group_id)
+        number_of_columns = int(tokens_per_name[members[0]])
+        if len(group_numbers) == 1:
+            columns = [tokens[i::number_of_columns] for i in range(number_of_columns)]
+            column_indexes = np.arange(len(tokens)).reshape(
+                len(names), number_of_columns).T
+            column_types = token_types.reshape(len(names), number_of_columns).T
+        else:
+            column_indexes = (token_offsets[members, np.newaxis] +
+                              np.arange(number_of_columns)).T
+            columns = [token_array[column].tolist() for column in column_indexes]
+            column_types = token_types[column_indexes]
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            token_sets = [set(TOK_TYPE_TO_STRING[tp] for tp in np.unique(types))
+                          for types in column_types]
+            logging.info(f"Token types per column: {token_sets}")
+        groups.append([
+            TokenStore.from_column(
+                column, types,
+                token_positions.column(indexes) if token_positions else None)
+            for types, column, indexes in zip(column_types, columns, column_indexes)])
+    return group_ids, groups
+
+
+def compress_token_store(token_store: TokenStore,
+                         dictionary: Optional[ColumnDictionary] = None) -> bytes:
+    tp = token_store.tp
+    updated = dictionary.copy() if dictionary is not None else None
+    data = compress_column(token_store.to_data(dictionary=updated))
+    transformed_tp = token_store.tp
+    if transformed_tp & DICTIONARY:
+        # Only keep the new values when the dictionary is actually used, the
+        # decoder only updates its table for dictionary columns.
+        dictionary.values, dictionary.indexes = updated.values, updated.indexes
+    elif transformed_tp & (BIT_PACKED | DIFF_ENCODED):
+        # These transforms remove redundancy the backends could also have
+        # found. Keep the plain column if it compresses better.
+        token_store.tp = tp
+        plain_data = compress_column(
+            token_store.to_data(bit_pack=False, diff_encode=False))
+        if len(plain_data) <= len(data):
+            return plain_data
+        token_store.tp = transformed_tp
+    return data
+
+
+def column_record(token_store: TokenStore, data: bytes) -> dict:
+    """Instrumentation fields of a compressed column."""
+    stats = token_store.column_stats()
+    record = {
+        "type": token_type_name(token_store.tp),
+        "flags": flag_names(token_store.tp),
+        "backend": BACKENDS[data[0]].name,
+        "tokens": stats.count,
+        "bytes_in": stats.total_length,
+        "bytes_out": len(data),
+    }
+    if token_store.tp & DIFF_ENCODED:
+        record["diff_runs"] = token_store.diff_runs
+    return record
+
+
+def compress(names: Union[Sequence[str], LineBlock],
+             dictionaries: Optional[Dictionaries] = None) -> bytes:
+    """
+    Compress a block of names. dictionaries holds the STRING column tables
+    of earlier blocks and is updated with the values of this block, so
+    decompress must be given the blocks in the same order.
+    """
+    if dictionaries is None:
+        dictionaries = {}
+    with instrumentation.stage("tokenize", names=len(names)):
+        group_ids, groups = group_names(names)
+    if len(groups) > UINT16_MAX:
+        raise ValueError(f"A block can hold at most {UINT16_MAX} name layouts, "
+                         f"found {len(groups)}. Use a smaller block size.")
+    stream = io.BytesIO()
+    stream.write(struct.pack("<IH", len(names), len(groups)))
+    if len(groups) > 1:
+        group_array = numbers_to_array(group_ids.tolist())
+        stream.write(compress_column(
+            group_array.typecode.encode("latin-1") + group_array.tobytes()))
+    for group_number, token_stores in enumerate(groups):
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            homogenized_token_order = [TOK_TYPE_TO_STRING[ts.tp] for ts in token_stores]
+            logging.info(f"Homogenized token type order: {homogenized_token_order}")
+        stream.write(struct.pack("<H", len(token_stores)))
+        signature = group_signature(token_stores)
+        for column_number, ts in enumerate(token_stores):
+            with instrumentation.stage("column", group=group_number,
+                                       column=column_number) as record:
+                dictionary = None
+                if ts.tp & STRING == STRING:
+                    dictionary = dictionaries.setdefault(
+                        (signature, column_number), ColumnDictionary())
+                data = compress_token_store(ts, dictionary)
+            if instrumentation.enabled():
+                record.update(column_record(ts, data))
+            stream.write(data)
+    return stream.getvalue()
+
+
+def decompress_to_bytes(data: bytes, dictionaries: Optional[Dictionaries] = None
+                        ) -> bytes:
+    """
+    Decompress to newline terminated names. Every column is decoded in bulk
+    and scattered into one output buffer, so no str is made per token.
+    """
+    if dictionaries is None:
+        dictionaries = {}
     stream = io.BytesIO(data)
-    token_stores = []
-    while stream.tell() != len(data):
-        token_stores.append(TokenStore.from_stream(stream))
-    name_chunks = [ts.tokens for ts in token_stores]
-    for parts in zip(*name_chunks):
-        yield "".join(parts)
+    number_of_names, number_of_groups = struct.unpack("<IH", stream.read(6))
+    if number_of_groups > 1:
+        group_data = decompress_column(stream)
+        group_ids = np.frombuffer(group_data[1:], dtype=chr(group_data[0]))
+    else:
+        group_ids = np.zeros(number_of_names, dtype=np.intp)
+    # Every name is followed by a newline.
+    name_lengths = np.ones(number_of_names, dtype=np.int64)
+    groups = []
+    with instrumentation.stage("decode_columns", bytes_in=len(data)):
+        for group_id in range(number_of_groups):
+            members = np.flatnonzero(group_ids == group_id)
+            number_of_columns, = struct.unpack("<H", stream.read(2))
+            column_data = [decompress_column(stream)
+                           for _ in range(number_of_columns)]
+            signature = "".join(map(column_signature, column_data))
+            columns = [
+                read_column(io.BytesIO(data),
+                            dictionaries.setdefault((signature, column_number),
+                                                    ColumnDictionary()))[1]
+                for column_number, data in enumerate(column_data)]
+            for column in columns:
+                if len(column.lengths) != len(members):
+                    raise ValueError(f"Column has {len(column.lengths)} tokens, "
+                                     f"expected {len(members)}")
+                name_lengths[members] += column.lengths
+            groups.append((members, columns))
+    with instrumentation.stage("assemble", names=number_of_names) as record:
+        name_ends = np.cumsum(name_lengths)
+        output = np.full(int(name_ends[-1]) if number_of_names else 0, NEWLINE,
+                         dtype=np.uint8)
+        for members, columns in groups:
+            token_starts = (name_ends - name_lengths)[members]
+            for column in columns:
+                column_offsets = np.cumsum(column.lengths) - column.lengths
+                output[np.repeat(token_starts - column_offsets, column.lengths) +
+                       np.arange(len(column.data))] = column.data
+                token_starts += column.lengths
+        record["bytes_out"] = len(output)
+    return output.tobytes()
+
+
+def decompress(data: bytes, dictionaries: Optional[Dictionaries] = None
+               ) -> Iterator[str]:
+    yield from decompress_to_bytes(data, dictionaries).decode("latin-1").split("\n")[:-1]
+
+
+def compress_frame(names: Union[Sequence[str], LineBlock],
+                   dictionaries: Optional[Dictionaries] = None) -> bytes:
+    """
+    Compress a block of names into a self-describing frame. The frame header
+    stores the number of names and the size of the compressed block so frames
+    can be read one at a time. Frames are self-contained unless dictionaries
+    are shared with earlier frames.
+    """
+    data = compress(names, dictionaries)
+    return struct.pack("<II", len(names), len(data)) + data
+
+
+def read_frames(stream: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    while True:
+        header = stream.read(8)
+        if not header:
+            return
+        if len(header) != 8:
+            raise EOFError("Truncated frame header")
+        number_of_names, data_length = struct.unpack("<II", header)
+        data = stream.read(data_length)
+        if len(data) != data_length:
+            raise EOFError("Truncated frame")
+        yield number_of_names, data
+
+
+def decompress_frame(frame: Tuple[int, bytes],
+                     dictionaries: Optional[Dictionaries] = None) -> List[str]:
+    number_of_names, data = frame
+    names = list(decompress(data, dictionaries))
+    if len(names) != number_of_names:
+        raise ValueError(f"Frame should contain {number_of_names} names, "
+                         f"found {len(names)}")
+    return names
+
+
+def decompress_frame_to_bytes(frame: Tuple[int, bytes],
+                              dictionaries: Optional[Dictionaries] = None) -> bytes:
+    number_of_names, data = frame
+    names = decompress_to_bytes(data, dictionaries)
+    found = names.count(b"\n")
+    if found != number_of_names:
+        raise ValueError(f"Frame should contain {number_of_names} names, "
+                         f"found {found}")
+    return names
+
+
+def frame_compressor(threads: int, shared_dictionaries: bool
+                     ) -> Callable[[Union[Sequence[str], LineBlock]], bytes]:
+    """
+    With shared_dictionaries the STRING column tables are kept across
+    frames. That only works when frames are compressed in order.
+    """
+    if not shared_dictionaries:
+        return compress_frame
+    if threads > 1:
+        raise ValueError("Shared dictionaries require compressing with one thread.")
+    return functools.partial(compress_frame, dictionaries={})
+
+
+def compress_stream(lines: Iterable[str], block_size: int, threads: int = 1,
+                    reporter: Optional[instrumentation.Reporter] = None,
+                    shared_dictionaries: bool = False) -> Iterator[bytes]:
+    blocks = read_blocks(lines, block_size)
+    yield from instrumentation.instrumented_map(
+        frame_compressor(threads, shared_dictionaries), blocks, threads, reporter)
+
+
+def compress_file(path: str, block_size: int, threads: int = 1,
+                  reporter: Optional[instrumentation.Reporter] = None,
+                  shared_dictionaries: bool = False) -> Iterator[bytes]:
+    """Like compress_stream, but reads memory-mapped blocks of bytes."""
+    with MappedFile(path) as f:
+        yield from instrumentation.instrumented_map(
+            frame_compressor(threads, shared_dictionaries), f.blocks(block_size),
+            threads, reporter)
+
+
+def decompress_stream(stream: BinaryIO, threads: int = 1) -> Iterator[str]:
+    decode = decompress_frame
+    if threads <= 1:
+        # Frames are decoded in order, so frames that share dictionaries
+        # can be read as well.
+        decode = functools.partial(decompress_frame, dictionaries={})
+    for names in ordered_map(decode, read_frames(stream), threads):
+        yield from names
+
+
+def decompress_stream_to_bytes(stream: BinaryIO, threads: int = 1,
+                               reporter: Optional[instrumentation.Reporter] = None
+                               ) -> Iterator[bytes]:
+    """Like decompress_stream, but yields the newline terminated names of
+    each frame as one buffer."""
+    decode = decompress_frame_to_bytes
+    if threads <= 1:
+        decode = functools.partial(decompress_frame_to_bytes, dictionaries={})
+    yield from instrumentation.instrumented_map(
+        decode, read_frames(stream), threads, reporter)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("names", help="File with a name on each new line, or compressed file.")
     parser.add_argument("-d", "--decompress", action="store_true")
+    parser.add_argument("-b", "--block-size", type=int, default=10_000,
+                        help="Number of names per compressed frame.")
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="Number of processes used to (de)compress frames.")
     parser.add_argument("-v", "--verbose", action="count", default=0,
                         help="If supplied will give information about the found tokens.")
+    parser.add_argument("-s", "--shared-dictionaries", action="store_true",
+                        help="Keep the value tables of STRING columns across "
+                             "frames. Frames then have to be decompressed in "
+                             "order with one thread.")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    if args.shared_dictionaries and args.threads > 1 and not args.decompress:
+        parser.error("--shared-dictionaries can only be used with one thread.")
     logger = logging.getLogger()
     logger.setLevel(logging.WARNING - args.verbose * 10)
-    if args.decompress:
-        with open(args.names, "rb") as f:
-            data = f.read()
-        for name in decompress(data):
-            print(name)
-        return
-
-    with open(args.names, "rt") as f:
-        name_block = f.read()
-    data = compress(name_block.splitlines())
-    sys.stdout.buffer.write(data)
-    sys.stdout.buffer.flush()
-    return
+    reporter = instrumentation.open_reporter(args.stats, args.stats_format)
+    with reporter or contextlib.nullcontext():
+        if args.decompress:
+            with open(args.names, "rb") as f:
+                for names in decompress_stream_to_bytes(f, args.threads, reporter):
+                    sys.stdout.buffer.write(names)
+        else:
+            for frame in compress_file(args.names, args.block_size, args.threads,
+                                       reporter, args.shared_dictionaries):
+                sys.stdout.buffer.write(frame)
+        sys.stdout.buffer.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""
+Context model quality codec in the style of fqzcomp.
+
+Each phred is coded with an adaptive arithmetic (range) coder. The
+frequency model that is used is selected by a context built from the
+previous two phreds, a position bucket and the running sum of differences
+within the read. The number of bits each part contributes to the context
+can be configured.
+"""
+
+import argparse
+import bisect
+import io
+import itertools
+import struct
+import time
+from typing import BinaryIO, Dict, List, NamedTuple
+
+import numpy as np
+
+from quality_block import (QualityBlock, lengths_from_stream, lengths_to_bytes,
+                           read_file)
+
+RANGE_TOP = 1 << 24
+MAX_TOTAL = 1 << 16
+INCREMENT = 16
+
+
+class RangeEncoder:
+    """LZMA style range coder with carry propagation."""
+
+    def __init__(self):
+        self.low = 0
+        self.range = 0xFFFF_FFFF
+        self.cache = 0
+        self.cache_size = 1
+        self.out = bytearray()
+
+    def encode(self, cumulative: int, frequency: int, total: int):
+        r = self.range // total
+        self.low += r * cumulative
+        self.range = r * frequency
+        while self.range < RANGE_TOP:
+            self.range <<= 8
+            self.shift_low()
+
+    def shift_low(self):
+        low = self.low
+        if low < 0xFF00_0000 or low > 0xFFFF_FFFF:
+            carry = low >> 32
+            temp = self.cache
+            while True:
+                self.out.append((temp + carry) & 0xFF)
+                temp = 0xFF
+                self.cache_size -= 1
+                if self.cache_size == 0:
+                    break
+            self.cache = (low >> 24) & 0xFF
+        self.cache_size += 1
+        self.low = (low & 0x00FF_FFFF) << 8
+
+    def finish(self) -> bytes:
+        for _ in range(5):
+            self.shift_low()
+        return bytes(self.out)
+
+
+class RangeDecoder:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 5
+        self.range = 0xFFFF_FFFF
+        self.code = int.from_bytes(data[:5].ljust(5, b"\x00"), "big")
+
+    def decode_target(self, total: int) -> int:
+        self.r = self.range // total
+        return min(self.code // self.r, total - 1)
+
+    def update(self, cumulative: int, frequency: int):
+        self.code -= self.r * cumulative
+        self.range = self.r * frequency
+        while self.range < RANGE_TOP:
+            self.range <<= 8
+            byte = self.data[self.position] if self.position < len(self.data) else 0
+            self.code = (self.code << 8) | byte
+            self.position += 1
+
+
+class AdaptiveModel:
+    """Symbol frequencies that are updated after every coded symbol."""
+
+    def __init__(self, number_of_symbols: int):
+        self.frequencies = [1] * number_of_symbols
+        self.total = number_of_symbols
+
+    def encode(self, encoder: RangeEncoder, symbol: int):
+        frequencies = self.frequencies
+        encoder.encode(sum(frequencies[:symbol]), frequencies[symbol], self.total)
+        self.update(symbol)
+
+    def decode(self, decoder: RangeDecoder) -> int:
+        frequencies = self.frequencies
+        target = decoder.decode_target(self.total)
+        cumulative = list(itertools.accumulate(frequencies))
+        symbol = bisect.bisect_right(cumulative, target)
+        frequency = frequencies[symbol]
+        decoder.update(cumulative[symbol] - frequency, frequency)
+        self.update(symbol)
+        return symbol
+
+    def update(self, symbol: int):
+        self.frequencies[symbol] += INCREMENT
+        self.total += INCREMENT
+        if self.total > MAX_TOTAL:
+            self.frequencies = [(freq + 1) // 2 for freq in self.frequencies]
+            self.total = sum(self.frequencies)
+
+
+class ContextParameters(NamedTuple):
+    q1_bits: int = 6
+    q2_bits: int = 4
+    position_bits: int = 3
+    delta_bits: int = 3
+
+    def to_bytes(self) -> bytes:
+        return struct.pack("BBBB", *self)
+
+    @classmethod
+    def from_stream(cls, stream: BinaryIO):
+        return cls(*struct.unpack("BBBB", stream.read(4)))
+
+
+DEFAULT_PARAMETERS = ContextParameters()
+
+
+class ContextModel:
+    """
+    Builds the context for each phred and keeps a model per context.
+    Phreds are given as symbols: indexes into the alphabet of the block.
+    """
+
+    def __init__(self, number_of_symbols: int, parameters: ContextParameters):
+        self.number_of_symbols = number_of_symbols
+        self.parameters = parameters
+        self.models: Dict[int, AdaptiveModel] = {}
+        symbol_bits = max(1, (number_of_symbols - 1).bit_length())
+        # Keep the most significant bits of the previous phreds.
+        self.q1_shift = max(0, symbol_bits - parameters.q1_bits)
+        self.q2_shift = max(0, symbol_bits - parameters.q2_bits)
+        self.position_max = (1 << parameters.position_bits) - 1
+        self.delta_max = (1 << parameters.delta_bits) - 1
+
+    def model(self, q1: int, q2: int, position: int, delta: int) -> AdaptiveModel:
+        parameters = self.parameters
+        context = q1 >> self.q1_shift
+        context = (context << parameters.q2_bits) | (q2 >> self.q2_shift)
+        context = (context << parameters.position_bits) | min(
+            position.bit_length(), self.position_max)
+        context = (context << parameters.delta_bits) | min(
+            delta >> 3, self.delta_max)
+        model = self.models.get(context)
+        if model is None:
+            model = self.models[context] = AdaptiveModel(self.number_of_symbols)
+        return model
+
+    def encode_read(self, encoder: RangeEncoder, symbols: List[int]):
+        q1 = q2 = delta = 0
+        for position, symbol in enumerate(symbols):
+            self.model(q1, q2, position, delta).encode(encoder, symbol)
+            delta += abs(symbol - q1) if position else 0
+            q2 = q1
+            q1 = symbol
+
+    def decode_read(self, decoder: RangeDecoder, length: int) -> List[int]:
+        symbols = []
+        q1 = q2 = delta = 0
+        for position in range(length):
+            symbol = self.model(q1, q2, position, delta).decode(decoder)
+            symbols.append(symbol)
+            delta += abs(symbol - q1) if position else 0
+            q2 = q1
+            q1 = symbol
+        return symbols
+
+
+def compress(block: QualityBlock,
+             parameters: ContextParameters = DEFAULT_PARAMETERS) -> bytes:
+    alphabet, symbols = np.unique(block.phreds(), return_inverse=True)
+    symbols = symbols.tolist()
+    model = ContextModel(len(alphabet), parameters)
+    encoder = RangeEncoder()
+    start = 0
+    for length in block.lengths.tolist():
+        model.encode_read(encoder, symbols[start:start + length])
+        start += length
+    return b"".join([
+        parameters.to_bytes(),
+        struct.pack("B", len(alphabet)),
+        alphabet.tobytes(),
+        lengths_to_bytes(block.lengths),
+        encoder.finish(),
+    ])
+
+
+def decompress(data: bytes) -> QualityBlock:
+    stream = io.BytesIO(data)
+    parameters = ContextParameters.from_stream(stream)
+    alphabet_size, = struct.unpack("B", stream.read(1))
+    alphabet = np.frombuffer(stream.read(alphabet_size), dtype=np.uint8)
+    lengths = lengths_from_stream(stream)
+    model = ContextModel(alphabet_size, parameters)
+    decoder = RangeDecoder(stream.read())
+    symbols = []
+    for length in lengths.tolist():
+        symbols.extend(model.decode_read(decoder, length))
+    phreds = alphabet[np.array(symbols, dtype=np.intp)]
+    return QualityBlock(phreds.tobytes(), lengths)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("quals", help="File with a quality string on each line.")
+    parser.add_argument("-n", "--lines", type=int,
+                        help="Only compress the first n lines.")
+    parser.add_argument("--q1-bits", type=int, default=DEFAULT_PARAMETERS.q1_bits,
+                        help="Bits of the previous phred in the context.")
+    parser.add_argument("--q2-bits", type=int, default=DEFAULT_PARAMETERS.q2_bits,
+                        help="Bits of the phred before that in the context.")
+    parser.add_argument("--position-bits", type=int,
+                        default=DEFAULT_PARAMETERS.position_bits,
+                        help="Bits of the log2 position bucket in the context.")
+    parser.add_argument("--delta-bits", type=int,
+                        default=DEFAULT_PARAMETERS.delta_bits,
+                        help="Bits of the running delta in the context.")
+    args = parser.parse_args()
+    parameters = ContextParameters(args.q1_bits, args.q2_bits,
+                                   args.position_bits, args.delta_bits)
+    block = read_file(args.quals, args.lines)
+    start = time.perf_counter()
+    compressed = compress(block, parameters)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    decompressed = decompress(compressed)
+    decode_time = time.perf_counter() - start
+    assert decompressed.data == block.data
+    assert np.array_equal(decompressed.lengths, block.lengths)
+    print(f"original\t{len(block.data) + len(block)}")
+    print(f"compressed\t{len(compressed)}")
+    print(f"encode time\t{encode_time:.2f}s")
+    print(f"decode time\t{decode_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
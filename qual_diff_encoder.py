@@ -1,35 +1,36 @@
 #!/usr/bin/env python3
 import array
-import collections
 import sys
 
 import dnaio
+import numpy as np
+
+from quality_block import QualityBlock, blocks_from_records
+
+
+def qual_diff_encode(qualities: str) -> array.ArrayType:
+    block = QualityBlock.from_qualities([qualities])
+    phreds = block.phreds()
+    if len(phreds) and (phreds.min() < 33 or phreds.max() > 126):
+        raise ValueError(f"Qualities contain characters outside the phred range: "
+                         f"{qualities}")
+    return array.array("b", block.delta_encode().tobytes())
+
+
+def qual_diff_decode(encoded: array.ArrayType) -> str:
+    deltas = np.frombuffer(encoded, dtype=np.int8)
+    return np.cumsum(deltas, dtype=np.int64).astype(np.uint8).tobytes().decode("ascii")
 
-def qual_diff_encode(qualities: str) -> bytes:
-    qualities_raw = qualities.encode('ascii')
-    previous_phred = qualities_raw[0]
-    assert previous_phred >= 33
-    assert previous_phred <= 126
-    encoded_diffs = array.array("b", bytes(len(qualities)))
-    encoded_diffs[0] = previous_phred
-    for i, phred in enumerate(qualities_raw[1:], start=1):
-        assert phred >= 33
-        assert phred <= 126
-        diff = phred - previous_phred
-        previous_phred = phred
-        encoded_diffs[i] = diff
-    return encoded_diffs
-
-
-def qual_diff_decode(encoded: str):
-    pass
 
 if __name__ == "__main__":
-    counter = collections.Counter()
+    counts = np.zeros(256, dtype=np.int64)
     with dnaio.open(sys.argv[1]) as f:
-        for record in f:
-            counter.update(qual_diff_encode(record.qualities))
-    print(len(counter))
-    for diff, count in counter.most_common():
-        print(f"{diff}\t{count}")
-
+        for block in blocks_from_records(f):
+            deltas = block.delta_encode()
+            counts += np.bincount(deltas.view(np.uint8), minlength=256)
+    diffs = np.arange(256, dtype=np.uint8).view(np.int8)
+    print(np.count_nonzero(counts))
+    for i in np.argsort(-counts, kind="stable"):
+        if counts[i] == 0:
+            break
+        print(f"{diffs[i]}\t{counts[i]}")
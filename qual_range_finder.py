@@ -20,11 +20,33 @@ def find_ranges(data: bytes, max_diff=15):
 
     yield range_start, len(data)
 
+def native_encode(quals_file):
+    # Build the extension first with: python setup.py build_ext --inplace
+    from diffcompress import decode_ranges, encode_ranges
+    encoded_length = 0
+    with open(quals_file, "rb") as f:
+        for line in f:
+            quals = line.rstrip(b"\n")
+            encoded = encode_ranges(quals)
+            if decode_ranges(encoded) != quals:
+                raise RuntimeError(f"Round trip failed for line: {quals}")
+            encoded_length += len(encoded)
+        print(f.tell())
+    print(encoded_length)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("quals")
     parser.add_argument("-e", "--encode-bits", type=int, default=4)
+    parser.add_argument("-n", "--native", action="store_true",
+                        help="Encode with the diffcompress C extension and "
+                             "check that decoding restores the qualities. "
+                             "Only supports 4 encode bits.")
     args = parser.parse_args()
+    if args.native:
+        native_encode(args.quals)
+        return
     encoded_length = 0
     encode_bits = args.encode_bits
     max_diff = 2 ** encode_bits - 1
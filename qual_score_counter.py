@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 
 import sys
-from collections import Counter
 
 import dnaio
+import numpy as np
+
+from quality_block import PHRED_CHARACTERS, PHRED_OFFSET, blocks_from_records
 
 
 if __name__ == "__main__":
-    counter = Counter()
+    counts = np.zeros(PHRED_CHARACTERS, dtype=np.int64)
     with dnaio.open(sys.argv[1], open_threads=4) as f:
-
-        for record in f:
-            counter.update(record.qualities)
-    print(len(counter))
-    for phred, count in counter.most_common():
-        print(f"{ord(phred) - 33}\t{count}")
+        for block in blocks_from_records(f):
+            counts += block.counts()
+    print(np.count_nonzero(counts))
+    for phred in np.argsort(-counts, kind="stable"):
+        if counts[phred] == 0:
+            break
+        print(f"{phred - PHRED_OFFSET}\t{counts[phred]}")
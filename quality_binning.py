@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+Quality binning for archival storage.
+
+A binning table maps every phred to the representative value of its bin
+and is applied to an entire QualityBlock at once with bytes.translate.
+Illumina's 8-level scheme is built in, other schemes can be given as
+LOW-HIGH:VALUE bins. Binning is lossy, so the error it introduces is
+reported next to the compressed size.
+
+Independently of binning, a block can be stored compacted: every phred is
+replaced by its rank in the alphabet of the block. This is lossless and
+brings all values close together, which helps the range encoding of
+qual_range_finder. The result is compressed with the entropy backends.
+"""
+
+import argparse
+import io
+import struct
+import time
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from entropy_backends import BULK_BACKENDS, compress_column, decompress_column
+from quality_block import (MAX_PHRED, PHRED_OFFSET, QualityBlock,
+                           lengths_from_stream, lengths_to_bytes, read_file)
+
+COMPACT = 0b01
+RANGE_ENCODED = 0b10
+
+
+class Bin(NamedTuple):
+    low: int
+    high: int
+    value: int
+
+
+# Phreds 0 and 1 (no calls) are kept as is.
+ILLUMINA_8_BINS = [
+    Bin(2, 9, 6),
+    Bin(10, 19, 15),
+    Bin(20, 24, 22),
+    Bin(25, 29, 27),
+    Bin(30, 34, 33),
+    Bin(35, 39, 37),
+    Bin(40, MAX_PHRED, 40),
+]
+
+SCHEMES = {
+    "none": [],
+    "illumina8": ILLUMINA_8_BINS,
+}
+
+
+def parse_bins(spec: str) -> List[Bin]:
+    """
+    Parse bins such as "2-9:6,10-19:15,20-:30". A bin without a high end
+    runs up to the highest phred.
+    """
+    bins = []
+    for part in spec.split(","):
+        phred_range, _, value = part.partition(":")
+        low, _, high = phred_range.partition("-")
+        if not value or not low:
+            raise ValueError(f"Bins should be written as LOW-HIGH:VALUE, got {part!r}")
+        bins.append(Bin(int(low), int(high) if high else MAX_PHRED, int(value)))
+    return bins
+
+
+def binning_table(bins: Iterable[Bin], offset: int = PHRED_OFFSET) -> bytes:
+    """256 byte translate table for ASCII phreds. Unbinned phreds are kept."""
+    table = bytearray(range(256))
+    for low, high, value in bins:
+        if not 0 <= low <= high <= MAX_PHRED or not 0 <= value <= MAX_PHRED:
+            raise ValueError(f"Invalid bin {low}-{high}:{value}, phreds "
+                             f"should be between 0 and {MAX_PHRED}")
+        table[low + offset:high + offset + 1] = bytes(
+            [value + offset]) * (high - low + 1)
+    return bytes(table)
+
+
+IDENTITY = binning_table([])
+
+
+def bin_qualities(qualities: Sequence[str], table: bytes) -> List[str]:
+    return QualityBlock.from_qualities(qualities).translate(table).qualities()
+
+
+class BinningError(NamedTuple):
+    mean_absolute: float
+    root_mean_square: float
+    maximum: int
+
+
+def binning_error(original: QualityBlock, binned: QualityBlock) -> BinningError:
+    """Error in phred units introduced by binning."""
+    difference = binned.phreds().astype(np.int16) - original.phreds()
+    if len(difference) == 0:
+        return BinningError(0.0, 0.0, 0)
+    absolute = np.abs(difference)
+    return BinningError(float(absolute.mean()),
+                        float(np.sqrt(np.mean(np.square(difference, dtype=np.float64)))),
+                        int(absolute.max()))
+
+
+def compact_alphabet(block: QualityBlock) -> Tuple[bytes, QualityBlock]:
+    """Replace every phred by its rank in the alphabet of the block."""
+    alphabet = np.flatnonzero(np.bincount(block.phreds(), minlength=256))
+    ranks = np.zeros(256, dtype=np.uint8)
+    ranks[alphabet] = np.arange(len(alphabet))
+    return alphabet.astype(np.uint8).tobytes(), block.translate(ranks.tobytes())
+
+
+def compress(block: QualityBlock, table: bytes = IDENTITY, compact: bool = True,
+             range_encode: bool = False,
+             backend_ids: Optional[Iterable[int]] = BULK_BACKENDS) -> bytes:
+    """
+    Bin the block with table and compress it. Range encoding needs the
+    diffcompress extension.
+    """
+    block = block.translate(table)
+    flags = 0
+    alphabet_header = b""
+    if compact and block.data:
+        alphabet, block = compact_alphabet(block)
+        flags |= COMPACT
+        # 256 symbols do not fit in a byte, store the count minus one.
+        alphabet_header = struct.pack("B", len(alphabet) - 1) + alphabet
+    payload = block.data
+    if range_encode:
+        payload = block.range_encode()
+        flags |= RANGE_ENCODED
+    return b"".join([
+        struct.pack("B", flags),
+        alphabet_header,
+        lengths_to_bytes(block.lengths),
+        compress_column(payload, backend_ids),
+    ])
+
+
+def decompress(data: bytes) -> QualityBlock:
+    stream = io.BytesIO(data)
+    flags, = struct.unpack("B", stream.read(1))
+    alphabet = None
+    if flags & COMPACT:
+        alphabet_size, = struct.unpack("B", stream.read(1))
+        alphabet = stream.read(alphabet_size + 1)
+    lengths = lengths_from_stream(stream)
+    payload = decompress_column(stream)
+    if flags & RANGE_ENCODED:
+        block = QualityBlock.range_decode(payload, lengths)
+    else:
+        block = QualityBlock(payload, lengths)
+    if alphabet is not None:
+        block = block.translate(alphabet.ljust(256, b"\x00"))
+    return block
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("quals", help="File with a quality string on each line.")
+    parser.add_argument("-s", "--scheme", choices=SCHEMES, default="illumina8")
+    parser.add_argument("--bins", type=parse_bins,
+                        help="Custom bins as LOW-HIGH:VALUE,... in phred "
+                             "units. Overrides --scheme.")
+    parser.add_argument("-n", "--lines", type=int,
+                        help="Only use the first n lines.")
+    args = parser.parse_args()
+    bins = args.bins if args.bins is not None else SCHEMES[args.scheme]
+    table = binning_table(bins)
+    block = read_file(args.quals, args.lines)
+    binned = block.translate(table)
+    error = binning_error(block, binned)
+    print(f"phreds\t\t{len(block.data)}")
+    print(f"distinct\t{np.count_nonzero(block.counts())} -> "
+          f"{np.count_nonzero(binned.counts())}")
+    print(f"mean abs error\t{error.mean_absolute:.4f}")
+    print(f"rms error\t{error.root_mean_square:.4f}")
+    print(f"max error\t{error.maximum}")
+    for compact in (False, True):
+        for range_encode in (False, True):
+            name = "+".join(["compact" if compact else "plain"] +
+                            (["range"] if range_encode else []))
+            start = time.perf_counter()
+            try:
+                compressed = compress(block, table, compact, range_encode)
+            except ImportError:
+                print(f"{name}\tdiffcompress extension is not built")
+                continue
+            encode_time = time.perf_counter() - start
+            decompressed = decompress(compressed)
+            assert decompressed.data == binned.data
+            assert np.array_equal(decompressed.lengths, binned.lengths)
+            bits_per_phred = len(compressed) * 8 / max(len(block.data), 1)
+            print(f"{name:<16}{len(compressed)}\t{bits_per_phred:.3f} bits/phred"
+                  f"\t{encode_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Block based container for quality strings.
+
+All qualities of a block are concatenated into one contiguous buffer and
+the length of each read is kept in a separate array. Transforms work on
+the entire buffer at once instead of on one Python string per read.
+"""
+
+import argparse
+import array
+import io
+import struct
+import time
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from bitpacking import array_type_to_itemsize, numbers_to_array
+from mmap_reader import LineBlock, MappedFile
+from parallel import batched
+
+PHRED_OFFSET = 33
+MAX_PHRED = ord("~") - PHRED_OFFSET
+# Number of ASCII values up to and including the highest phred character.
+PHRED_CHARACTERS = PHRED_OFFSET + MAX_PHRED + 1
+
+
+def read_starts(lengths: np.ndarray) -> np.ndarray:
+    return np.cumsum(lengths) - lengths
+
+
+def segmented_cumsum(deltas: np.ndarray, starts: np.ndarray,
+                     lengths: np.ndarray) -> np.ndarray:
+    """
+    Cumulative sum of deltas that restarts at every read. The value at the
+    start of each read is taken as is.
+    """
+    cumulative = np.cumsum(deltas, dtype=np.int64)
+    read_of_position = np.repeat(np.arange(len(lengths)), lengths)
+    offsets = cumulative[starts] - deltas[starts]
+    return cumulative - offsets[read_of_position]
+
+
+def lengths_to_bytes(lengths: np.ndarray) -> bytes:
+    if len(lengths):
+        length_array = numbers_to_array(lengths.tolist())
+    else:
+        length_array = array.array("B")
+    header = struct.pack("<IB", len(length_array), ord(length_array.typecode))
+    return header + length_array.tobytes()
+
+
+def lengths_from_stream(stream: BinaryIO) -> np.ndarray:
+    number_of_reads, typecode = struct.unpack("<IB", stream.read(5))
+    typecode = chr(typecode)
+    return np.frombuffer(
+        stream.read(number_of_reads * array_type_to_itemsize(typecode)),
+        dtype=typecode).astype(np.int64)
+
+
+class QualityBlock:
+    data: bytes
+    lengths: np.ndarray
+
+    def __init__(self, data: bytes, lengths: Sequence[int]):
+        self.data = data
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        if self.lengths.sum() != len(data):
+            raise ValueError(f"Lengths add up to {self.lengths.sum()}, but "
+                             f"there are {len(data)} phreds.")
+
+    @classmethod
+    def from_qualities(cls, qualities: Sequence[str]):
+        lengths = np.fromiter(map(len, qualities), dtype=np.int64,
+                              count=len(qualities))
+        return cls("".join(qualities).encode("ascii"), lengths)
+
+    @classmethod
+    def from_line_block(cls, block: LineBlock):
+        return cls(block.concatenated().tobytes(), block.lengths())
+
+    @classmethod
+    def from_lines(cls, lines: bytes):
+        """Create a block from newline terminated quality strings."""
+        if lines and not lines.endswith(b"\n"):
+            lines += b"\n"
+        buffer = np.frombuffer(lines, dtype=np.uint8)
+        is_newline = buffer == ord("\n")
+        newlines = np.flatnonzero(is_newline)
+        lengths = np.diff(newlines, prepend=-1) - 1
+        return cls(buffer[~is_newline].tobytes(), lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def phreds(self) -> np.ndarray:
+        return np.frombuffer(self.data, dtype=np.uint8)
+
+    def qualities(self) -> List[str]:
+        return self.to_lines().decode("ascii").split("\n")[:-1]
+
+    def to_lines(self) -> bytes:
+        starts = read_starts(self.lengths)
+        lines = np.insert(self.phreds(), starts + self.lengths, ord("\n"))
+        return lines.tobytes()
+
+    def counts(self) -> np.ndarray:
+        """Number of occurrences of each ASCII phred character."""
+        counts = np.bincount(self.phreds(), minlength=PHRED_CHARACTERS)
+        if len(counts) > PHRED_CHARACTERS:
+            raise ValueError(f"Quality characters should be between "
+                             f"{chr(PHRED_OFFSET)!r} and {chr(PHRED_CHARACTERS - 1)!r}")
+        return counts
+
+    def delta_encode(self) -> np.ndarray:
+        """
+        Difference with the previous phred in the same read. The first
+        phred of each read is stored as is.
+        """
+        phreds = self.phreds().astype(np.int16)
+        deltas = np.diff(phreds, prepend=0)
+        starts = read_starts(self.lengths)
+        starts = starts[self.lengths > 0]
+        deltas[starts] = phreds[starts]
+        return deltas.astype(np.int8)
+
+    @classmethod
+    def delta_decode(cls, deltas: np.ndarray, lengths: Sequence[int]):
+        lengths = np.asarray(lengths, dtype=np.int64)
+        starts = read_starts(lengths)
+        non_empty = lengths > 0
+        phreds = segmented_cumsum(deltas.astype(np.int64), starts[non_empty],
+                                  lengths[non_empty])
+        return cls(phreds.astype(np.uint8).tobytes(), lengths)
+
+    def range_encode(self) -> bytes:
+        """
+        Range encode the entire buffer with the diffcompress extension.
+        Stretches may cross read boundaries as the lengths are stored
+        separately.
+        """
+        from diffcompress import encode_ranges
+        return encode_ranges(self.data)
+
+    @classmethod
+    def range_decode(cls, encoded: bytes, lengths: Sequence[int]):
+        from diffcompress import decode_ranges
+        return cls(decode_ranges(encoded), lengths)
+
+    def translate(self, table: bytes):
+        """Map every phred through a 256 byte table, for instance for binning."""
+        return type(self)(self.data.translate(table), self.lengths)
+
+    def to_bytes(self) -> bytes:
+        return lengths_to_bytes(self.lengths) + self.data
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        stream = io.BytesIO(data)
+        lengths = lengths_from_stream(stream)
+        return cls(stream.read(), lengths)
+
+
+def read_file(path: str, lines: Optional[int] = None) -> QualityBlock:
+    """
+    Read a file with a quality string on each line as one block. With
+    lines only the first lines quality strings are read.
+    """
+    with MappedFile(path) as f:
+        for block in f.blocks(lines or max(len(f), 1)):
+            return QualityBlock.from_line_block(block)
+    return QualityBlock(b"", [])
+
+
+def read_blocks(lines: Iterable[bytes], block_size: int) -> Iterator[QualityBlock]:
+    for block in batched(lines, block_size):
+        yield QualityBlock.from_lines(b"".join(block))
+
+
+def blocks_from_records(records: Iterable, block_size: int = 10_000
+                        ) -> Iterator[QualityBlock]:
+    """Group the qualities of dnaio records into blocks."""
+    qualities = []
+    for record in records:
+        qualities.append(record.qualities)
+        if len(qualities) == block_size:
+            yield QualityBlock.from_qualities(qualities)
+            qualities = []
+    if qualities:
+        yield QualityBlock.from_qualities(qualities)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load a file with a quality string on each line as a "
+                    "QualityBlock and report the size of each transform.")
+    parser.add_argument("quals")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    block = read_file(args.quals)
+    print(f"reads\t\t{len(block)}")
+    print(f"phreds\t\t{len(block.data)}")
+    print(f"distinct\t{np.count_nonzero(block.counts())}")
+    deltas = block.delta_encode()
+    assert QualityBlock.delta_decode(deltas, block.lengths).data == block.data
+    print(f"distinct deltas\t{len(np.unique(deltas))}")
+    try:
+        range_encoded = block.range_encode()
+    except ImportError:
+        print("range encoded\tdiffcompress extension is not built")
+    else:
+        assert QualityBlock.range_decode(range_encoded, block.lengths).data == block.data
+        print(f"range encoded\t{len(range_encoded)}")
+    print(f"time\t\t{time.perf_counter() - start:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,33 +5,215 @@ Script to sort and unsort a file using the sort indexes.
 """
 import argparse
 import array
+import heapq
 import operator
+import os
+import sys
+import tempfile
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
 
-def sort_file(file, output, index_output, array_type="H"):
+from mmap_reader import MappedFile
+from permutation_codec import (permutation_chunks, read_permutation_length,
+                               write_permutation)
+
+# Rough memory cost of keeping a line and its index in a Python list.
+LINE_OVERHEAD = 100
+INDEX_CHUNK_SIZE = 64 * 1024
+# Runs merged at once. Each run keeps its lines and indexes file open.
+MAX_MERGE_RUNS = 64
+
+
+def parse_memory_limit(value: str) -> int:
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def line_cost(line: bytes) -> int:
+    return sys.getsizeof(line) + LINE_OVERHEAD
+
+
+def read_index_chunks(f: BinaryIO, array_type: str) -> Iterator[array.array]:
+    while True:
+        indexes = array.array(array_type)
+        data = f.read(INDEX_CHUNK_SIZE * indexes.itemsize)
+        if not data:
+            return
+        indexes.frombytes(data)
+        yield indexes
+
+
+def read_indexes(f: BinaryIO, array_type: str) -> Iterator[int]:
+    for indexes in read_index_chunks(f, array_type):
+        yield from indexes
+
+
+def read_compact_indexes(f: BinaryIO) -> Iterator[int]:
+    for indexes in permutation_chunks(f):
+        yield from indexes.tolist()
+
+
+def with_newline(line: bytes) -> bytes:
+    """
+    The last line of a file may lack a newline. Sorting would move it in
+    between other lines and join it with the next one.
+    """
+    return line if line.endswith(b"\n") else line + b"\n"
+
+
+def sorted_runs(file, memory_limit: int) -> Iterator[List[Tuple[int, bytes]]]:
     with open(file, "rb") as f:
-        indexes_and_lines = list(enumerate(f.readlines()))
-    indexes_and_lines.sort(key=operator.itemgetter(1))
-    indexes = array.array(array_type, (index for index, line in indexes_and_lines))
+        run = []
+        run_size = 0
+        for index, line in enumerate(f):
+            run.append((index, with_newline(line)))
+            run_size += line_cost(line)
+            if run_size >= memory_limit:
+                run.sort(key=operator.itemgetter(1))
+                yield run
+                run = []
+                run_size = 0
+        if run:
+            run.sort(key=operator.itemgetter(1))
+            yield run
+
+
+def read_run(lines_file, indexes_file) -> Iterator[Tuple[int, bytes]]:
+    with open(lines_file, "rb") as lines:
+        with open(indexes_file, "rb") as indexes:
+            yield from zip(read_indexes(indexes, "Q"), lines)
+
+
+def write_run(run: Iterable[Tuple[int, bytes]], lines_file, indexes_file):
+    with open(lines_file, "wb") as lines, open(indexes_file, "wb") as index_out:
+        indexes = array.array("Q")
+        for index, line in run:
+            lines.write(line)
+            indexes.append(index)
+            if len(indexes) == INDEX_CHUNK_SIZE:
+                index_out.write(indexes.tobytes())
+                indexes = array.array("Q")
+        index_out.write(indexes.tobytes())
+
+
+def merge_runs(runs: List[Tuple[str, str]]) -> Iterator[Tuple[int, bytes]]:
+    return heapq.merge(*(read_run(lines_file, indexes_file)
+                         for lines_file, indexes_file in runs),
+                       key=operator.itemgetter(1))
+
+
+def external_sort_file(file, output, index_output, array_type, memory_limit):
+    """
+    Sort lines in runs that fit in memory_limit, write the runs to
+    temporary files and k-way merge them. Every run keeps two files open,
+    so at most MAX_MERGE_RUNS runs are merged at once, in multiple passes
+    if needed. Equal lines are merged in input order, so the result is the
+    same as sort_file.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        runs = []
+        for run_number, run in enumerate(sorted_runs(file, memory_limit)):
+            run_files = (os.path.join(tmpdir, f"{run_number}.lines"),
+                         os.path.join(tmpdir, f"{run_number}.indexes"))
+            write_run(run, *run_files)
+            runs.append(run_files)
+        merge_pass = 0
+        while len(runs) > MAX_MERGE_RUNS:
+            merged_runs = []
+            for group_start in range(0, len(runs), MAX_MERGE_RUNS):
+                group = runs[group_start:group_start + MAX_MERGE_RUNS]
+                run_name = f"pass{merge_pass}_{len(merged_runs)}"
+                run_files = (os.path.join(tmpdir, f"{run_name}.lines"),
+                             os.path.join(tmpdir, f"{run_name}.indexes"))
+                write_run(merge_runs(group), *run_files)
+                for path in (path for run_files in group for path in run_files):
+                    os.remove(path)
+                merged_runs.append(run_files)
+            runs = merged_runs
+            merge_pass += 1
+        merged_indexes = array.array(array_type)
+        with open(output, "wb") as out:
+            with open(index_output, "wb") as index_out:
+                for index, line in merge_runs(runs):
+                    out.write(line)
+                    merged_indexes.append(index)
+                    if len(merged_indexes) == INDEX_CHUNK_SIZE:
+                        index_out.write(merged_indexes.tobytes())
+                        merged_indexes = array.array(array_type)
+                index_out.write(merged_indexes.tobytes())
+
+
+def compact_index_file(index_file, array_type: str):
+    """
+    Replace a raw index array with its permutation_codec encoding. The
+    indexes are encoded a chunk at a time into a temporary file.
+    """
+    length = os.stat(index_file).st_size // array.array(array_type).itemsize
+    compact_file = index_file + ".compact"
+    with open(index_file, "rb") as f, open(compact_file, "wb") as out:
+        write_permutation(out, read_index_chunks(f, array_type), length)
+    os.replace(compact_file, index_file)
+
+
+def sort_file(file, output, index_output, array_type="H",
+              memory_limit: Optional[int] = None, compact: bool = False):
+    if memory_limit is not None:
+        external_sort_file(file, output, index_output, array_type, memory_limit)
+    else:
+        memory_sort_file(file, output, index_output, array_type)
+    if compact:
+        compact_index_file(index_output, array_type)
+
+
+def memory_sort_file(file, output, index_output, array_type="H"):
+    with MappedFile(file) as f:
+        lines = [with_newline(bytes(line)) for block in f.blocks(INDEX_CHUNK_SIZE)
+                 for line in block.with_newlines()]
+    order = sorted(range(len(lines)), key=lines.__getitem__)
     with open(output, "wb") as f:
-        for index, line in indexes_and_lines:
-            f.write(line)
+        f.writelines(lines[index] for index in order)
     with open(index_output, "wb") as f:
-        f.write(indexes.tobytes())
+        f.write(array.array(array_type, order).tobytes())
 
 
-def unsort_file(input, input_indexes, output, array_type="H"):
-    with open(input, "rb") as f:
-        lines = f.readlines()
-    with open(input_indexes, "rb") as f:
-        # Use frombytes rather than the __init__ method as frombytes
-        # will do a memory copy rather than iterating over the bytestring.
-        indexes = array.array(array_type)
-        indexes.frombytes(f.read())
-    indexes_and_lines = list(zip(indexes, lines))
-    indexes_and_lines.sort(key=operator.itemgetter(0))
-    with open(output, "wb") as f:
-        for index, line in indexes_and_lines:
-            f.write(line)
+def unsort_file(input, input_indexes, output, array_type="H",
+                memory_limit: Optional[int] = None, compact: bool = False):
+    """
+    Put every line back at its original position. Lines are scattered
+    directly into place using the indexes. When the lines do not fit in
+    memory_limit, the output is produced in windows of original positions
+    with one pass over the input per window. An empty input gives an empty
+    output.
+    """
+    if compact:
+        with open(input_indexes, "rb") as f:
+            number_of_lines = read_permutation_length(f)
+    else:
+        number_of_lines = os.stat(input_indexes).st_size // array.array(array_type).itemsize
+    window_size = max(1, number_of_lines)
+    if memory_limit is not None:
+        with open(input, "rb") as f:
+            total_cost = sum(line_cost(line) for line in f)
+        number_of_windows = max(1, -(-total_cost // memory_limit))
+        window_size = max(1, -(-number_of_lines // number_of_windows))
+    with open(output, "wb") as out:
+        for window_start in range(0, number_of_lines, window_size):
+            window_end = min(window_start + window_size, number_of_lines)
+            window: List[Optional[bytes]] = [None] * (window_end - window_start)
+            with open(input, "rb") as f, open(input_indexes, "rb") as idxf:
+                if compact:
+                    indexes = read_compact_indexes(idxf)
+                else:
+                    indexes = read_indexes(idxf, array_type)
+                for index, line in zip(indexes, f):
+                    if window_start <= index < window_end:
+                        window[index - window_start] = with_newline(line)
+            if None in window:
+                raise ValueError(f"{input} has fewer lines than there are "
+                                 f"indexes in {input_indexes}")
+            out.writelines(window)
 
 
 def main():
@@ -42,20 +224,36 @@ def main():
     sort_parser.add_argument("-o", "--output")
     sort_parser.add_argument("-i", "--indexes-output")
     sort_parser.add_argument("-t", "--index-array-type", default="H")
+    sort_parser.add_argument("-m", "--memory-limit", type=parse_memory_limit,
+                             help="Sort in runs on disk that use at most this "
+                                  "much memory, for example 2G.")
+    sort_parser.add_argument("-c", "--compact-indexes", action="store_true",
+                             help="Store the indexes with the smallest "
+                                  "permutation encoding instead of as an array.")
     unsort_parser = subparsers.add_parser("unsort")
     unsort_parser.add_argument("input")
     unsort_parser.add_argument("indexes")
     unsort_parser.add_argument("-o", "--output", default="/dev/stdout")
     unsort_parser.add_argument("-t", "--index-array-type", default="H")
+    unsort_parser.add_argument("-m", "--memory-limit", type=parse_memory_limit,
+                               help="Restore the order in windows that use at "
+                                    "most this much memory. The input is read "
+                                    "once to size the windows and once more "
+                                    "for every window.")
+    unsort_parser.add_argument("-c", "--compact-indexes", action="store_true",
+                               help="The indexes were stored with "
+                                    "--compact-indexes.")
     args = parser.parse_args()
     if hasattr(args, "indexes"):
-        unsort_file(args.input, args.indexes, args.output, args.index_array_type)
+        unsort_file(args.input, args.indexes, args.output, args.index_array_type,
+                    args.memory_limit, args.compact_indexes)
         return
     if args.output is None:
         args.output = args.input + ".sorted"
     if args.indexes_output is None:
         args.indexes_output = args.output + ".indexes"
-    sort_file(args.input, args.output, args.indexes_output, args.index_array_type)
+    sort_file(args.input, args.output, args.indexes_output, args.index_array_type,
+              args.memory_limit, args.compact_indexes)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+Sequence codec that stores A, C, G and T at 2 bits per base.
+
+All sequences of a block are concatenated and packed four bases to a byte
+with lookup tables. Any other symbol (N, IUPAC codes, lower case) is
+stored as A in the packed buffer and recorded in a sparse exception list
+of runs: the gap since the previous run, the run length and the symbol.
+N stretches therefore cost a few bytes per stretch, not per base. The
+exception list is compressed separately.
+
+The packed buffer is compressed with the generic backends, or optionally
+with an adaptive order-k context model over the preceding bases.
+"""
+
+import argparse
+import io
+import struct
+import time
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import dnaio
+import numpy as np
+
+from entropy_backends import BULK_BACKENDS, compress_column, decompress_column
+from qual_context_model import AdaptiveModel, RangeDecoder, RangeEncoder
+from quality_block import lengths_from_stream, lengths_to_bytes, read_starts
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+NOT_A_BASE = 0xFF
+
+BASE_TO_CODE = np.full(256, NOT_A_BASE, dtype=np.uint8)
+BASE_TO_CODE[BASES] = np.arange(4)
+# Every packed byte to its four 2-bit codes, most significant bits first.
+BYTE_TO_CODES = ((np.arange(256)[:, np.newaxis] >> np.array([6, 4, 2, 0])) & 3
+                 ).astype(np.uint8)
+BYTE_TO_BASES = BASES[BYTE_TO_CODES]
+
+PACKED = 0
+CONTEXT_MODEL = 1
+
+MAX_ORDER = 12
+
+
+class Exceptions(NamedTuple):
+    """Runs of symbols that are not A, C, G or T."""
+    starts: np.ndarray
+    lengths: np.ndarray
+    symbols: bytes
+
+    def to_bytes(self) -> bytes:
+        gaps = np.diff(self.starts, prepend=0)
+        gaps[1:] -= self.lengths[:-1]
+        return lengths_to_bytes(gaps) + lengths_to_bytes(self.lengths) + self.symbols
+
+    @classmethod
+    def from_stream(cls, stream: BinaryIO):
+        gaps = lengths_from_stream(stream)
+        lengths = lengths_from_stream(stream)
+        ends = np.cumsum(gaps + lengths)
+        return cls(ends - lengths, lengths, stream.read(len(lengths)))
+
+
+def find_exceptions(data: bytes, codes: np.ndarray) -> Exceptions:
+    positions = np.flatnonzero(codes == NOT_A_BASE)
+    if len(positions) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return Exceptions(empty, empty, b"")
+    symbols = np.frombuffer(data, dtype=np.uint8)[positions]
+    is_start = np.ones(len(positions), dtype=bool)
+    is_start[1:] = (np.diff(positions) != 1) | (symbols[1:] != symbols[:-1])
+    run_indexes = np.flatnonzero(is_start)
+    lengths = np.diff(run_indexes, append=len(positions))
+    return Exceptions(positions[run_indexes], lengths,
+                      symbols[run_indexes].tobytes())
+
+
+def pack_bases(data: bytes) -> Tuple[bytes, Exceptions]:
+    """Pack bases at 2 bits each. Exceptions are packed as A."""
+    codes = BASE_TO_CODE[np.frombuffer(data, dtype=np.uint8)]
+    exceptions = find_exceptions(data, codes)
+    codes[codes == NOT_A_BASE] = 0
+    padded = np.zeros((len(codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+    return packed.tobytes(), exceptions
+
+
+def apply_exceptions(bases: np.ndarray, exceptions: Exceptions) -> np.ndarray:
+    if len(exceptions.symbols) == 0:
+        return bases
+    run_of_position = np.repeat(np.arange(len(exceptions.lengths)),
+                                exceptions.lengths)
+    offsets = np.arange(len(run_of_position)) - read_starts(
+        exceptions.lengths)[run_of_position]
+    positions = exceptions.starts[run_of_position] + offsets
+    symbols = np.frombuffer(exceptions.symbols, dtype=np.uint8)
+    bases[positions] = symbols[run_of_position]
+    return bases
+
+
+def unpack_bases(packed: bytes, count: int, exceptions: Exceptions) -> bytes:
+    bases = BYTE_TO_BASES[np.frombuffer(packed, dtype=np.uint8)].reshape(-1)[:count]
+    return apply_exceptions(bases, exceptions).tobytes()
+
+
+def context_model(models: Dict[int, AdaptiveModel], context: int) -> AdaptiveModel:
+    """Models are only created for contexts that occur."""
+    model = models.get(context)
+    if model is None:
+        model = models[context] = AdaptiveModel(4)
+    return model
+
+
+def context_model_encode(codes: Iterable[int], order: int) -> bytes:
+    """Code each base with an adaptive model selected by the previous bases."""
+    mask = (1 << (2 * order)) - 1
+    models: Dict[int, AdaptiveModel] = {}
+    encoder = RangeEncoder()
+    context = 0
+    for code in codes:
+        context_model(models, context).encode(encoder, code)
+        context = ((context << 2) | code) & mask
+    return encoder.finish()
+
+
+def context_model_decode(data: bytes, count: int, order: int) -> np.ndarray:
+    mask = (1 << (2 * order)) - 1
+    models: Dict[int, AdaptiveModel] = {}
+    decoder = RangeDecoder(data)
+    codes = []
+    context = 0
+    for _ in range(count):
+        code = context_model(models, context).decode(decoder)
+        codes.append(code)
+        context = ((context << 2) | code) & mask
+    return np.array(codes, dtype=np.uint8)
+
+
+def compress(sequences: Sequence[str], order: int = 0,
+             backend_ids: Optional[Iterable[int]] = BULK_BACKENDS) -> bytes:
+    """
+    Compress a block of sequences. With order 0 the packed bases are
+    compressed with the backends, otherwise with an order-k context model.
+    """
+    if not 0 <= order <= MAX_ORDER:
+        raise ValueError(f"Order must be between 0 and {MAX_ORDER}, got {order}")
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    data = "".join(sequences).encode("ascii")
+    packed, exceptions = pack_bases(data)
+    if order == 0:
+        bases = struct.pack("B", PACKED) + compress_column(packed, backend_ids)
+    else:
+        codes = BYTE_TO_CODES[np.frombuffer(packed, dtype=np.uint8)]
+        codes = codes.reshape(-1)[:len(data)].tolist()
+        bases = struct.pack("BB", CONTEXT_MODEL, order) + context_model_encode(
+            codes, order)
+    return b"".join([
+        lengths_to_bytes(lengths),
+        compress_column(exceptions.to_bytes(), backend_ids),
+        bases,
+    ])
+
+
+def decompress(data: bytes) -> List[str]:
+    stream = io.BytesIO(data)
+    lengths = lengths_from_stream(stream)
+    exceptions = Exceptions.from_stream(io.BytesIO(decompress_column(stream)))
+    count = int(lengths.sum())
+    method, = struct.unpack("B", stream.read(1))
+    if method == PACKED:
+        concatenated = unpack_bases(decompress_column(stream), count, exceptions)
+    elif method == CONTEXT_MODEL:
+        order, = struct.unpack("B", stream.read(1))
+        codes = context_model_decode(stream.read(), count, order)
+        concatenated = apply_exceptions(BASES[codes], exceptions).tobytes()
+    else:
+        raise ValueError(f"Unknown sequence method: {method}")
+    concatenated = concatenated.decode("ascii")
+    ends = np.cumsum(lengths).tolist()
+    starts = [0] + ends[:-1]
+    return [concatenated[start:end] for start, end in zip(starts, ends)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("fastq", help="FASTQ(.gz) file.")
+    parser.add_argument("-n", "--records", type=int, default=10_000,
+                        help="Number of records to compress.")
+    parser.add_argument("-k", "--order", type=int, default=0,
+                        help="Order of the context model. 0 uses the generic "
+                             "backends on the packed bases.")
+    args = parser.parse_args()
+    with dnaio.open(args.fastq) as records:
+        sequences = [record.sequence for record, _ in zip(records, range(args.records))]
+    start = time.perf_counter()
+    compressed = compress(sequences, args.order)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    assert decompress(compressed) == sequences
+    decode_time = time.perf_counter() - start
+    print(f"bases\t\t{sum(map(len, sequences))}")
+    print(f"compressed\t{len(compressed)}")
+    print(f"encode time\t{encode_time:.2f}s")
+    print(f"decode time\t{decode_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+from setuptools import Extension, setup
+
+# Only used to build the C extension in place:
+# python setup.py build_ext --inplace
+setup(
+    name="fastqcompress",
+    ext_modules=[Extension("diffcompress", ["diffcompress.c"])],
+)